@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+"""
+Benchmarks of Api operations on generated data.
+
+Every size runs the same seeded workload against each data-access backend: all offers and requests are added one by
+one, then a sample of them is cancelled. Reported per operation are throughput and p50/p99 latency, plus peak memory
+of the whole run (measured in a second, traced run so tracing does not slow down the timed one).
+
+    python benchmark.py --sizes 1000 10000 --output results.json
+    python benchmark.py --sizes 1000 --compare results.json
+"""
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from datetime import timedelta
+
+from parkingmatcher.parkingmatcher import Api, DBDataAccess, Offer, Period, Request, Spot, TestDataAccess, User, \
+    date_hour, parking_zones
+
+start_day = date_hour("2018-01-01T00")
+operations = ["new_offer", "new_request", "cancel_offer", "cancel_request"]
+backends = {"test": lambda users, spots: TestDataAccess(users, spots),
+            "db": lambda users, spots: DBDataAccess(":memory:", users, spots)}
+
+
+def hours(_from, _to):
+    return Period(start_day + timedelta(hours=_from), start_day + timedelta(hours=_to))
+
+
+def generate_users(rand, count):
+    return [User("user%d" % i, "user%d@lp.pl" % i) for i in range(count)]
+
+
+def generate_spots(rand, owners):
+    zones = sorted(parking_zones)
+    return [Spot(rand.choice(zones), i, owner) for i, owner in enumerate(owners)]
+
+
+def generate_offers(rand, spots, count, days=7):
+    offers = []
+    for _ in range(count):
+        begin = rand.randrange(days * 24)
+        offers.append(Offer.unmatched(rand.choice(spots), hours(begin, begin + rand.randint(1, 10))))
+    return offers
+
+
+def generate_requests(rand, users, count, days=7):
+    zones = sorted(parking_zones)
+    requests = []
+    for i in range(count):
+        begin = rand.randrange(days * 24)
+        period = hours(begin, begin + rand.randint(1, 10))
+        requests.append(Request(rand.choice(users), period.begin, period.end,
+                                rand.sample(zones, rand.randint(1, len(zones))),
+                                start_day - timedelta(days=days) + timedelta(seconds=i)))
+    return requests
+
+
+def workload(size, seed):
+    """
+    :return: users, spots, offers, requests and samples of them to cancel, all the same for the same size and seed
+    """
+    rand = random.Random(seed)
+    users = generate_users(rand, max(size // 10, 20))
+    spots = generate_spots(rand, users[:len(users) // 2])
+    offers = generate_offers(rand, spots, size)
+    requests = generate_requests(rand, users, size)
+    return users, spots, offers, requests, rand.sample(offers, size // 10), rand.sample(requests, size // 10)
+
+
+def run(backend, size, seed):
+    """
+    :return: operation name -> list of call durations in seconds
+    """
+    users, spots, offers, requests, offers_to_cancel, requests_to_cancel = workload(size, seed)
+    api = Api(backends[backend](users, spots))
+    timings = {}
+    for name, calls in [("new_offer", offers), ("new_request", requests),
+                        ("cancel_offer", offers_to_cancel), ("cancel_request", requests_to_cancel)]:
+        method = getattr(api, name)
+        durations = timings[name] = []
+        for argument in calls:
+            started = time.perf_counter()
+            method(argument)
+            durations.append(time.perf_counter() - started)
+    return timings
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)] if sorted_values else 0.0
+
+
+def summary(durations):
+    ordered = sorted(durations)
+    total = sum(ordered)
+    return {"calls": len(ordered),
+            "ops_per_sec": len(ordered) / total if total else 0.0,
+            "p50_ms": percentile(ordered, 0.5) * 1000,
+            "p99_ms": percentile(ordered, 0.99) * 1000}
+
+
+def benchmark(backend, size, seed):
+    result = {name: summary(durations) for name, durations in run(backend, size, seed).items()}
+    tracemalloc.start()
+    run(backend, size, seed)
+    result["peak_memory_mb"] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+    tracemalloc.stop()
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """
+    :return: lines describing operations whose throughput dropped more than `tolerance` below the baseline
+    """
+    regressions = []
+    for backend, sizes in results["results"].items():
+        for size, measured in sizes.items():
+            before = baseline.get("results", {}).get(backend, {}).get(size)
+            if before is None:
+                continue
+            for name in operations:
+                old, new = before[name]["ops_per_sec"], measured[name]["ops_per_sec"]
+                if old and new < old * (1 - tolerance):
+                    regressions.append("{0} {1} {2}: {3:.0f} -> {4:.0f} ops/s".format(backend, size, name, old, new))
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark Api operations")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="number of offers and of requests generated per run")
+    parser.add_argument("--backends", nargs="+", default=sorted(backends), choices=sorted(backends))
+    parser.add_argument("--seed", type=int, default=2018)
+    parser.add_argument("--output", help="JSON file to save results to")
+    parser.add_argument("--compare", help="JSON file of earlier results to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="throughput drop reported as a regression")
+    args = parser.parse_args(argv)
+
+    results = {"python": platform.python_version(), "seed": args.seed, "results": {}}
+    for backend in args.backends:
+        for size in args.sizes:
+            measured = results["results"].setdefault(backend, {})[str(size)] = benchmark(backend, size, args.seed)
+            for name in operations:
+                print("{0:5} {1:>7} {2:15} {3[ops_per_sec]:10.0f} ops/s  p50 {3[p50_ms]:8.3f} ms  "
+                      "p99 {3[p99_ms]:8.3f} ms".format(backend, size, name, measured[name]))
+            print("{0:5} {1:>7} peak memory {2:.1f} MB".format(backend, size, measured["peak_memory_mb"]))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions = compare(results, json.load(baseline), args.tolerance)
+        for line in regressions:
+            print("regression: " + line)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+Snapshot = namedtuple("Snapshot", ["version", "unmatched_offers", "matched_offers", "request_queue"])
+
+
+class AsyncApi:
+    def __init__(self, api, burst_size=100):
+        """
+        Asyncio front end of an Api.
+        Changes are queued and applied in order of calls by a single matcher task, which hands them to a thread of its
+        own, the only one touching the data access. Calls return futures of their results.
+        Changes queued while it works are applied together as a burst, in one transaction, each change in a nested
+        one so that a failing change leaves nothing behind. Reads are served from a snapshot of the data taken after
+        each burst, so they never wait for the matcher, nor does the event loop.
+        Use as `async with AsyncApi(api) as matcher:`, or call `start` and `stop`.
+        :param api: Api applying the changes
+        :param burst_size: most changes applied in one burst
+        """
+        if burst_size < 1:
+            raise AttributeError("burst_size must be positive")
+        self.api = api
+        self.burst_size = burst_size
+        self.__queue = None
+        self.__matcher = None
+        self.__executor = None
+        self.__version = 0  # number of bursts applied, or failed
+        self.__snapshot = None
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.stop()
+
+    def start(self):
+        if self.__matcher is not None:
+            raise AttributeError("already started")
+        self.__queue = asyncio.Queue()
+        self.__executor = ThreadPoolExecutor(max_workers=1)
+        self.__snapshot = self.__take_snapshot()
+        self.__matcher = asyncio.ensure_future(self.__match())
+
+    async def stop(self):
+        """
+        Applies all changes queued so far, then stops the matcher
+        """
+        matcher, self.__matcher = self.__matcher, None
+        if matcher is not None:
+            self.__queue.put_nowait(None)
+            await matcher
+            self.__executor.shutdown()
+
+    def new_offer(self, offer):
+        """
+        :return: future of the Request the offer was matched with, if any
+        """
+        return self.__submit("new_offer", offer)
+
+    def cancel_offer(self, offer):
+        return self.__submit("cancel_offer", offer)
+
+    def new_request(self, request):
+        """
+        :return: future of the unmatched Offer the request was matched with, if any
+        """
+        return self.__submit("new_request", request)
+
+    def cancel_request(self, request):
+        return self.__submit("cancel_request", request)
+
+    def __submit(self, method, argument):
+        if self.__matcher is None:
+            raise AttributeError("matcher not started")
+        result = asyncio.get_running_loop().create_future()
+        self.__queue.put_nowait((method, argument, result))
+        return result
+
+    async def __match(self):
+        stopping = False
+        while not stopping:
+            burst = [await self.__queue.get()]
+            while len(burst) < self.burst_size and not self.__queue.empty():
+                burst.append(self.__queue.get_nowait())
+            stopping = None in burst
+            changes = [change for change in burst if change is not None]
+            if changes:
+                loop = asyncio.get_running_loop()
+                outcomes, self.__snapshot = await loop.run_in_executor(self.__executor, self.__apply, changes)
+                self.__resolve(outcomes)
+            await asyncio.sleep(0)  # let readers and submitters run between bursts
+
+    def __apply(self, changes):
+        """
+        Applies a burst in one transaction, then takes the snapshot after it; run on the matcher thread.
+        A change that fails is rolled back on its own; if the transaction fails, so does every change of the burst,
+        and the matcher goes on with the next one.
+        :return: (result future, succeeded, result or exception) triples, and the snapshot
+        """
+        data = self.api.data
+        outcomes = []
+        try:
+            with data.transaction():
+                for method, argument, result in changes:
+                    try:
+                        with data.transaction():
+                            outcomes.append((result, True, getattr(self.api, method)(argument)))
+                    except Exception as e:
+                        outcomes.append((result, False, e))
+        except Exception as e:
+            outcomes = [(result, False, e) for _, _, result in changes]
+        self.__version += 1
+        return outcomes, self.__take_snapshot()
+
+    @staticmethod
+    def __resolve(outcomes):
+        """
+        Resolves the futures of a burst, once it is committed
+        """
+        for result, succeeded, outcome in outcomes:
+            if not result.done():
+                if succeeded:
+                    result.set_result(outcome)
+                else:
+                    result.set_exception(outcome)
+
+    def __take_snapshot(self):
+        data = self.api.data
+        return Snapshot(self.__version, tuple(data.get_unmatched_offers()), tuple(data.get_matched_offers()),
+                        tuple(data.get_request_queue()))
+
+    def snapshot(self):
+        """
+        State of the data after the last burst applied, shared by all reads until the next one
+        """
+        if self.__snapshot is None:
+            self.__snapshot = self.__take_snapshot()  # not started yet, so nothing else touches the data
+        return self.__snapshot
+
+    def get_unmatched_offers(self):
+        return list(self.snapshot().unmatched_offers)
+
+    def get_matched_offers(self):
+        return list(self.snapshot().matched_offers)
+
+    def get_request_queue(self):
+        return list(self.snapshot().request_queue)
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from parkingmatcher.parkingmatcher import parking_zones, date_hour, hours_since_epoch, spot_key
+
+
+class Availability:
+    zones = sorted(parking_zones)
+
+    def __init__(self, data):
+        """
+        Free and taken spots per zone and hour, counted over arrays of all offers at once
+        :param data: data access to read spots and offers from
+        """
+        spots = list(data.spots)
+        spot_indexes = {spot_key(spot): i for i, spot in enumerate(spots)}
+        self.spot_zones = np.array([self.zones.index(spot.zone) for spot in spots], dtype=np.int64)
+        self.unmatched = self.offer_table(data.get_unmatched_offers(), spot_indexes)
+        self.matched = self.offer_table(data.get_matched_offers(), spot_indexes)
+
+    @staticmethod
+    def offer_table(offers, spot_indexes):
+        """
+        :return: array with a (spot index, begin hour, end hour) row for every offer on a known spot
+        """
+        rows = [(spot_indexes[spot_key(off.spot)], off.period.begin_hour, off.period.end_hour) for off in offers
+                if spot_key(off.spot) in spot_indexes]
+        return np.array(rows, dtype=np.int64).reshape(-1, 3)
+
+    def free(self, begins, ends):
+        """
+        :return: zone x hour matrix of spots offered and not taken, rows in order of `zones`, one column for every
+        hour from `begins` until `ends`
+        """
+        return self.__per_zone_hour(self.unmatched, begins, ends)
+
+    def taken(self, begins, ends):
+        """
+        :return: zone x hour matrix of spots taken by matched requests, like `free`
+        """
+        return self.__per_zone_hour(self.matched, begins, ends)
+
+    def __per_zone_hour(self, table, begins, ends):
+        first = hours_since_epoch(date_hour(begins))
+        width = max(hours_since_epoch(date_hour(ends)) - first, 0)
+        # difference array: +1 in the hour an offer starts covering the window, -1 in the hour it stops
+        zone = self.spot_zones[table[:, 0]] if len(table) else np.zeros(0, dtype=np.int64)
+        start = np.clip(table[:, 1] - first, 0, width)
+        stop = np.clip(table[:, 2] - first, 0, width)
+        inside = start < stop
+        zone, start, stop = zone[inside], start[inside], stop[inside]
+        size = len(self.zones) * (width + 1)
+        diff = np.bincount(zone * (width + 1) + start, minlength=size) - \
+            np.bincount(zone * (width + 1) + stop, minlength=size)
+        return np.cumsum(diff.reshape(len(self.zones), width + 1), axis=1)[:, :width]
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+from itertools import count
+
+from parkingmatcher.periodindex import PeriodIndex
+
+
+class BatchPlan:
+    def __init__(self, offers, assignments, free):
+        """
+        Result of matching a whole queue at once
+        :param offers: the unmatched offers that were planned over
+        :param assignments: (request, position of the offer in `offers`) pairs
+        :param free: position of an offer -> periods of it left free
+        """
+        self.offers = offers
+        self.assignments = assignments
+        self.free = free
+        self.hours = sum(request.period.length() for request, _ in assignments)
+        self.greedy_hours = None
+
+    def __repr__(self):
+        return "<{0} matched for {1} h, {2} h more than one by one>".format(
+            len(self.assignments), self.hours, self.gain())
+
+    def gain(self):
+        """
+        How many more hours are assigned than by matching the queue one request at a time, like `Api.new_request`
+        """
+        return None if self.greedy_hours is None else self.hours - self.greedy_hours
+
+    def changed_offers(self):
+        """
+        :return: generator of (offer, requests assigned to it, periods of it left free) for each offer assigned to
+        """
+        assigned = {}
+        for request, position in self.assignments:
+            assigned.setdefault(position, []).append(request)
+        return ((self.offers[position], requests, self.free[position]) for position, requests in assigned.items())
+
+
+class BatchMatcher:
+    def __init__(self, offers, requests):
+        """
+        Plans matching of queued requests to unmatched offers all at once.
+        Each request is put into the free slot that leaves the smallest gap before it (interval scheduling best fit),
+        which keeps long slots whole for long requests instead of taking the shortest offer first.
+        This is a heuristic: with each request fitting only some offers, finding the plan assigning most hours is hard
+        in general, so plans are not guaranteed to be maximal, only to assign no fewer hours than one by one matching.
+        :param offers: unmatched Offers
+        :param requests: queued Requests, in order of the queue
+        """
+        self.offers = list(offers)
+        self.requests = list(requests)
+
+    def plan(self, by_when_requested=False):
+        """
+        :param by_when_requested: place requests in order of `when_requested`, so earlier requests are never left out
+        for later ones. Otherwise requests ending earliest and longest requests first are both tried. One by one
+        matching is tried as well, so the plan kept, the one assigning most hours, never assigns fewer than it.
+        :return: BatchPlan, with hours assigned by one by one matching to compare with
+        """
+        if by_when_requested:
+            orders = [self.__by_when_requested()]
+        else:
+            orders = [sorted(self.requests, key=lambda req: (req.period.end_hour, req.period.begin_hour)),
+                      sorted(self.requests, key=lambda req: -req.period.length())]
+        greedy = self.greedy()
+        plans = [self.__assign(order, self.__best_fit) for order in orders] + [greedy]
+        best = max(plans, key=lambda plan: plan.hours)
+        best.greedy_hours = greedy.hours
+        return best
+
+    def greedy(self):
+        """
+        Plan of `Api.new_request` rules applied to the queue: earliest requested first, into the shortest offer
+        """
+        return self.__assign(self.__by_when_requested(), self.__shortest)
+
+    def __by_when_requested(self):
+        return sorted(self.requests, key=lambda req: req.when_requested)
+
+    @staticmethod
+    def __best_fit(indexes, request):
+        found = [index.latest_containing(request.period) for index in indexes]
+        found = [f for f in found if f is not None]
+        return max(found, key=lambda f: (f[1].begin_hour, -f[1].length()))[0] if found else None
+
+    @staticmethod
+    def __shortest(indexes, request):
+        found = [index.shortest_containing(request.period) for index in indexes]
+        found = [f for f in found if f is not None]
+        return min(found, key=lambda f: f[1])[0] if found else None
+
+    def __assign(self, requests, pick):
+        sequence = count()
+        zone_slots = {}  # zone -> PeriodIndex of (offer position, slot number) for free slots
+        free = {}  # offer position -> {slot number: period}
+        slot_numbers = count()
+
+        def add_slot(position, period):
+            number = next(slot_numbers)
+            free.setdefault(position, {})[number] = period
+            zone_slots.setdefault(self.offers[position].spot.zone, PeriodIndex(sequence)).add((position, number),
+                                                                                              period)
+
+        for position, offer in enumerate(self.offers):
+            add_slot(position, offer.period)
+        assignments = []
+        for request in requests:
+            slot = pick([zone_slots[zone] for zone in set(request.zones) if zone in zone_slots], request)
+            if slot is None:
+                continue
+            position, number = slot
+            period = free[position].pop(number)
+            zone_slots[self.offers[position].spot.zone].remove(slot, period)
+            for per in [period.before(request.period), period.after(request.period)]:
+                if per is not None:
+                    add_slot(position, per)
+            assignments.append((request, position))
+        return BatchPlan(self.offers, assignments,
+                         {position: sorted(slots.values(), key=lambda per: per.begin_hour)
+                          for position, slots in free.items()})
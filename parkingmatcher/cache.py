@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Lock
+
+from parkingmatcher.parkingmatcher import Registry, parking_zones, spot_key
+
+
+class CachedDataAccess:
+    def __init__(self, data, size=1024):
+        """
+        Data access passing every call through to `data`, keeping the results of offer and queue reads until a change
+        they depend on.
+        Changes count versions of offers per zone and per spot, and of queued requests per zone. A read is kept
+        together with the versions it depends on, and read again once any of them changed, so results are reused
+        until something relevant happens. All changes have to be made through this data access.
+        :param size: most results kept; the least recently used ones are dropped first
+        """
+        if size < 1:
+            raise AttributeError("size must be positive")
+        self.data = data
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.__registry = Registry(data.users, data.spots)
+        self.__offer_versions = dict.fromkeys(parking_zones, 0)  # zone -> changes of offers there
+        self.__spot_versions = {}  # spot_key -> changes of offers for the spot
+        # zone -> changes of requests wanting a spot there, None -> of requests wanting no known zone
+        self.__request_versions = dict.fromkeys(parking_zones, 0)
+        self.__generation = 0  # changes of everything at once, as when cleared
+        self.__results = OrderedDict()  # (method name, arguments) -> (versions, result), least recently used first
+        self.__lock = Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.data, name)
+
+    def __versions(self, zones=(), request_zones=(), spot=None):
+        return (self.__generation, tuple(self.__offer_versions.get(zone, 0) for zone in zones),
+                tuple(self.__request_versions.get(zone, 0) for zone in request_zones),
+                self.__spot_versions.get(spot_key(spot), 0) if spot is not None else None)
+
+    def __read(self, key, versions, read):
+        with self.__lock:
+            cached = self.__results.get(key)
+            if cached is not None and cached[0] == versions:
+                self.__results.move_to_end(key)
+                self.hits += 1
+                return list(cached[1])
+            self.misses += 1
+        result = read()  # versions were taken before reading, so a change while reading is read again next time
+        with self.__lock:
+            self.__results[key] = (versions, result)
+            self.__results.move_to_end(key)
+            while len(self.__results) > self.size:
+                self.__results.popitem(last=False)
+        return list(result)
+
+    def __changed_offer(self, offer):
+        with self.__lock:
+            self.__offer_versions[offer.spot.zone] = self.__offer_versions.get(offer.spot.zone, 0) + 1
+            key = spot_key(offer.spot)
+            self.__spot_versions[key] = self.__spot_versions.get(key, 0) + 1
+
+    def __changed_request(self, request):
+        with self.__lock:
+            for zone in set(request.zones) or [None]:
+                self.__request_versions[zone] = self.__request_versions.get(zone, 0) + 1
+
+    def invalidate(self):
+        """
+        Drops every result kept, as after changes made around this data access
+        """
+        with self.__lock:
+            self.__generation += 1
+            self.__results.clear()
+
+    @contextmanager
+    def transaction(self):
+        try:
+            with self.data.transaction():
+                yield
+        except BaseException:
+            self.invalidate()  # results read inside a rolled back transaction are gone
+            raise
+
+    def clear(self):
+        self.data.clear()
+        self.invalidate()
+
+    def get_unmatched_offers(self):
+        return self.__read(("get_unmatched_offers",), self.__versions(parking_zones), self.data.get_unmatched_offers)
+
+    def get_matched_offers(self):
+        return self.__read(("get_matched_offers",), self.__versions(parking_zones), self.data.get_matched_offers)
+
+    def get_matched_requests(self):
+        return self.__read(("get_matched_requests",), self.__versions(parking_zones), self.data.get_matched_requests)
+
+    def get_request_queue(self, user=None, before=None):
+        zones = sorted(self.__registry.zones_of(user)) if user else list(parking_zones) + [None]
+        return self.__read(("get_request_queue", user.email if user else None, before),
+                           self.__versions(request_zones=zones),
+                           lambda: self.data.get_request_queue(user, before))
+
+    def get_offers_for_spot(self, spot, since=None, until=None):
+        return self.__read(("get_offers_for_spot", spot_key(spot), since, until), self.__versions(spot=spot),
+                           lambda: self.data.get_offers_for_spot(spot, since, until))
+
+    def add_offer(self, offer):
+        self.data.add_offer(offer)
+        self.__changed_offer(offer)
+
+    def delete_offer(self, offer):
+        self.data.delete_offer(offer)
+        self.__changed_offer(offer)
+
+    def add_request(self, request):
+        self.data.add_request(request)
+        self.__changed_request(request)
+
+    def delete_request_from_queue(self, request):
+        self.data.delete_request_from_queue(request)
+        self.__changed_request(request)
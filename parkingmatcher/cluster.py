@@ -0,0 +1,463 @@
+# -*- coding: utf-8 -*-
+
+from contextlib import contextmanager
+from io import BytesIO
+from itertools import count
+from multiprocessing.connection import Client, Listener
+import pickle
+import sqlite3
+from threading import Event, Lock, Thread, get_ident
+import time
+import uuid
+
+from parkingmatcher.oplog import Decoder, encode_body, methods
+from parkingmatcher.parkingmatcher import Api, TestDataAccess
+from parkingmatcher.snapshot import read_snapshot, write_snapshot
+
+
+class NotLeader(Exception):
+    pass
+
+
+class SharedStore:
+    schema = ["create table if not exists lease (name text primary key, holder text, address text, term integer, "
+              "seconds real, renewal integer)",
+              "create table if not exists operation (position integer primary key autoincrement, term integer, "
+              "caller text, call integer, body blob)",
+              "create table if not exists caller (caller text primary key, call integer, position integer, "
+              "outcome blob)",
+              "create table if not exists snapshot (position integer primary key, data blob)"]
+    lease_name = "matcher"
+
+    def __init__(self, dbfile, timeout=5.0, clock=time.monotonic):
+        """
+        What the nodes of a cluster share, in one SQLite database: the lease of the matcher leader, the calls it
+        applied, numbered by position, with the last call of every caller, and the latest snapshot of its data.
+        Clocks of different nodes are never compared: a node takes the lease once it has seen it go unrenewed for
+        the length of the lease on its own clock.
+        Another shared database, like MySQL, can take its place by providing the same methods.
+        :param dbfile: database file name
+        :param timeout: seconds to wait for another node's write lock
+        :param clock: returns the time in seconds on this node's monotonic clock
+        """
+        self.clock = clock
+        self.__seen = None  # ((term, renewal) of the lease last read, when they were first read)
+        self.dbcon = sqlite3.connect(dbfile, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self.__lock = Lock()  # one connection for all threads of a node
+        self.dbcon.execute("pragma journal_mode = WAL")
+        with self.__transaction():
+            for statement in self.schema:
+                self.dbcon.execute(statement)
+
+    def close(self):
+        self.dbcon.close()
+
+    @contextmanager
+    def __transaction(self, mode="immediate"):
+        with self.__lock:
+            self.dbcon.execute("begin " + mode)
+            try:
+                yield
+            except BaseException:
+                self.dbcon.execute("rollback")
+                raise
+            self.dbcon.execute("commit")
+
+    def __lease(self):
+        return self.dbcon.execute("select holder, address, term, seconds, renewal from lease where name = ?",
+                                  (self.lease_name,)).fetchone()
+
+    def __expired(self, lease):
+        """
+        :return: True if the lease was released, or has not been renewed for its length since this node saw it
+        """
+        now = self.clock()
+        if self.__seen is None or self.__seen[0] != (lease[2], lease[4]):
+            self.__seen = (lease[2], lease[4]), now
+        return now - self.__seen[1] >= lease[3]
+
+    def __check_term(self, term):
+        lease = self.__lease()
+        if lease is None or lease[2] != term or lease[3] <= 0:
+            raise NotLeader("term %d is over" % term)
+
+    def acquire(self, node, address, seconds):
+        """
+        Takes the lease if nobody holds it, or it ran out
+        :param address: where the node takes calls forwarded to the leader
+        :return: term of the leadership taken, or None if another node holds the lease
+        """
+        with self.__transaction():
+            lease = self.__lease()
+            if lease is not None and not self.__expired(lease):
+                return None
+            term = lease[2] + 1 if lease is not None else 1
+            self.dbcon.execute("insert or replace into lease (name, holder, address, term, seconds, renewal) "
+                               "values (?, ?, ?, ?, ?, 0)", (self.lease_name, node, address, term, seconds))
+            return term
+
+    def renew(self, term, seconds):
+        """
+        The holder counts the lease from before renewing it, on its own clock; other nodes count it from when they
+        see it renewed, which is later
+        :return: True if the lease is still held in the term, now for `seconds` more
+        """
+        with self.__transaction():
+            try:
+                self.__check_term(term)
+            except NotLeader:
+                return False
+            self.dbcon.execute("update lease set seconds = ?, renewal = renewal + 1 where name = ?",
+                               (seconds, self.lease_name))
+            return True
+
+    def release(self, term):
+        with self.__transaction():
+            self.dbcon.execute("update lease set seconds = 0, renewal = renewal + 1 where name = ? and term = ?",
+                               (self.lease_name, term))
+
+    def leader(self):
+        """
+        :return: (node, address, term) of the leader, or None if the lease ran out
+        """
+        with self.__transaction("deferred"):
+            lease = self.__lease()
+            return lease[:3] if lease is not None and not self.__expired(lease) else None
+
+    def append(self, term, method, argument, caller=None, call=None):
+        """
+        Logs a call of the leader, refused once the lease taken in `term` is lost, so a node that stopped being
+        leader without noticing yet cannot change anything.
+        A call is logged once: the same call of a caller again is not logged, but answered with where it was.
+        :param caller: id of the thread of a node making the call, making calls one at a time
+        :param call: number of the call, growing with every call of the caller
+        :return: (position of the call, True if logged now, outcome of a call logged before as published, if it was)
+        :raise NotLeader: if the term is over
+        """
+        body = encode_body(method, argument)
+        with self.__transaction():
+            self.__check_term(term)
+            if caller is not None:
+                last = self.dbcon.execute("select call, position, outcome from caller where caller = ?",
+                                          (caller,)).fetchone()
+                if last is not None and last[0] == call:
+                    return last[1], False, last[2]
+            position = self.dbcon.execute("insert into operation (term, caller, call, body) values (?, ?, ?, ?)",
+                                          (term, caller, call, body)).lastrowid
+            if caller is not None:
+                self.dbcon.execute("insert or replace into caller (caller, call, position, outcome) "
+                                   "values (?, ?, ?, null)", (caller, call, position))
+            return position, True, None
+
+    def publish(self, term, data, position, outcomes=()):
+        """
+        Stores a snapshot of the leader's data at `position`, dropping the calls it includes; the outcomes of the
+        last calls of callers are kept instead
+        :param outcomes: (caller, call, outcome) of calls up to `position`
+        :raise NotLeader: if the term is over
+        """
+        snapshot = BytesIO()
+        write_snapshot(data, snapshot, position)
+        with self.__transaction():
+            self.__check_term(term)
+            self.dbcon.executemany("update caller set outcome = ? where caller = ? and call = ? and outcome is null",
+                                   [(outcome, caller, call) for caller, call, outcome in outcomes])
+            self.dbcon.execute("insert or replace into snapshot (position, data) values (?, ?)",
+                               (position, snapshot.getvalue()))
+            self.dbcon.execute("delete from snapshot where position < ?", (position,))
+            self.dbcon.execute("delete from operation where position <= ?", (position,))
+
+    def read(self, position):
+        """
+        Reads what happened after `position`, all as of one moment
+        :return: (snapshot if there is one past `position`, else None,
+        [(position, caller, call, method number and payload)] of the calls after both)
+        """
+        with self.__transaction("deferred"):
+            snapshot = self.dbcon.execute("select position, data from snapshot where position > ? "
+                                          "order by position desc limit 1", (position,)).fetchone()
+            if snapshot is not None:
+                position = snapshot[0]
+            operations = self.dbcon.execute("select position, caller, call, body from operation where position > ? "
+                                            "order by position", (position,)).fetchall()
+        return (snapshot[1] if snapshot is not None else None), operations
+
+
+class Replica:
+    def __init__(self, users, spots):
+        """
+        Data of the leader as of a position in the shared store, brought up to date by replaying the calls logged
+        there, like the leader applied them
+        """
+        self.api = Api(TestDataAccess(users, spots))
+        self.decode = Decoder(users, spots)
+        self.position = 0
+        self.outcomes = {}  # caller -> (call, position, succeeded, result or exception) of its last call
+
+    def catch_up(self, store):
+        snapshot, operations = store.read(self.position)
+        if snapshot is not None:
+            data, self.position = read_snapshot(snapshot, name="snapshot of the shared store")
+            self.api = Api(data)
+            self.decode = Decoder(data.users, data.spots)
+        for position, caller, call, body in operations:
+            self.apply(position, caller, call, *self.decode(body))
+
+    def apply(self, position, caller, call, method, argument):
+        """
+        Applies a call logged at `position`, keeping its outcome for the caller
+        :return: (succeeded, result or exception)
+        """
+        try:
+            outcome = True, getattr(self.api, method)(argument)
+        except Exception as e:
+            outcome = False, e  # failed the same way on the leader, if replayed
+        self.position = position
+        if caller is not None:
+            self.outcomes[caller] = (call, position) + outcome
+        return outcome
+
+
+class ClusterNode:
+    def __init__(self, store, node, users, spots, authkey, host="127.0.0.1", lease_seconds=2.0, lease_margin=0.1,
+                 snapshot_every=1000, staleness=0.0, forward_timeout=10.0):
+        """
+        A node of a cluster sharing one store: one node at a time holds the lease of the leader and does all matching;
+        the others forward changes to it, and read from replicas of its data, caught up from the shared store.
+        The leader logs every call before applying it, so a node taking over after the lease ran out replays them
+        and carries on from the same data. A forwarded call is tried again on the next leader if the connection to
+        the current one breaks. Calls carry the id of the thread making them and a number, logged with them, so a
+        call the leader already applied is answered with its result instead of being applied twice.
+        The leader counts its lease on its own monotonic clock, from before renewing it, and gives it up
+        `lease_margin` seconds early, in case other nodes' clocks run slower.
+        :param store: SharedStore, or another store with its methods
+        :param node: name of the node, unique in the cluster
+        :param authkey: bytes the nodes of the cluster share to accept each other's connections
+        :param host: address nodes connect to to forward calls to this one when it is leader
+        :param lease_seconds: time the leader holds the lease for, renewed three times as often
+        :param lease_margin: seconds the leader stops reading as leader before its lease runs out
+        :param snapshot_every: calls between snapshots the leader publishes
+        :param staleness: seconds followers read their replica for before catching up; changes they forwarded are
+        always caught up with first
+        :param forward_timeout: seconds to keep trying to reach a leader for
+        """
+        self.store = store
+        self.node = node
+        self.authkey = authkey
+        self.lease_seconds = lease_seconds
+        self.lease_margin = lease_margin
+        self.snapshot_every = snapshot_every
+        self.staleness = staleness
+        self.forward_timeout = forward_timeout
+        self.replica = Replica(users, spots)
+        self.term = None  # term of the leadership, while leader
+        self.__lease_until = 0.0  # time.monotonic() the leadership is sure to last until
+        self.__lock = Lock()  # replica and leadership
+        self.__instance = "%s %s" % (node, uuid.uuid4().hex)  # calls of a node started again are new calls
+        self.__calls = count(1)
+        self.__unpublished = 0  # calls since the last snapshot
+        self.__written = 0  # position of the last call forwarded
+        self.__caught_up = None  # when the replica was last caught up
+        self.__forwarding = Lock()
+        self.__leader_connection = None  # (address, connection) calls are forwarded on
+        self.__listener = Listener((host, 0), authkey=authkey)
+        self.address = "%s:%d" % self.__listener.address
+        self.__stopped = Event()
+        self.__threads = [Thread(target=self.__heartbeat, daemon=True), Thread(target=self.__accept, daemon=True)]
+
+    def start(self):
+        self.step()
+        for thread in self.__threads:
+            thread.start()
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.__stopped.set()
+        if self.__threads[1].is_alive():
+            host, port = self.__listener.address
+            Client((host, port), authkey=self.authkey).close()  # wakes the thread waiting for connections
+        self.__listener.close()
+        for thread in self.__threads:
+            if thread.is_alive():
+                thread.join()
+        with self.__lock:
+            if self.term is not None:
+                self.store.release(self.term)
+                self.term = None
+        with self.__forwarding:
+            if self.__leader_connection is not None:
+                self.__leader_connection[1].close()
+                self.__leader_connection = None
+
+    def is_leader(self):
+        return self.term is not None and time.monotonic() < self.__lease_until
+
+    def step(self):
+        """
+        Renews the lease while leader, or takes it when it runs out, catching up before taking any call
+        :return: True if leader
+        """
+        with self.__lock:
+            started = time.monotonic()
+            if self.term is not None:
+                if not self.store.renew(self.term, self.lease_seconds):
+                    self.term = None
+            else:
+                term = self.store.acquire(self.node, self.address, self.lease_seconds)
+                if term is not None:
+                    self.replica.catch_up(self.store)
+                    self.term = term
+            if self.term is not None:
+                self.__lease_until = started + self.lease_seconds - self.lease_margin
+            return self.term is not None
+
+    def __heartbeat(self):
+        while not self.__stopped.wait(self.lease_seconds / 3):
+            self.step()
+
+    def __accept(self):
+        while True:
+            try:
+                connection = self.__listener.accept()
+            except Exception:
+                if self.__stopped.is_set():
+                    return
+                continue  # a connection without the authkey
+            if self.__stopped.is_set():
+                connection.close()
+                return
+            Thread(target=self.__serve, args=(connection,), daemon=True).start()
+
+    def __serve(self, connection):
+        """
+        Applies calls forwarded by another node, answering each with (succeeded, (result, position) or exception)
+        """
+        with connection:
+            while True:
+                try:
+                    caller, call, method, argument = connection.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    if method not in methods:
+                        raise AttributeError("method '%s' cannot be forwarded" % method)
+                    with self.__lock:
+                        reply = True, self.__apply(caller, call, method, argument)
+                except Exception as e:
+                    reply = False, e
+                connection.send(reply)
+
+    def __apply(self, caller, call, method, argument):
+        """
+        Logs and applies a call as leader, or answers one applied before like the first time
+        :return: (result, position of the call)
+        """
+        if self.term is None:
+            raise NotLeader("%s is not the leader" % self.node)
+        try:
+            position, logged, published = self.store.append(self.term, method, argument, caller, call)
+        except NotLeader:
+            self.term = None
+            raise
+        if logged:
+            succeeded, result = self.replica.apply(position, caller, call, method, argument)
+            self.__unpublished += 1
+            if self.__unpublished >= self.snapshot_every:
+                self.__publish(position)
+        elif self.replica.outcomes.get(caller, (None,))[0] == call:
+            succeeded, result = self.replica.outcomes[caller][2:]
+        else:
+            succeeded, result = pickle.loads(published)  # replayed from a snapshot, which keeps no outcomes
+        if not succeeded:
+            raise result
+        return result, position
+
+    def __publish(self, position):
+        self.__unpublished = 0
+        outcomes = [(caller, call, pickle.dumps((succeeded, result)))
+                    for caller, (call, _, succeeded, result) in self.replica.outcomes.items()]
+        try:
+            self.store.publish(self.term, self.replica.api.data, position, outcomes)
+        except NotLeader:
+            self.term = None  # the call is logged all the same
+
+    def __forward(self, caller, call, method, argument):
+        with self.__forwarding:
+            leader = self.store.leader()
+            if leader is None or leader[0] == self.node:
+                raise NotLeader("no leader to forward to")
+            if self.__leader_connection is None or self.__leader_connection[0] != leader[1]:
+                if self.__leader_connection is not None:
+                    self.__leader_connection[1].close()
+                    self.__leader_connection = None
+                host, port = leader[1].rsplit(":", 1)
+                self.__leader_connection = leader[1], Client((host, int(port)), authkey=self.authkey)
+            try:
+                self.__leader_connection[1].send((caller, call, method, argument))
+                succeeded, reply = self.__leader_connection[1].recv()
+            except (EOFError, OSError):
+                self.__leader_connection[1].close()
+                self.__leader_connection = None
+                raise
+        if not succeeded:
+            raise reply
+        return reply
+
+    def __call(self, method, argument):
+        caller, call = "%s %d" % (self.__instance, get_ident()), next(self.__calls)
+        deadline = time.monotonic() + self.forward_timeout
+        while True:
+            with self.__lock:
+                if self.term is not None:
+                    try:
+                        return self.__apply(caller, call, method, argument)[0]
+                    except NotLeader:
+                        pass
+            try:
+                result, position = self.__forward(caller, call, method, argument)
+            except (NotLeader, EOFError, OSError):
+                if time.monotonic() >= deadline:
+                    raise NotLeader("no leader reached in %s s" % self.forward_timeout)
+                if not self.step():
+                    self.__stopped.wait(self.lease_seconds / 10)
+                continue
+            self.__written = max(self.__written, position)
+            return result
+
+    def new_offer(self, offer):
+        return self.__call("new_offer", offer)
+
+    def cancel_offer(self, offer):
+        return self.__call("cancel_offer", offer)
+
+    def new_request(self, request):
+        return self.__call("new_request", request)
+
+    def cancel_request(self, request):
+        return self.__call("cancel_request", request)
+
+    def __read(self, read):
+        with self.__lock:
+            if not self.is_leader() and (self.replica.position < self.__written or self.__caught_up is None or
+                                         time.monotonic() - self.__caught_up >= self.staleness):
+                self.replica.catch_up(self.store)
+                self.__caught_up = time.monotonic()
+            return read(self.replica.api)
+
+    def get_unmatched_offers(self):
+        return self.__read(lambda api: api.data.get_unmatched_offers())
+
+    def get_matched_offers(self):
+        return self.__read(lambda api: api.data.get_matched_offers())
+
+    def get_request_queue(self):
+        return self.__read(lambda api: api.data.get_request_queue())
+
+    def get_request_for_owner(self, owner, until=None):
+        return self.__read(lambda api: api.get_request_for_owner(owner, until))
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+from collections import namedtuple
+from datetime import datetime, timedelta
+import sqlite3
+
+from parkingmatcher.parkingmatcher import DBDataAccess, Offer, Period, Registry, Request, date_hour, \
+    hours_since_epoch
+
+Compaction = namedtuple("Compaction", ["unmatched_offers", "matched_offers", "requests"])  # numbers evicted
+
+
+class Archive:
+    schema = ["create table if not exists history (zone text, number text, ownername text, owneremail text, "
+              "timebegins text, timeends text, requestorname text, requestoremail text, zones text, "
+              "whenrequested text, unique (zone, number, timebegins))",
+              "create index if not exists history_end on history (timeends)"]
+    query_history = "select zone, number, ownername, owneremail, timebegins, timeends, requestorname, " \
+                    "requestoremail, zones, whenrequested from history"
+
+    time_format = DBDataAccess.time_format
+    when_requested_format = DBDataAccess.when_requested_format
+
+    def __init__(self, dbfile):
+        """
+        Cold store of matched offers that have ended, in an SQLite database of its own.
+        A spot's offers never overlap, so an offer is kept once per spot and beginning: archiving it again, as after
+        a crash between archiving and evicting, changes nothing.
+        :param dbfile: database file name, or ":memory:"
+        """
+        self.dbcon = sqlite3.connect(dbfile)
+        self.registry = Registry()
+        with self.dbcon:
+            for statement in self.schema:
+                self.dbcon.execute(statement)
+
+    def close(self):
+        self.dbcon.close()
+
+    def add(self, offers):
+        """
+        :param offers: matched offers
+        :return: number of offers not archived before
+        """
+        before = self.dbcon.total_changes
+        with self.dbcon:
+            self.dbcon.executemany("insert or ignore into history values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                   [(off.spot.zone, off.spot.place, off.spot.owner.name, off.spot.owner.email,
+                                     off.period.begin.strftime(self.time_format),
+                                     off.period.end.strftime(self.time_format),
+                                     off.matched_request().requestor.name, off.matched_request().requestor.email,
+                                     ",".join(off.matched_request().zones),
+                                     off.matched_request().when_requested.strftime(self.when_requested_format))
+                                    for off in offers])
+        return self.dbcon.total_changes - before
+
+    def count(self):
+        return self.dbcon.execute("select count(*) from history").fetchone()[0]
+
+    def get_history(self, since=None, until=None):
+        """
+        :param since: only offers ending after this time
+        :param until: only offers ending at or before this time
+        :return: archived matched offers, in order of ending
+        """
+        query, params = self.query_history + " where 1 = 1", []
+        if since:
+            query += " and timeends > ?"
+            params.append(since.strftime(self.time_format))
+        if until:
+            query += " and timeends <= ?"
+            params.append(until.strftime(self.time_format))
+        return [self.__offer(*row) for row in self.dbcon.execute(query + " order by timeends, rowid", params)]
+
+    def __offer(self, zone, number, owner_name, owner_email, begins, ends, name, email, zones, when_requested):
+        spot = self.registry.spot(zone, number, self.registry.user(owner_name, owner_email))
+        period = Period(begins, ends)
+        return Offer.matched_with(spot, Request.with_period(self.registry.user(name, email), period, zones.split(","),
+                                                            datetime.strptime(when_requested,
+                                                                              self.when_requested_format)))
+
+
+class Compactor:
+    def __init__(self, data, archive=None, horizon=timedelta(0), clock=datetime.now):
+        """
+        Evicts offers and requests that have ended, so the data only holds what can still be matched.
+        Unmatched offers and queued requests are dropped; matched offers are moved to the archive, if there is one.
+        :param data: data access to compact
+        :param archive: Archive for matched offers, dropped too if None
+        :param horizon: how long to keep offers and requests after they end
+        :param clock: returns the current time
+        """
+        self.data = data
+        self.archive = archive
+        self.horizon = horizon
+        self.clock = clock
+        self.__compacted_hour = None  # hour everything ending by it was evicted
+
+    def compact(self, now=None):
+        """
+        Evicts everything that ended by the hour `horizon` before `now`, the clock's time if not given.
+        Matched offers are archived before they are evicted, so a crash in between loses nothing.
+        :return: Compaction
+        """
+        hour = date_hour((now or self.clock()) - self.horizon)
+        cutoff = hour + timedelta(hours=1)
+        with self.data.transaction():
+            offers = self.data.get_offers_ending_before(cutoff)
+            matched = [off for off in offers if off.matched_request() is not None]
+            if self.archive is not None and matched:
+                self.archive.add(matched)
+            for offer in offers:
+                self.data.delete_offer(offer)
+            requests = self.data.get_request_queue(before=cutoff)
+            for request in requests:
+                self.data.delete_request_from_queue(request)
+        self.__compacted_hour = hours_since_epoch(hour)
+        return Compaction(len(offers) - len(matched), len(matched), len(requests))
+
+    def compact_if_due(self, now=None):
+        """
+        Compacts unless already done this hour: periods are whole hours, so nothing more ends until the next one
+        :return: Compaction, or None if not due
+        """
+        now = now or self.clock()
+        if self.__compacted_hour is not None and hours_since_epoch(now - self.horizon) <= self.__compacted_hour:
+            return None
+        return self.compact(now)
+
+
+class CompactingApi:
+    def __init__(self, api, compactor):
+        """
+        Api compacting its data on the first call of every hour, keeping it to offers and requests that have not
+        ended without a schedule of its own.
+        Not safe to call from many threads at once; with ConcurrentApi, compact under its `exclusive` instead.
+        """
+        self.api = api
+        self.data = api.data
+        self.compactor = compactor
+
+    def __call(self, method, argument):
+        self.compactor.compact_if_due()
+        return getattr(self.api, method)(argument)
+
+    def new_offer(self, offer):
+        return self.__call("new_offer", offer)
+
+    def cancel_offer(self, offer):
+        return self.__call("cancel_offer", offer)
+
+    def new_request(self, request):
+        return self.__call("new_request", request)
+
+    def cancel_request(self, request):
+        return self.__call("cancel_request", request)
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+from contextlib import contextmanager
+from threading import Lock, local
+
+from parkingmatcher.parkingmatcher import Api, Registry, parking_zones
+
+
+class MissingZones(Exception):
+    def __init__(self, zones):
+        """
+        Raised when a match needs locks of zones the calling thread does not hold
+        :param zones: zones to lock before trying again
+        """
+        super().__init__(zones)
+        self.zones = set(zones)
+
+
+class ConcurrentApi(Api):
+    def __init__(self, data, metrics=None):
+        """
+        Api that many threads can call at once.
+        Every zone has a lock guarding the requests queued for a spot there and the offers of its spots: gluing an
+        offer and matching it both read the zone's unmatched offers and queue, so a spot cannot be changed apart from
+        its zone. Calls lock the zones they touch in sorted order, so they never wait for each other in a cycle; calls
+        in different zones run in parallel. A call that finds it needs more zones, like an offer matching a request
+        that wants other zones too, starts again with those zones locked. Cancelling a matched request locks every
+        zone, as the offer it frees can match a request for any.
+        Reads lock the zones they read as well, so they never see the data access halfway through a change; read
+        through the methods here rather than the data access.
+        :param data: data access that can be called from many threads as long as they touch different zones, like
+        TestDataAccess
+        :param metrics: see Api
+        """
+        super().__init__(data, metrics)
+        self.__zone_locks = {zone: Lock() for zone in parking_zones}
+        self.__registry = Registry(data.users, data.spots)
+        self.__held = local()
+
+    def __held_zones(self):
+        """
+        :return: zones locked by the calling thread
+        """
+        if not hasattr(self.__held, "zones"):
+            self.__held.zones = set()
+        return self.__held.zones
+
+    @contextmanager
+    def __locked(self, zones):
+        """
+        Locks zones the calling thread does not hold yet, releasing them at the end of the block
+        """
+        held_zones = self.__held_zones()
+        zones = sorted(set(zones) - held_zones)
+        if zones and held_zones:
+            raise MissingZones(held_zones.union(zones))
+        acquired = []
+        try:
+            for zone in zones:
+                self.__zone_locks[zone].acquire()
+                held_zones.add(zone)
+                acquired.append(zone)
+            yield
+        finally:
+            for zone in reversed(acquired):
+                held_zones.discard(zone)
+                self.__zone_locks[zone].release()
+
+    @contextmanager
+    def exclusive(self):
+        """
+        Locks every zone, so nothing changes during the block; for reading the whole data access consistently
+        """
+        with self.__locked(parking_zones):
+            yield
+
+    def __check_zones(self, zones):
+        """
+        Raises MissingZones unless the calling thread holds locks of all `zones`
+        """
+        held_zones, zones = self.__held_zones(), set(zones)
+        if not held_zones.issuperset(zones):
+            raise MissingZones(held_zones.union(zones))
+
+    def _reserve(self, request, offer):
+        """
+        Checks that the zones of `request` are locked before it is matched
+        """
+        self.__check_zones(request.zones)
+
+    def __retrying(self, zones, method, argument):
+        """
+        Calls `method` with given zones locked, again with more zones locked as long as it finds it needs them.
+        Methods raise MissingZones before changing anything.
+        """
+        zones = set(zones)
+        while True:
+            try:
+                with self.__locked(zones):
+                    return method(argument)
+            except MissingZones as missing:
+                if self.__held_zones():
+                    raise  # zones can only be locked before any other
+                zones |= missing.zones
+
+    def new_offer(self, offer):
+        return self.__retrying([offer.spot.zone], super().new_offer, offer)
+
+    def new_request(self, request):
+        return self.__retrying(request.zones, super().new_request, request)
+
+    def cancel_offer(self, offer):
+        return self.__retrying([offer.spot.zone], self.__cancel_offer, offer)
+
+    def __cancel_offer(self, offer):
+        displaced = [off.matched_request() for off in
+                     self.data.get_offers_for_spot(offer.spot, offer.period.begin, offer.period.end)
+                     if off.matched_request()]
+        self.__check_zones(zone for req in displaced for zone in req.zones)
+        return super().cancel_offer(offer)
+
+    def cancel_request(self, request):
+        return self.__retrying(request.zones, self.__cancel_request, request)
+
+    def __cancel_request(self, request):
+        if not self.data.is_queued(request) and self.data.get_offers_matched_with(request):
+            self.__check_zones(parking_zones)  # freed offers can match requests for any zone
+        return super().cancel_request(request)
+
+    @contextmanager
+    def deferred_matching(self):
+        """
+        Runs the block with every zone locked. Matching is not deferred: cancellations match again right away.
+        """
+        with self.exclusive():
+            yield
+
+    def bulk_load(self, offers, requests):
+        with self.__locked(parking_zones):
+            return super().bulk_load(offers, requests)
+
+    def batch_match(self, by_when_requested=False, apply=True):
+        with self.__locked(parking_zones):
+            return super().batch_match(by_when_requested, apply)
+
+    def get_request_for_owner(self, owner, until=None):
+        with self.__locked(self.__registry.zones_of(owner)):
+            return super().get_request_for_owner(owner, until)
+
+    def get_unmatched_offers(self):
+        with self.__locked(parking_zones):
+            return self.data.get_unmatched_offers()
+
+    def get_matched_offers(self):
+        with self.__locked(parking_zones):
+            return self.data.get_matched_offers()
+
+    def get_request_queue(self, user=None, before=None):
+        with self.__locked(self.__registry.zones_of(user) if user else parking_zones):
+            return self.data.get_request_queue(user, before)
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime
+from itertools import islice
+import json
+import time
+
+from parkingmatcher.parkingmatcher import Offer, Period, Registry, Request
+
+
+class IngestReport:
+    def __init__(self, max_rejects=100):
+        """
+        Counts of an ingestion
+        :param max_rejects: most rejects kept with their reasons; all are counted
+        """
+        self.records = 0
+        self.applied = 0
+        self.rejected = 0
+        self.rejects = []  # (line number, reason) of the first `max_rejects` rejects
+        self.batches = 0
+        self.seconds = 0.0
+        self.max_rejects = max_rejects
+
+    def reject(self, line_number, reason):
+        self.rejected += 1
+        if len(self.rejects) < self.max_rejects:
+            self.rejects.append((line_number, reason))
+
+    @property
+    def records_per_sec(self):
+        return self.records / self.seconds if self.seconds else 0.0
+
+    def __repr__(self):
+        return "{0} records, {1} applied, {2} rejected in {3:.2f} s ({4:.0f} records/s)".format(
+            self.records, self.applied, self.rejected, self.seconds, self.records_per_sec)
+
+
+class RecordParser:
+    def __init__(self, users, spots):
+        """
+        Turns feed records into Api calls.
+        An offer record names a known spot: {"type": "offer", "zone": "etap1", "place": "12",
+        "begins": "2018-01-02T08", "ends": "2018-01-02T16"}.
+        A request record names its requestor: {"type": "request", "name": "Jan", "email": "jan@lp.pl",
+        "zones": "etap1,etap2", "begins": ..., "ends": ..., "when_requested": "2018-01-01T12:30:00"}, zones being
+        a list or comma-delimited, when_requested optional and taken as local time if it has a time zone.
+        Either may have "cancel": true to cancel the offer or request instead.
+        :param users: known users, shared by requests made by them
+        :param spots: known spots, the only ones offers are accepted for
+        """
+        self.registry = Registry(users, spots)
+
+    def __call__(self, record):
+        """
+        :return: (Api method name, argument)
+        :raise ValueError: if the record is not a valid offer or request
+        """
+        if not isinstance(record, dict):
+            raise ValueError("not an object")
+        kind = record.get("type")
+        try:
+            period = Period(record["begins"], record["ends"])
+            if kind == "offer":
+                spot = self.registry.get_spot(record["zone"], record["place"])
+                if spot is None:
+                    raise ValueError("unknown spot %s/%s" % (record["zone"], record["place"]))
+                return ("cancel_offer" if record.get("cancel") else "new_offer"), Offer.unmatched(spot, period)
+            if kind == "request":
+                user = self.registry.user(record.get("name", record["email"]), record["email"])
+                when = datetime.fromisoformat(record["when_requested"]) if "when_requested" in record \
+                    else datetime.now()
+                if when.tzinfo is not None:
+                    when = when.astimezone().replace(tzinfo=None)  # local time, like the times of other requests
+                request = Request(user, period.begin, period.end, record["zones"], when)
+                if not request.zones:
+                    raise ValueError("no known zones in %r" % record["zones"])
+                return ("cancel_request" if record.get("cancel") else "new_request"), request
+        except KeyError as e:
+            raise ValueError("missing %s" % e)
+        except (AttributeError, TypeError) as e:
+            raise ValueError(str(e))
+        raise ValueError("unknown type %r" % kind)
+
+
+def read_jsonl(lines):
+    """
+    Yields (line number, record or None, error or None) for each non-blank line, reading them one at a time
+    """
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            yield number, json.loads(line), None
+        except ValueError as e:
+            yield number, None, "invalid JSON: %s" % e
+
+
+def ingest(lines, api, batch_size=500, on_batch=None, max_rejects=100):
+    """
+    Feeds offers and requests from a JSONL feed to the Api.
+    Lines are read only as batches are applied, at most `batch_size` at a time, so memory does not grow with the feed
+    and a slow Api slows down reading instead of piling up records. Each batch is applied in one transaction and each
+    record in a nested one, so a rejected record leaves nothing behind.
+    Records that are not valid, or that the Api fails on, are counted as rejected and skipped.
+    :param lines: iterable of lines, like an open file
+    :param api: Api, or anything with the same methods and a `data` attribute
+    :param on_batch: called with the report after every batch, to show progress
+    :return: IngestReport
+    """
+    if batch_size < 1:
+        raise AttributeError("batch_size must be positive")
+    parse = RecordParser(api.data.users, api.data.spots)
+    report = IngestReport(max_rejects)
+    started = time.perf_counter()
+    records = read_jsonl(lines)
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            break
+        calls = []
+        for number, record, error in batch:
+            report.records += 1
+            if error is None:
+                try:
+                    calls.append((number,) + parse(record))
+                except ValueError as e:
+                    error = str(e)
+            if error is not None:
+                report.reject(number, error)
+        with api.data.transaction():
+            for number, method, argument in calls:
+                try:
+                    with api.data.transaction():  # nested, so a rejected record leaves nothing behind
+                        getattr(api, method)(argument)
+                except Exception as e:
+                    report.reject(number, "%s: %s" % (method, e))
+                else:
+                    report.applied += 1
+        report.batches += 1
+        report.seconds = time.perf_counter() - started
+        if on_batch is not None:
+            on_batch(report)
+    report.seconds = time.perf_counter() - started
+    return report
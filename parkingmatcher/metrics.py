@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock
+import time
+
+
+class Metrics:
+    def __init__(self, prefix="parkingmatcher"):
+        """
+        Call timings and item counts, exportable in Prometheus text format
+        :param prefix: prefix of the exported metric names
+        """
+        self.prefix = prefix
+        self.calls = {}  # (layer, call) -> [number of calls, seconds spent]
+        self.items = {}  # item -> count
+        self.__lock = Lock()
+
+    @contextmanager
+    def timed(self, layer, call):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self.__lock:
+                timing = self.calls.setdefault((layer, call), [0, 0.0])
+                timing[0] += 1
+                timing[1] += elapsed
+
+    def count(self, item, amount=1):
+        with self.__lock:
+            self.items[item] = self.items.get(item, 0) + amount
+
+    def prometheus(self):
+        with self.__lock:
+            calls = sorted(self.calls.items())
+            items = sorted(self.items.items())
+        lines = ["# HELP {0}_call_seconds Time spent in Api methods and data-access calls".format(self.prefix),
+                 "# TYPE {0}_call_seconds summary".format(self.prefix)]
+        for (layer, call), (number, seconds) in calls:
+            labels = '{{layer="{0}",call="{1}"}}'.format(layer, call)
+            lines.append("{0}_call_seconds_count{1} {2}".format(self.prefix, labels, number))
+            lines.append("{0}_call_seconds_sum{1} {2!r}".format(self.prefix, labels, seconds))
+        lines += ["# HELP {0}_items_total Items scanned and matched".format(self.prefix),
+                  "# TYPE {0}_items_total counter".format(self.prefix)]
+        for item, number in items:
+            lines.append('{0}_items_total{{item="{1}"}} {2}'.format(self.prefix, item, number))
+        return "\n".join(lines) + "\n"
+
+
+class NoMetrics:
+    """
+    Stands in for Metrics when they are not collected, doing nothing
+    """
+    @contextmanager
+    def timed(self, layer, call):
+        yield
+
+    def count(self, item, amount=1):
+        pass
+
+
+no_metrics = NoMetrics()
+
+
+def timed(method):
+    """
+    Times a method of an object that has `metrics`
+    """
+    @wraps(method)
+    def timed_method(self, *args, **kwargs):
+        with self.metrics.timed("api", method.__name__):
+            return method(self, *args, **kwargs)
+    return timed_method
+
+
+class InstrumentedDataAccess:
+    untimed = {"transaction"}
+
+    def __init__(self, data, metrics):
+        """
+        Data access passing every call through to `data`, timing it and counting the items it returns
+        """
+        self.data = data
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        attribute = getattr(self.data, name)
+        if name.startswith("_") or name in self.untimed or not callable(attribute):
+            return attribute
+
+        @wraps(attribute)
+        def instrumented(*args, **kwargs):
+            with self.metrics.timed("data", name):
+                result = attribute(*args, **kwargs)
+            if isinstance(result, list):
+                self.metrics.count(name + "_returned", len(result))
+            return result
+        setattr(self, name, instrumented)
+        return instrumented
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+
+from datetime import timedelta
+import os
+import struct
+from threading import Lock
+from zlib import crc32
+
+from parkingmatcher.parkingmatcher import Api, Offer, Period, Registry, Request, TestDataAccess, epoch
+from parkingmatcher.snapshot import load_snapshot, save_snapshot
+
+methods = ["new_offer", "cancel_offer", "new_request", "cancel_request"]  # numbered from 1 in records
+record_header = struct.Struct("<IB")  # size of the method number and payload, method number
+record_trailer = struct.Struct("<I")  # CRC32 of the method number and payload
+text_size = struct.Struct("<I")
+offer_hours = struct.Struct("<qq")
+request_times = struct.Struct("<qqq")
+microsecond = timedelta(microseconds=1)
+
+
+def encode_text(text):
+    encoded = text.encode("utf-8")
+    return text_size.pack(len(encoded)) + encoded
+
+
+def encode_call(method, argument):
+    """
+    :return: log record of an Api call
+    """
+    body = encode_body(method, argument)
+    return record_header.pack(len(body), body[0]) + body[1:] + record_trailer.pack(crc32(body))
+
+
+def encode_body(method, argument):
+    """
+    :return: method number and payload of an Api call, as read back by Decoder
+    """
+    if method not in methods:
+        raise AttributeError("method '%s' is not logged" % method)
+    if method.endswith("offer"):
+        spot = argument.spot
+        payload = b"".join([encode_text(spot.zone), encode_text(spot.place), encode_text(spot.owner.name),
+                            encode_text(spot.owner.email),
+                            offer_hours.pack(argument.period.begin_hour, argument.period.end_hour)])
+    else:
+        payload = b"".join([encode_text(argument.requestor.name), encode_text(argument.requestor.email),
+                            encode_text(",".join(argument.zones)),
+                            request_times.pack(argument.period.begin_hour, argument.period.end_hour,
+                                               (argument.when_requested - epoch) // microsecond)])
+    return bytes([methods.index(method) + 1]) + payload
+
+
+class Decoder:
+    def __init__(self, users=(), spots=()):
+        """
+        Turns log records back into Api calls, sharing one object per user and spot
+        """
+        self.registry = Registry(users, spots)
+
+    def __call__(self, body):
+        """
+        :param body: method number and payload of a record
+        :return: (method, argument)
+        """
+        method = methods[body[0] - 1]
+        texts, position = [], 1
+        for _ in range(4 if method.endswith("offer") else 3):
+            size, = text_size.unpack_from(body, position)
+            position += text_size.size
+            texts.append(bytes(body[position:position + size]).decode("utf-8"))
+            position += size
+        if method.endswith("offer"):
+            zone, place, name, email = texts
+            begin, end = offer_hours.unpack_from(body, position)
+            return method, Offer.unmatched(self.registry.spot(zone, place, self.registry.user(name, email)),
+                                           Period.from_hours(begin, end))
+        name, email, zones = texts
+        begin, end, when = request_times.unpack_from(body, position)
+        return method, Request.with_period(self.registry.user(name, email), Period.from_hours(begin, end),
+                                           zones.split(",") if zones else [], epoch + when * microsecond)
+
+
+def read_records(path, start=0):
+    """
+    Yields (end position, method number and payload) of records from `start` on, stopping at the end of the file or
+    at a last record cut short or damaged by a crash while it was written
+    :raise ValueError: if a damaged record is followed by anything but zero bytes never written
+    """
+    with open(path, "rb") as log:
+        log.seek(start)
+        position = start
+        while True:
+            header = log.read(record_header.size)
+            if not header:
+                return
+            size = record_header.unpack(header)[0] if len(header) == record_header.size else 0
+            body = header[4:] + log.read(size - 1) if size > 0 else b""
+            trailer = log.read(record_trailer.size) if size > 0 else b""
+            if size < 1 or len(body) < size or len(trailer) < record_trailer.size or \
+                    record_trailer.unpack(trailer)[0] != crc32(body):
+                if log.read().strip(b"\0"):
+                    raise ValueError("damaged record at %d of '%s'" % (position, path))
+                return
+            position += record_header.size - 1 + size + record_trailer.size
+            yield position, body
+
+
+class OperationLog:
+    def __init__(self, path, batch_size=100):
+        """
+        Append-only log of Api calls.
+        Records are buffered and written with one fsync for the whole batch: by whichever caller of `sync` comes
+        first, while the others wait for it instead of syncing on their own (group commit).
+        A record cut short by a crash is cut off the end when the log is opened again.
+        Positions in the log are byte offsets.
+        :param batch_size: records that may wait for a sync when callers do not wait for one
+        """
+        self.path = path
+        self.batch_size = batch_size
+        end = 0
+        if os.path.exists(path):
+            for end, _ in read_records(path):
+                pass
+        self.__file = open(path, "ab")
+        self.__file.truncate(end)
+        self.__buffer = []
+        self.__end = end  # position after the last record appended
+        self.__synced = end  # position after the last record synced
+        self.__lock = Lock()
+        self.__sync_lock = Lock()
+        self.syncs = 0
+
+    @property
+    def position(self):
+        return self.__end
+
+    def unsynced(self):
+        return len(self.__buffer)
+
+    def append(self, method, argument):
+        """
+        :return: log position after the record
+        """
+        record = encode_call(method, argument)
+        with self.__lock:
+            self.__buffer.append(record)
+            self.__end += len(record)
+            return self.__end
+
+    def sync(self, position=None):
+        """
+        Makes records up to `position`, or all of them, durable
+        """
+        with self.__sync_lock:
+            if position is not None and self.__synced >= position:
+                return  # synced along with others while waiting
+            with self.__lock:
+                records, self.__buffer = self.__buffer, []
+                end = self.__end
+            if records:
+                self.__file.write(b"".join(records))
+                self.__file.flush()
+                os.fsync(self.__file.fileno())
+                self.syncs += 1
+            self.__synced = end
+
+    def close(self):
+        self.sync()
+        self.__file.close()
+
+    def replay(self, api, start=0):
+        """
+        Runs logged calls from `start` on through the Api. Only calls that succeeded are logged, so any call failing
+        now fails the replay.
+        :return: log position after the last record replayed
+        """
+        decode = Decoder(api.data.users, api.data.spots)
+        position = start
+        for position, body in read_records(self.path, start):
+            method, argument = decode(body)
+            getattr(api, method)(argument)
+        return position
+
+
+class LoggedApi:
+    def __init__(self, api, log, durable=True):
+        """
+        Api logging every change it made.
+        Calls are applied and logged one at a time, so the log replays them in the order they happened; a call that
+        fails is not logged. Syncing the log happens outside of that, so threads calling at once share syncs.
+        :param durable: return from calls only once they are synced; otherwise the log is synced every
+        `log.batch_size` calls, losing at most that many on a crash
+        """
+        self.api = api
+        self.data = api.data
+        self.log = log
+        self.durable = durable
+        self.__order = Lock()
+
+    def __call(self, method, argument):
+        with self.__order:
+            result = getattr(self.api, method)(argument)
+            position = self.log.append(method, argument)
+        if self.durable or self.log.unsynced() >= self.log.batch_size:
+            self.log.sync(position)
+        return result
+
+    def new_offer(self, offer):
+        return self.__call("new_offer", offer)
+
+    def cancel_offer(self, offer):
+        return self.__call("cancel_offer", offer)
+
+    def new_request(self, request):
+        return self.__call("new_request", request)
+
+    def cancel_request(self, request):
+        return self.__call("cancel_request", request)
+
+    def checkpoint(self, snapshot_path):
+        """
+        Saves a snapshot of the data together with the log position it is at, so recovery only replays what follows
+        """
+        with self.__order:
+            self.log.sync()
+            save_snapshot(self.data, snapshot_path, self.log.position)
+
+
+def recover(snapshot_path, log, users=(), spots=(), data_access=TestDataAccess):
+    """
+    Loads the latest snapshot, or starts from no data, then replays the log tail after it
+    :param users: users to start from when there is no snapshot
+    :param spots: spots to start from when there is no snapshot
+    :return: Api over the recovered data
+    """
+    if os.path.exists(snapshot_path):
+        data, position = load_snapshot(snapshot_path, data_access)
+    else:
+        data, position = data_access(users, spots), 0
+    api = Api(data)
+    log.replay(api, position)
+    return api
@@ -1,23 +1,65 @@
 # -*- coding: utf-8 -*-
 
+from bisect import bisect_left, insort
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from functools import lru_cache
+from itertools import count
+import re
 import sqlite3
 
+from parkingmatcher.batchmatch import BatchMatcher
+from parkingmatcher.metrics import InstrumentedDataAccess, no_metrics, timed
+from parkingmatcher.periodindex import PeriodIndex
+
 parking_zones = {"etap1": "I Etap",
                  "etap2": "II Etap",
                  "outside": "na zewnątrz"}
 
 datehour_format = "%Y-%m-%dT%H"
+epoch = datetime(1970, 1, 1)
+object_ids = count(1)  # ids of offers and requests
+
+
+datehour_pattern = re.compile(r"\d{4}-\d\d-\d\dT\d\d$", re.ASCII)
 
 
 def date_hour(source):
     if isinstance(source, datetime):
         return datetime(source.year, source.month, source.day, source.hour)
     else:
-        return datetime.strptime(source.strip()[:13], datehour_format)
+        return parse_date_hour(source.strip()[:13])
+
+
+@lru_cache(maxsize=4096)
+def parse_date_hour(text):
+    """
+    Reads `datehour_format` by slicing, leaving anything else (and invalid dates) to strptime for the same errors
+    """
+    if datehour_pattern.match(text):
+        try:
+            return datetime(int(text[0:4]), int(text[5:7]), int(text[8:10]), int(text[11:13]))
+        except ValueError:
+            pass
+    return datetime.strptime(text, datehour_format)
+
+
+def hours_since_epoch(moment, round_up=False):
+    return -((epoch - moment) // timedelta(hours=1)) if round_up else (moment - epoch) // timedelta(hours=1)
+
+
+def number_objects_from(first):
+    """
+    Makes ids of offers and requests created from now on start at `first`, so processes exchanging them can keep
+    their ids apart
+    """
+    global object_ids
+    object_ids = count(first)
 
 
 class User:
+    __slots__ = ("name", "email")
+
     def __init__(self, name, email):
         """
         A user
@@ -32,12 +74,19 @@ class User:
         return "{0} <{1}>".format(self.name, self.email)
 
     def __eq__(self, other):
+        if self is other:
+            return True
         if other is None or not isinstance(other, User):
             return False
         return self.email == other.email
 
+    def __hash__(self):
+        return hash(self.email)
+
 
 class Spot:
+    __slots__ = ("zone", "place", "owner")
+
     def __init__(self, zone, place, owner):
         """
         A parking spot
@@ -57,17 +106,44 @@ class Spot:
         return "{1} m. {0} nal. do {2}".format(self.place, parking_zones[self.zone], self.owner.name)
 
     def __eq__(self, other):
+        if self is other:
+            return True
         if other is None or not isinstance(other, Spot):
             return False
         return self.place == other.place and self.zone == other.zone
 
+    def __hash__(self):
+        return hash((self.zone, self.place))
+
 
 class Period:
+    __slots__ = ("begin_hour", "end_hour")
+
     def __init__(self, begins, ends):
-        time1 = date_hour(begins)
-        time2 = date_hour(ends)
-        self.begin = time1 if time1 < time2 else time2
-        self.end = time2 if time1 < time2 else time1
+        """
+        A period of whole hours, stored as hours since `epoch`
+        :param begins: one end of the period (passed as a DateTime object or ISO8601 string)...
+        :param ends: ...and the other one, in any order
+        """
+        hour1 = hours_since_epoch(date_hour(begins))
+        hour2 = hours_since_epoch(date_hour(ends))
+        self.begin_hour = hour1 if hour1 < hour2 else hour2
+        self.end_hour = hour2 if hour1 < hour2 else hour1
+
+    @classmethod
+    def from_hours(cls, begin_hour, end_hour):
+        period = cls.__new__(cls)
+        period.begin_hour = begin_hour
+        period.end_hour = end_hour
+        return period
+
+    @property
+    def begin(self):
+        return epoch + timedelta(hours=self.begin_hour)
+
+    @property
+    def end(self):
+        return epoch + timedelta(hours=self.end_hour)
 
     def __repr__(self):
         return "<{0} - {1}>".format(self.begin.strftime(datehour_format), self.end.strftime(datehour_format))
@@ -75,36 +151,41 @@ class Period:
     def __eq__(self, other):
         if other is None or not isinstance(other, Period):
             return False
-        return self.begin == other.begin and self.end == other.end
+        return self.begin_hour == other.begin_hour and self.end_hour == other.end_hour
+
+    def __hash__(self):
+        return hash((self.begin_hour, self.end_hour))
 
     def length(self):
-        return abs(self.end - self.begin).total_seconds() / 3600
+        return float(self.end_hour - self.begin_hour)
 
     def contains(self, other):
-        return other.begin >= self.begin and other.end <= self.end
+        return other.begin_hour >= self.begin_hour and other.end_hour <= self.end_hour
 
     def intersects(self, other):
-        return other.end > self.begin and other.begin < self.end
+        return other.end_hour > self.begin_hour and other.begin_hour < self.end_hour
 
     def adjacent(self, other):
-        return self.end == other.begin or self.begin == other.end
+        return self.end_hour == other.begin_hour or self.begin_hour == other.end_hour
 
     def gluable(self, other):
         return self.adjacent(other) or self.intersects(other)
 
     def intersection(self, other):
-        return None if other.end <= self.begin or other.begin >= self.end else Period(max(self.begin, other.begin),
-                                                                                      min(self.end, other.end))
+        return None if other.end_hour <= self.begin_hour or other.begin_hour >= self.end_hour \
+            else Period.from_hours(max(self.begin_hour, other.begin_hour), min(self.end_hour, other.end_hour))
 
     def before(self, other):
-        return None if other.begin <= self.begin else Period(self.begin, min(self.end, other.begin))
+        return None if other.begin_hour <= self.begin_hour \
+            else Period.from_hours(self.begin_hour, min(self.end_hour, other.begin_hour))
 
     def after(self, other):
-        return None if other.end >= self.end else Period(max(other.end, self.begin), self.end)
+        return None if other.end_hour >= self.end_hour \
+            else Period.from_hours(max(other.end_hour, self.begin_hour), self.end_hour)
 
     def glue(self, other):
         if self.gluable(other):
-            return Period(min(self.begin, other.begin), max(self.end, other.end))
+            return Period.from_hours(min(self.begin_hour, other.begin_hour), max(self.end_hour, other.end_hour))
 
 
 class Offer:
@@ -119,6 +200,7 @@ class Offer:
         """
         if not isinstance(spot, Spot):
             raise AttributeError("spot is not of type Spot")
+        self.id = next(object_ids)
         self.spot = spot
         self.period = period
         self.__match = matching_request
@@ -143,6 +225,9 @@ class Offer:
             return False
         return self.spot == other.spot and self.period == other.period and self.__match == other.__match
 
+    def __hash__(self):
+        return hash((self.spot, self.period, self.__match))
+
     def matched_request(self):
         return self.__match
 
@@ -159,6 +244,7 @@ class Request:
         """
         if not isinstance(requestor, User):
             raise AttributeError("requestor is not of type User")
+        self.id = next(object_ids)
         self.requestor = requestor
         self.period = Period(time_begins, time_ends)
         self.zones = list(filter(lambda z: z in parking_zones,
@@ -166,6 +252,21 @@ class Request:
                                      in_zones if isinstance(in_zones, list) else in_zones.split(","))))
         self.when_requested = when_requested
 
+    @classmethod
+    def with_period(cls, requestor, period, zones, when_requested):
+        """
+        A request made of already checked parts, as stored ones are
+        :param period: Period
+        :param zones: list of zone ids
+        """
+        request = cls.__new__(cls)
+        request.id = next(object_ids)
+        request.requestor = requestor
+        request.period = period
+        request.zones = zones
+        request.when_requested = when_requested
+        return request
+
     def matches(self, offer):
         return offer.spot.zone in self.zones and offer.period.contains(self.period)
 
@@ -174,6 +275,9 @@ class Request:
             return False
         return self.requestor == other.requestor and self.period == other.period and self.zones == other.zones
 
+    def __hash__(self):
+        return hash((self.requestor, self.period, tuple(self.zones)))
+
     def __repr__(self):
         return "{0} szuka miejsca w {1} od {2} do {3}".format(self.requestor.name,
                                                               ", ".join(self.zones),
@@ -181,77 +285,506 @@ class Request:
                                                               self.period.end.strftime("%d.%m.%Y g. %H"))
 
 
-class TestDataAccess:
-    __offers = []
-    __request_queue = []
+def spot_key(spot):
+    return spot.zone, spot.place
+
 
+class Registry:
+    def __init__(self, users=(), spots=()):
+        """
+        Keeps a single object per user, by email, and per spot, by zone and place, so users and spots made from stored
+        data are shared instead of built over and over, and compare by identity
+        :param users: users to start with
+        :param spots: spots to start with; their owners are added to the users
+        """
+        self.__users = {}  # email -> user
+        self.__spots = {}  # spot_key -> spot
+        self.__owned = {}  # owner email -> spots, in order of adding
+        for user in users:
+            self.add_user(user)
+        for spot in spots:
+            self.add_spot(spot)
+
+    def add_user(self, user):
+        """
+        :return: the user registered with the same email, `user` itself if there was none
+        """
+        return self.__users.setdefault(user.email, user)
+
+    def add_spot(self, spot):
+        """
+        :return: the spot registered at the same zone and place, `spot` itself if there was none
+        """
+        registered = self.__spots.get(spot_key(spot))
+        if registered is None:
+            self.add_user(spot.owner)
+            registered = self.__spots[spot_key(spot)] = spot
+            self.__owned.setdefault(spot.owner.email, []).append(spot)
+        return registered
+
+    def user(self, name, email):
+        """
+        :return: the user registered with the email, registering a new one if there was none
+        """
+        user = self.__users.get(email)
+        return user if user is not None else self.add_user(User(name, email))
+
+    def spot(self, zone, place, owner):
+        """
+        :return: the spot registered at the zone and place, registering a new one if there was none
+        """
+        spot = self.__spots.get((zone, str(place)))
+        return spot if spot is not None else self.add_spot(Spot(zone, place, self.add_user(owner)))
+
+    def get_user(self, email):
+        return self.__users.get(email)
+
+    def get_spot(self, zone, place):
+        return self.__spots.get((zone, str(place)))
+
+    def spots_of(self, owner):
+        return list(self.__owned.get(owner.email, ()))
+
+    def zones_of(self, owner):
+        return {spot.zone for spot in self.__owned.get(owner.email, ())}
+
+
+class TestDataAccess:
     def __init__(self, init_users, init_spots):
         self.users = init_users
         self.spots = init_spots
+        self.registry = Registry(init_users, init_spots)
+        self.clear()
 
     def clear(self):
-        self.__offers = []
-        self.__request_queue = []
+        self.__offers = {}  # id -> offer, in order of adding
+        self.__offer_ids = {}  # offer -> ids of the stored offers equal to it, in order of adding
+        self.__matched_offer_ids = {}  # request -> ids of offers matched with it
+        self.__spot_offers = {}  # spot_key -> PeriodIndex of the spot's offers
+        self.__zone_unmatched = {}  # zone -> PeriodIndex of unmatched offers, all numbered in order of adding
+        self.__unmatched_sequence = count()
+        self.__request_queue = {}  # id -> request, in order of adding
+        self.__request_ids = {}  # request -> ids of the queued requests equal to it, in order of adding
+        self.__zone_requests = {}  # zone -> PeriodIndex of queued requests wanting a spot there
+        self.__zone_requests_by_end = {}  # zone -> sorted (end hour, queue position, request id) of queued requests
+        self.__queue_positions = {}  # request id -> queue position
+        self.__queue_position = count()
+
+    @contextmanager
+    def transaction(self):
+        yield
 
     def get_request_queue(self, user=None, before=None):
-        zones = {spot.zone for spot in filter(lambda s: s.owner == user, self.spots)} if user else None
-        return [req for req in filter(lambda r: r.period.end < before if before else True, self.__request_queue)
-                if zones is None or zones & set(req.zones)]
+        before_hour = hours_since_epoch(before, round_up=True) if before else None
+        if not user:
+            return [req for req in self.__request_queue.values()
+                    if before_hour is None or req.period.end_hour < before_hour]
+        found = {}
+        for zone in self.registry.zones_of(user):
+            by_end = self.__zone_requests_by_end.get(zone, [])
+            for _, position, request_id in by_end[:bisect_left(by_end, (before_hour,))] if before_hour else by_end:
+                found[position] = request_id
+        return [self.__request_queue[found[position]] for position in sorted(found)]
+
+    def is_queued(self, request):
+        return request in self.__request_ids
+
+    def get_first_matching_request(self, offer):
+        index = self.__zone_requests.get(offer.spot.zone)
+        return None if index is None else index.first_within(offer.period)
 
     def get_matched_requests(self):
-        return [off.matched_request() for off in self.__offers if off.matched_request()]
+        return [off.matched_request() for off in self.__offers.values() if off.matched_request()]
+
+    def get_offers(self):
+        return list(self.__offers.values())
 
     def get_unmatched_offers(self):
-        return list(filter(lambda o: o.matched_request() is None, self.__offers))
+        return list(filter(lambda o: o.matched_request() is None, self.__offers.values()))
 
     def get_matched_offers(self):
-        return list(filter(lambda o: o.matched_request(), self.__offers))
+        return list(filter(lambda o: o.matched_request(), self.__offers.values()))
+
+    def get_offers_matched_with(self, request):
+        return [self.__offers[offer_id] for offer_id in self.__matched_offer_ids.get(request, ())]
 
     def get_offers_for_spot(self, spot, since=None, until=None):
-        return sorted(filter(lambda off: off.spot == spot
-                             and (off.period.begin == since if since else True)
-                             and (off.period.end == until if until else True),
-                             self.__offers),
-                      key=lambda off: off.period.begin)
+        index = self.__spot_offers.get(spot_key(spot))
+        if index is None:
+            return []
+        if since:
+            since_hour = hours_since_epoch(date_hour(since))
+            offers = [off for off, _ in index.starting_between(since_hour, since_hour)]
+        else:
+            offers = list(index)
+        if until:
+            until_hour = hours_since_epoch(date_hour(until))
+            offers = [off for off in offers if off.period.end_hour == until_hour]
+        return offers
+
+    def get_shortest_matching_offer(self, request):
+        found = [index.shortest_containing(request.period)
+                 for index in map(self.__zone_unmatched.get, set(request.zones)) if index is not None]
+        found = [f for f in found if f is not None]
+        return min(found, key=lambda f: f[1])[0] if found else None
+
+    def get_offers_touching(self, spot, period):
+        index = self.__spot_offers.get(spot_key(spot))
+        return [] if index is None else index.touching(period)
+
+    def get_offers_ending_before(self, before):
+        before_hour = hours_since_epoch(before, round_up=True)
+        return [off for off in self.__offers.values() if off.period.end_hour < before_hour]
 
     def add_offer(self, offer):
-        self.__offers.append(offer)
+        self.__offers[offer.id] = offer
+        self.__offer_ids.setdefault(offer, {})[offer.id] = None
+        self.__spot_offers.setdefault(spot_key(offer.spot), PeriodIndex()).add(offer, offer.period)
+        if offer.matched_request() is None:
+            self.__zone_unmatched.setdefault(offer.spot.zone, PeriodIndex(self.__unmatched_sequence)) \
+                .add(offer, offer.period)
+        else:
+            self.__matched_offer_ids.setdefault(offer.matched_request(), {})[offer.id] = None
 
     def delete_offer(self, offer):
-        if offer in self.__offers:
-            self.__offers.remove(offer)
+        stored = self.__pop_first(self.__offers, self.__offer_ids, offer)
+        if stored is not None:
+            self.__spot_offers[spot_key(stored.spot)].remove(stored, stored.period)
+            if stored.matched_request() is None:
+                self.__zone_unmatched[stored.spot.zone].remove(stored, stored.period)
+            else:
+                matched_ids = self.__matched_offer_ids[stored.matched_request()]
+                del matched_ids[stored.id]
+                if not matched_ids:
+                    del self.__matched_offer_ids[stored.matched_request()]
 
     def add_request(self, request):
-        self.__request_queue.append(request)
+        self.__request_queue[request.id] = request
+        self.__request_ids.setdefault(request, {})[request.id] = None
+        position = self.__queue_positions[request.id] = next(self.__queue_position)
+        for zone in set(request.zones):
+            self.__zone_requests.setdefault(zone, PeriodIndex(key=lambda req: req.when_requested)) \
+                .add(request, request.period)
+            insort(self.__zone_requests_by_end.setdefault(zone, []), (request.period.end_hour, position, request.id))
 
     def delete_request_from_queue(self, request):
-        if request in self.__request_queue:
-            self.__request_queue.remove(request)
+        stored = self.__pop_first(self.__request_queue, self.__request_ids, request)
+        if stored is not None:
+            position = self.__queue_positions.pop(stored.id)
+            for zone in set(stored.zones):
+                self.__zone_requests[zone].remove(stored, stored.period)
+                by_end = self.__zone_requests_by_end[zone]
+                del by_end[bisect_left(by_end, (stored.period.end_hour, position))]
+
+    @staticmethod
+    def __pop_first(by_id, ids_by_value, value):
+        """
+        Removes the earliest added of the objects equal to `value`
+        :param by_id: id -> object
+        :param ids_by_value: object -> ids of objects equal to it
+        :return: the removed object, or None if there was none
+        """
+        ids = ids_by_value.get(value)
+        if not ids:
+            return None
+        first = next(iter(ids))
+        del ids[first]
+        if not ids:
+            del ids_by_value[value]
+        return by_id.pop(first)
 
 
 class DBDataAccess:
-    query_users = "select * from user"
-    query_spots = "select rowid, * from spot"
-    query_requests = "select rowid, * from request"
-    query_offers = "select rowid, * from offer"
-    query_offers_with_data = "select o.timebegins, o.timeends, s.zone, s.number, u.name, u.email from offer o " \
+    schema = ["create table if not exists user (email text primary key, name text)",
+              "create table if not exists spot (zone text, number text, owneremail text, unique (zone, number))",
+              "create table if not exists request (email text, timebegins text, timeends text, zones text, "
+              "whenrequested text, queued integer, name text)",
+              "create table if not exists request_zone (requestid integer, zone text, timebegins text, timeends text)",
+              "create table if not exists offer (spotid integer, zone text, timebegins text, timeends text, "
+              "requestid integer)",
+              "create index if not exists request_queued on request (queued, email, timebegins, timeends)",
+              "create index if not exists request_zone_period on request_zone (zone, timebegins, timeends)",
+              "create index if not exists request_zone_request on request_zone (requestid)",
+              "create index if not exists request_zone_end on request_zone (zone, timeends)",
+              "create index if not exists spot_owner on spot (owneremail)",
+              "create index if not exists offer_spot_period on offer (spotid, timebegins, timeends)",
+              "create index if not exists offer_unmatched_zone_period on offer (zone, timebegins, timeends) "
+              "where requestid is null",
+              "create index if not exists offer_matched on offer (requestid) where requestid is not null",
+              "create index if not exists offer_end on offer (timeends)"]
+
+    query_users = "select name, email from user"
+    query_spots = "select s.zone, s.number, u.name, u.email from spot s join user u on (u.email = s.owneremail)"
+    query_spot_id = "select rowid from spot where zone = ? and number = ?"
+    # requestors need not be stored users; requests stored before their name was kept take it from the user
+    query_requests = "select r.rowid, coalesce(r.name, u.name), r.email, r.timebegins, r.timeends, r.zones, " \
+                     "r.whenrequested from request r left join user u on (u.email = r.email)"
+    query_request_queue = query_requests + " where r.queued = 1"
+    query_request_queue_in_zone = query_request_queue + \
+        " and r.rowid in (select rz.requestid from request_zone rz join spot s on (s.zone = rz.zone) " \
+        "where s.owneremail = ? and rz.timeends < ?)"
+    query_first_matching_request = query_requests + \
+        " join request_zone rz on (rz.requestid = r.rowid) where rz.zone = ? and rz.timebegins >= ? " \
+        "and rz.timeends <= ? order by r.whenrequested, r.rowid limit 1"
+    query_queued_request_id = "select rowid from request where queued = 1 and email = ? and timebegins = ? " \
+                              "and timeends = ? and zones = ? order by rowid limit 1"
+    query_matched_request_ids = "select rowid from request where queued = 0 and email = ? and timebegins = ? " \
+                                "and timeends = ? and zones = ?"
+    query_offers_with_data = "select o.rowid, o.timebegins, o.timeends, s.zone, s.number, u.name, u.email, " \
+                             "coalesce(r.name, ru.name), r.email, r.timebegins, r.timeends, r.zones, " \
+                             "r.whenrequested from offer o " \
                              "left join spot s on (o.spotid = s.rowid) " \
-                             "left join user u on (u.email = s.owneremail)"
-    query_match = "select rowid, * from spot"
-
-    def __init__(self, dbfile):
-        self.dbcon = sqlite3.connect(dbfile)
+                             "left join user u on (u.email = s.owneremail) " \
+                             "left join request r on (r.rowid = o.requestid) " \
+                             "left join user ru on (ru.email = r.email)"
+    query_offers = query_offers_with_data + " order by o.rowid"
+    query_unmatched_offers = query_offers_with_data + " where o.requestid is null order by o.rowid"
+    query_offers_matched_with = query_offers_with_data + " where o.requestid in (" + query_matched_request_ids + \
+        ") order by o.rowid"
+    query_matched_offers = query_offers_with_data + " where o.requestid is not null order by o.rowid"
+    query_offers_for_spot = query_offers_with_data + " where o.spotid = ?"
+    query_offers_ending_before = query_offers_with_data + " where o.timeends < ? order by o.rowid"
+    query_offers_touching = query_offers_for_spot + " and o.timebegins <= ? and o.timeends >= ? " \
+                                                    "order by o.timebegins, o.rowid"
+    query_shortest_matching_offer = query_offers_with_data + \
+        " where o.requestid is null and o.zone in ({0}) and o.timebegins <= ? and o.timeends >= ? " \
+        "order by strftime('%s', o.timeends) - strftime('%s', o.timebegins), o.rowid limit 1"
+    query_unmatched_offer_id = "select rowid from offer where spotid = ? and timebegins = ? and timeends = ? " \
+                               "and requestid is null order by rowid limit 1"
+    query_matched_offer_id = "select o.rowid, o.requestid from offer o join request r on (r.rowid = o.requestid) " \
+                             "where o.spotid = ? and o.timebegins = ? and o.timeends = ? and r.email = ? " \
+                             "and r.timebegins = ? and r.timeends = ? and r.zones = ? order by o.rowid limit 1"
+
+    time_format = "%Y-%m-%dT%H:00"
+    when_requested_format = "%Y-%m-%d %H:%M:%S.%f"
+    end_of_time = "9999"  # sorts after every stored time
+    statement_cache_size = 256
+    synchronous_settings = ["OFF", "NORMAL", "FULL", "EXTRA"]
+    dbcon = None
+
+    def __init__(self, dbfile, init_users=(), init_spots=(), journal_mode="WAL", synchronous="NORMAL", timeout=5.0):
+        """
+        Data access backed by an SQLite database, created if it does not exist yet
+        :param dbfile: database file name, or ":memory:"
+        :param init_users: Users to store, if not stored already
+        :param init_spots: Spots to store, if not stored already
+        :param journal_mode: SQLite journal mode; WAL lets readers work alongside the single writer
+        :param synchronous: SQLite synchronous setting, one of `synchronous_settings`. With WAL, NORMAL only syncs
+        on checkpoints, which may lose the last transactions on power loss but never corrupts the database
+        :param timeout: seconds to wait for another connection's write lock
+        The connection may be used from any thread, one at a time.
+        """
+        if synchronous.upper() not in self.synchronous_settings:
+            raise AttributeError("synchronous '%s' not one of the settings" % synchronous)
+        self.dbcon = sqlite3.connect(dbfile, timeout=timeout, isolation_level=None, check_same_thread=False,
+                                     cached_statements=self.statement_cache_size)
         self.cursor = self.dbcon.cursor()
+        self.registry = Registry(init_users, init_spots)  # shares users and spots of the rows read
+        self.__transaction_depth = 0
+        self.dbcon.execute("pragma journal_mode = %s" % journal_mode)
+        self.dbcon.execute("pragma synchronous = %s" % synchronous.upper())
+        with self.transaction():
+            for statement in self.schema:
+                self.dbcon.execute(statement)
+            if "name" not in [column[1] for column in self.dbcon.execute("pragma table_info(request)")]:
+                self.dbcon.execute("alter table request add column name text")
+            self.dbcon.executemany("insert or ignore into user (email, name) values (?, ?)",
+                                   [(user.email, user.name) for user in init_users])
+            self.dbcon.executemany("insert or ignore into spot (zone, number, owneremail) values (?, ?, ?)",
+                                   [(spot.zone, spot.place, spot.owner.email) for spot in init_spots])
 
     def __del__(self):
-        self.dbcon.close()
+        if self.dbcon is not None:
+            self.dbcon.close()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Commits everything done inside at once, or rolls it all back on error.
+        Nested transactions are part of the outermost one, kept as savepoints: one failing rolls back only what was
+        done inside it, so the outer one can catch the error and go on.
+        """
+        depth = self.__transaction_depth
+        self.dbcon.execute("begin immediate" if depth == 0 else "savepoint nested%d" % depth)
+        self.__transaction_depth += 1
+        try:
+            yield
+        except BaseException:
+            self.__transaction_depth -= 1
+            if depth == 0:
+                self.dbcon.execute("rollback")
+            else:
+                self.dbcon.execute("rollback to nested%d" % depth)
+                self.dbcon.execute("release nested%d" % depth)
+            raise
+        self.__transaction_depth -= 1
+        self.dbcon.execute("commit" if depth == 0 else "release nested%d" % depth)
+
+    @property
+    def users(self):
+        return [self.registry.user(name, email) for name, email in self.dbcon.execute(self.query_users)]
+
+    @property
+    def spots(self):
+        return [self.registry.spot(zone, number, self.registry.user(name, email)) for zone, number, name, email in
+                self.dbcon.execute(self.query_spots)]
+
+    def __time(self, moment):
+        return moment.strftime(self.time_format)
+
+    def __request(self, name, email, begins, ends, zones, when_requested):
+        return Request(self.registry.user(name, email), begins, ends, zones,
+                       datetime.strptime(when_requested, self.when_requested_format))
+
+    def __offer(self, row):
+        _, begins, ends, zone, number, owner_name, owner_email = row[:7]
+        spot = self.registry.spot(zone, number, self.registry.user(owner_name, owner_email))
+        return Offer(spot, Period(begins, ends), self.__request(*row[7:]) if row[8] is not None else None)
+
+    def __offers(self, query, *params):
+        return [self.__offer(row) for row in self.dbcon.execute(query, params)]
+
+    def __spot_id(self, spot):
+        row = self.dbcon.execute(self.query_spot_id, (spot.zone, spot.place)).fetchone()
+        if row is None:
+            raise AttributeError("spot '%s' not stored" % spot)
+        return row[0]
+
+    def __insert_request(self, request, queued):
+        return self.dbcon.execute("insert into request (email, name, timebegins, timeends, zones, whenrequested, "
+                                  "queued) values (?, ?, ?, ?, ?, ?, ?)",
+                                  (request.requestor.email, request.requestor.name, self.__time(request.period.begin),
+                                   self.__time(request.period.end), ",".join(request.zones),
+                                   request.when_requested.strftime(self.when_requested_format),
+                                   1 if queued else 0)).lastrowid
+
+    def clear(self):
+        with self.transaction():
+            for table in ["offer", "request_zone", "request"]:
+                self.dbcon.execute("delete from %s" % table)
+
+    def get_request_queue(self, user=None, before=None):
+        before_time = self.__time(epoch + timedelta(hours=hours_since_epoch(before, round_up=True))) if before \
+            else self.end_of_time
+        if user:
+            query, params = self.query_request_queue_in_zone, [user.email, before_time]
+        else:
+            query, params = self.query_request_queue + " and r.timeends < ?", [before_time]
+        return [self.__request(*row[1:]) for row in self.dbcon.execute(query + " order by r.rowid", params)]
+
+    def __request_params(self, request):
+        return (request.requestor.email, self.__time(request.period.begin), self.__time(request.period.end),
+                ",".join(request.zones))
+
+    def is_queued(self, request):
+        return self.dbcon.execute(self.query_queued_request_id, self.__request_params(request)).fetchone() is not None
+
+    def get_first_matching_request(self, offer):
+        row = self.dbcon.execute(self.query_first_matching_request,
+                                 (offer.spot.zone, self.__time(offer.period.begin),
+                                  self.__time(offer.period.end))).fetchone()
+        return None if row is None else self.__request(*row[1:])
+
+    def get_matched_requests(self):
+        return [off.matched_request() for off in self.get_matched_offers()]
+
+    def get_offers(self):
+        return self.__offers(self.query_offers)
+
+    def get_unmatched_offers(self):
+        return self.__offers(self.query_unmatched_offers)
+
+    def get_matched_offers(self):
+        return self.__offers(self.query_matched_offers)
+
+    def get_offers_matched_with(self, request):
+        return self.__offers(self.query_offers_matched_with, *self.__request_params(request))
+
+    def get_shortest_matching_offer(self, request):
+        zones = sorted(set(request.zones))
+        if not zones:
+            return None
+        query = self.query_shortest_matching_offer.format(", ".join("?" * len(zones)))
+        offers = self.__offers(query, *(zones + [self.__time(request.period.begin),
+                                                 self.__time(request.period.end)]))
+        return offers[0] if offers else None
+
+    def get_offers_for_spot(self, spot, since=None, until=None):
+        query, params = self.query_offers_for_spot, [self.__spot_id(spot)]
+        if since:
+            query += " and o.timebegins = ?"
+            params.append(self.__time(since))
+        if until:
+            query += " and o.timeends = ?"
+            params.append(self.__time(until))
+        return self.__offers(query + " order by o.timebegins, o.rowid", *params)
+
+    def get_offers_touching(self, spot, period):
+        return self.__offers(self.query_offers_touching, self.__spot_id(spot), self.__time(period.end),
+                             self.__time(period.begin))
+
+    def get_offers_ending_before(self, before):
+        return self.__offers(self.query_offers_ending_before,
+                             self.__time(epoch + timedelta(hours=hours_since_epoch(before, round_up=True))))
+
+    def add_offer(self, offer):
+        request = offer.matched_request()
+        with self.transaction():
+            self.dbcon.execute("insert into offer (spotid, zone, timebegins, timeends, requestid) "
+                               "values (?, ?, ?, ?, ?)",
+                               (self.__spot_id(offer.spot), offer.spot.zone, self.__time(offer.period.begin),
+                                self.__time(offer.period.end),
+                                self.__insert_request(request, False) if request else None))
+
+    def delete_offer(self, offer):
+        request = offer.matched_request()
+        params = [self.__spot_id(offer.spot), self.__time(offer.period.begin), self.__time(offer.period.end)]
+        with self.transaction():
+            if request:
+                row = self.dbcon.execute(self.query_matched_offer_id,
+                                         params + list(self.__request_params(request))).fetchone()
+            else:
+                row = self.dbcon.execute(self.query_unmatched_offer_id, params).fetchone()
+            if row is not None:
+                self.dbcon.execute("delete from offer where rowid = ?", (row[0],))
+                if request:
+                    self.dbcon.execute("delete from request where rowid = ?", (row[1],))
+
+    def add_request(self, request):
+        with self.transaction():
+            requestid = self.__insert_request(request, True)
+            self.dbcon.executemany("insert into request_zone (requestid, zone, timebegins, timeends) "
+                                   "values (?, ?, ?, ?)",
+                                   [(requestid, zone, self.__time(request.period.begin),
+                                     self.__time(request.period.end)) for zone in set(request.zones)])
+
+    def delete_request_from_queue(self, request):
+        with self.transaction():
+            row = self.dbcon.execute(self.query_queued_request_id, self.__request_params(request)).fetchone()
+            if row is not None:
+                self.dbcon.execute("delete from request_zone where requestid = ?", row)
+                self.dbcon.execute("delete from request where rowid = ?", row)
 
 
 class Api:
-    def __init__(self, data):
-        self.data = data
+    def __init__(self, data, metrics=None):
+        """
+        :param data: data access
+        :param metrics: Metrics to time Api methods and data-access calls with, and count items scanned and matched.
+        Nothing is collected if not given.
+        """
+        self.metrics = metrics or no_metrics
+        self.data = InstrumentedDataAccess(data, metrics) if metrics else data
+        self.__dirty = None  # (freed offers, displaced requests) while matching is deferred
+
+    def _reserve(self, request, offer):
+        """
+        Called when `request` is about to be matched with `offer`, before anything is changed
+        """
+        pass
 
     def __match_request_with_offer(self, request, offer):
+        self.metrics.count("requests_matched")
         self.data.add_offer(Offer.matched_with(offer.spot, request))
         for per in [offer.period.before(request.period), offer.period.after(request.period)]:
             if per is not None:
@@ -259,50 +792,204 @@ class Api:
         self.data.delete_request_from_queue(request)
         self.data.delete_offer(offer)
 
+    @timed
     def new_offer(self, offer):
-        # disallow new offers over existing matched ones
-        existing_offers = list(filter(lambda off: off.period.gluable(offer.period),
-                                      self.data.get_offers_for_spot(offer.spot)))
-        if any(filter(lambda off: off.period.intersects(offer.period) and off.matched_request(), existing_offers)):
-            return
-
-        for xo in existing_offers:
-            offer = Offer.unmatched(offer.spot, offer.period.glue(xo.period))
-            self.data.delete_offer(xo)
-
-        matching_requests = list(filter(lambda req: req.matches(offer), self.data.get_request_queue()))
-        if any(matching_requests):
-            first_request = min(matching_requests, key=lambda req: req.when_requested)
-            self.__match_request_with_offer(first_request, offer)
-        else:
-            self.data.add_offer(offer)
-
+        """
+        :return: the queued Request the offer was matched with, if any
+        """
+        with self.data.transaction():
+            # disallow new offers over existing matched ones
+            existing_offers = self.data.get_offers_touching(offer.spot, offer.period)
+            self.metrics.count("offers_scanned", len(existing_offers))
+            if any(filter(lambda off: off.period.intersects(offer.period) and off.matched_request(),
+                          existing_offers)):
+                self.metrics.count("offers_rejected")
+                return None
+
+            self.metrics.count("offers_glued", len(existing_offers))
+            for xo in existing_offers:
+                offer = Offer.unmatched(offer.spot, offer.period.glue(xo.period))
+
+            first_request = self.data.get_first_matching_request(offer)
+            if first_request is not None:
+                self._reserve(first_request, offer)
+            for xo in existing_offers:
+                self.data.delete_offer(xo)
+            if first_request is not None:
+                self.__match_request_with_offer(first_request, offer)
+            else:
+                self.data.add_offer(offer)
+            return first_request
+
+    @timed
     def cancel_offer(self, offer):
-        matching_offers = self.data.get_offers_for_spot(offer.spot, offer.period.begin, offer.period.end)
-        for matching in matching_offers:
-            req = matching.matched_request()
-            self.data.delete_offer(matching)
-            if req:
-                self.new_request(req)
-
+        with self.data.transaction():
+            matching_offers = self.data.get_offers_for_spot(offer.spot, offer.period.begin, offer.period.end)
+            for matching in matching_offers:
+                req = matching.matched_request()
+                self.data.delete_offer(matching)
+                if req:
+                    self.__rematch(req)
+            if self.__dirty is not None:
+                self.__dirty[0].pop(Offer.unmatched(offer.spot, offer.period), None)
+
+    @timed
     def new_request(self, request):
-        # check for existing requests, expand if necessary
-        matching_offers = list(filter(lambda off: request.matches(off), self.data.get_unmatched_offers()))
-        if any(matching_offers):
-            first_offer = min(matching_offers, key=lambda off: off.period.length())
-            self.__match_request_with_offer(request, first_offer)
-        else:
-            self.data.add_request(request)
-
+        """
+        :return: the unmatched Offer the request was matched with, if any
+        """
+        with self.data.transaction():
+            # check for existing requests, expand if necessary
+            first_offer = self.data.get_shortest_matching_offer(request)
+            if first_offer is not None:
+                self._reserve(request, first_offer)
+                self.__match_request_with_offer(request, first_offer)
+            else:
+                self.metrics.count("requests_queued")
+                self.data.add_request(request)
+            return first_offer
+
+    @timed
     def cancel_request(self, request):
-        if request in self.data.get_request_queue():
-            self.data.delete_request_from_queue(request)
+        with self.data.transaction():
+            if self.data.is_queued(request):
+                self.data.delete_request_from_queue(request)
+            elif self.__dirty is not None and self.__dirty[1].get(request):
+                self.__dirty[1][request].pop()
+            else:
+                for offer in self.data.get_offers_matched_with(request):
+                    self.data.delete_offer(offer)
+                    self.__rematch(Offer.unmatched(offer.spot, offer.period))
+
+    def __rematch(self, freed):
+        """
+        Matches an offer freed or a request displaced by a cancellation, or marks it dirty if matching is deferred
+        """
+        if isinstance(freed, Offer):
+            if self.__dirty is None:
+                self.new_offer(freed)
+            else:
+                self.__dirty[0].setdefault(freed, []).append(freed)
+        elif self.__dirty is None:
+            self.new_request(freed)
         else:
-            matched_offer = list(filter(lambda off: off.matched_request() == request, self.data.get_matched_offers()))
-            for offer in matched_offer:
-                self.data.delete_offer(offer)
-                self.new_offer(Offer.unmatched(offer.spot, offer.period))
+            self.__dirty[1].setdefault(freed, []).append(freed)
 
-    def get_request_for_owner(self, owner, until=date_hour(datetime.now() + timedelta(days=7))):
-        return self.data.get_request_queue(owner, until)
+    @contextmanager
+    def deferred_matching(self):
+        """
+        Defers re-matching after cancellations to the end of the block.
+        Offers freed and requests displaced by cancellations are kept aside as dirty spot and zone windows. At the end
+        they go through `bulk_load` together, so only offers and requests overlapping those windows are looked at
+        again, once, instead of after every single cancellation. Cancelling a freed period or a displaced request
+        before then just drops it. The whole block is one transaction.
+        """
+        if self.__dirty is not None:
+            yield
+            return
+        with self.data.transaction():
+            self.__dirty = ({}, {})
+            try:
+                yield
+            finally:
+                freed, displaced = self.__dirty
+                self.__dirty = None
+                self.bulk_load([off for offs in freed.values() for off in offs],
+                               [req for reqs in displaced.values() for req in reqs])
+
+    @timed
+    def bulk_load(self, offers, requests):
+        """
+        Adds many offers and requests at once. Ends in the same state as calling `new_offer` for each offer in order
+        of beginning, then `new_request` for each request in order of `when_requested`.
+        Offers are glued with each other and with the spot's stored offers in one sweep per spot. Only glued groups
+        that touch a matched offer, hold stored offers touching each other or could take a queued request are then
+        added one offer at a time.
+        :param offers: unmatched Offers
+        :param requests: Requests
+        """
+        with self.data.transaction():
+            spot_offers = {}
+            for position, offer in sorted(enumerate(offers), key=lambda po: (po[1].period.begin_hour, po[0])):
+                spot_offers.setdefault(spot_key(offer.spot), []).append((position, offer))
+            steps = []  # ((begin, position) of the last offer involved, stored offers to glue, offer to add)
+            for new_offers in spot_offers.values():
+                spot = new_offers[0][1].spot
+                for period, stored, added in self.__glued_groups(self.data.get_offers_for_spot(spot), new_offers):
+                    glued = Offer.unmatched(spot, period)
+                    if not added:
+                        continue
+                    # new_offer only glues offers touching the new one, so stored offers touching each other
+                    # must not be glued through one another
+                    if any(off.matched_request() for off in stored) or \
+                            any(off.period.gluable(nxt.period) for off, nxt in zip(stored, stored[1:])) or \
+                            self.data.get_first_matching_request(glued) is not None:
+                        steps.extend(((off.period.begin_hour, position), None, off) for position, off in added)
+                    else:
+                        position, last = added[-1]
+                        steps.append(((last.period.begin_hour, position), stored,
+                                      glued if stored or len(added) > 1 else last))
+            # replaying in order keeps the order offers are stored in, which breaks ties between requests' matches
+            for _, stored, offer in sorted(steps, key=lambda step: step[0]):
+                if stored is None:
+                    self.new_offer(offer)
+                else:
+                    for off in stored:
+                        self.data.delete_offer(off)
+                    self.data.add_offer(offer)
+            for request in sorted(requests, key=lambda req: req.when_requested):
+                self.new_request(request)
+
+    @staticmethod
+    def __glued_groups(stored_offers, new_offers):
+        """
+        Splits offers on one spot into groups that would all be glued together
+        :param stored_offers: offers already stored for the spot, in order of beginning
+        :param new_offers: (position, offer) pairs of the offers being added, in order of beginning
+        :return: generator of (glued period, stored offers, new (position, offer) pairs) for every group
+        """
+        tagged = sorted([(off.period.begin_hour, 0, off) for off in stored_offers] +
+                        [(po[1].period.begin_hour, 1, po) for po in new_offers], key=lambda t: (t[0], t[1]))
+        period, stored, added = None, [], []
+        for _, is_new, item in tagged:
+            item_period = item[1].period if is_new else item.period
+            if period is not None and not period.gluable(item_period):
+                yield period, stored, added
+                period, stored, added = None, [], []
+            period = item_period if period is None else period.glue(item_period)
+            (added if is_new else stored).append(item)
+        if period is not None:
+            yield period, stored, added
+
+    @timed
+    def batch_match(self, by_when_requested=False, apply=True):
+        """
+        Matches the whole request queue with unmatched offers at once, using up free hours that matching one request
+        or offer at a time leaves behind. The plan never assigns fewer hours than one by one matching, but is not
+        guaranteed to assign the most possible, see `BatchMatcher`
+        :param by_when_requested: place earlier requests first, see `BatchMatcher.plan`
+        :param apply: store the plan; otherwise only report it
+        :return: BatchPlan, which tells how many more hours it assigns than one by one matching
+        """
+        with self.data.transaction():
+            plan = BatchMatcher(self.data.get_unmatched_offers(), self.data.get_request_queue()).plan(
+                by_when_requested)
+            if apply:
+                self.metrics.count("requests_matched", len(plan.assignments))
+                for offer, requests, free in plan.changed_offers():
+                    self.data.delete_offer(offer)
+                    for request in requests:
+                        self.data.add_offer(Offer.matched_with(offer.spot, request))
+                        self.data.delete_request_from_queue(request)
+                    for per in free:
+                        self.data.add_offer(Offer.unmatched(offer.spot, per))
+            return plan
+
+    @timed
+    def get_request_for_owner(self, owner, until=None):
+        """
+        Queued requests the owner could help with by offering their spot
+        :param until: only requests ending before this time; a week from now if not given
+        """
+        return self.data.get_request_queue(owner, until or date_hour(datetime.now() + timedelta(days=7)))
 
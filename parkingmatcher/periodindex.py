@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+from bisect import bisect_left, insort
+from itertools import count
+
+
+class PeriodIndex:
+    def __init__(self, sequence=None, key=None):
+        """
+        Items kept in order of the beginning of their period, apart for each length of it, and apart for each
+        period in order of `key`.
+        Lookups by beginning only visit entries that begin within the longest stored period from the queried one, so
+        for items that do not overlap each other (like offers on a single spot) they take logarithmic time. Looking
+        up the shortest containing period takes a search per stored length, and the first item within a period a
+        look at each distinct period inside it, however many items there are.
+        :param sequence: counter numbering added items; indexes sharing one can have their results compared
+        :param key: function giving the order of an item for `first_within`, taken when it is added; by default
+        items are in order of adding
+        """
+        self.__keys = []  # sorted (begin, seq) pairs
+        self.__entries = {}  # seq -> (item, period, key taken when added)
+        self.__lengths = []  # sorted lengths of stored periods
+        self.__by_length = {}  # length -> sorted (begin, seq) pairs of periods that long
+        self.__periods = []  # sorted distinct (begin, end) pairs of stored periods
+        self.__by_period = {}  # (begin, end) -> sorted (key, seq) pairs of items stored under that period
+        self.__seq = sequence if sequence is not None else count()
+        self.__key = key
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __iter__(self):
+        return (self.__entries[seq][0] for _, seq in self.__keys)
+
+    def add(self, item, period):
+        seq = next(self.__seq)
+        rank = self.__key(item) if self.__key is not None else seq
+        self.__entries[seq] = (item, period, rank)
+        insort(self.__keys, (period.begin_hour, seq))
+        span = period.end_hour - period.begin_hour
+        if span not in self.__by_length:
+            self.__by_length[span] = []
+            insort(self.__lengths, span)
+        insort(self.__by_length[span], (period.begin_hour, seq))
+        hours = (period.begin_hour, period.end_hour)
+        if hours not in self.__by_period:
+            self.__by_period[hours] = []
+            insort(self.__periods, hours)
+        insort(self.__by_period[hours], (rank, seq))
+
+    def remove(self, item, period):
+        """
+        Removes the earliest added item equal to `item` stored under `period`.
+        :return: True if anything was removed
+        """
+        for pos in range(bisect_left(self.__keys, (period.begin_hour,)), len(self.__keys)):
+            begin, seq = self.__keys[pos]
+            if begin != period.begin_hour:
+                break
+            stored, per, rank = self.__entries[seq]
+            if (stored, per) == (item, period):
+                del self.__keys[pos]
+                del self.__entries[seq]
+                span = period.end_hour - period.begin_hour
+                same_length = self.__by_length[span]
+                del same_length[bisect_left(same_length, (begin, seq))]
+                if not same_length:
+                    del self.__by_length[span]
+                    del self.__lengths[bisect_left(self.__lengths, span)]
+                hours = (period.begin_hour, period.end_hour)
+                same_period = self.__by_period[hours]
+                del same_period[bisect_left(same_period, (rank, seq))]
+                if not same_period:
+                    del self.__by_period[hours]
+                    del self.__periods[bisect_left(self.__periods, hours)]
+                return True
+        return False
+
+    def __longest(self):
+        return self.__lengths[-1] if self.__lengths else None
+
+    def starting_between(self, first, last):
+        """
+        Yields (item, period) pairs with period beginning between hours `first` and `last` inclusive, in order
+        """
+        for pos in range(bisect_left(self.__keys, (first,)), len(self.__keys)):
+            begin, seq = self.__keys[pos]
+            if begin > last:
+                break
+            yield self.__entries[seq][:2]
+
+    def first_within(self, period):
+        """
+        The item with the smallest key among those whose period lies within `period`; ties go to the earliest added.
+        Only the first item of each distinct period inside `period` is compared.
+        """
+        best = None
+        pos = bisect_left(self.__periods, (period.begin_hour,))
+        while pos < len(self.__periods):
+            begin, end = self.__periods[pos]
+            if begin > period.end_hour:
+                break
+            if end > period.end_hour:
+                pos = bisect_left(self.__periods, (begin, float("inf")), pos)  # the next beginning
+                continue
+            first = self.__by_period[(begin, end)][0]
+            if best is None or first < best:
+                best = first
+            pos += 1
+        return None if best is None else self.__entries[best[1]][0]
+
+    def shortest_containing(self, period):
+        """
+        The item with the shortest period containing `period`, ties going to the earliest added.
+        Lengths are tried from the shortest that could contain `period`; a period of a given length contains it if it
+        begins between `period.end_hour` minus that length and `period.begin_hour`, which is found by bisection.
+        :return: (item, rank) pair, where rank orders results from indexes sharing a sequence; None if nothing fits
+        """
+        begin, end = period.begin_hour, period.end_hour
+        for length in self.__lengths[bisect_left(self.__lengths, end - begin):]:
+            same_length = self.__by_length[length]
+            first = None
+            pos = bisect_left(same_length, (end - length,))
+            while pos < len(same_length) and same_length[pos][0] <= begin:
+                # the first entry of each beginning is the earliest added of them
+                if first is None or same_length[pos][1] < first:
+                    first = same_length[pos][1]
+                pos = bisect_left(same_length, (same_length[pos][0], float("inf")), pos)
+            if first is not None:
+                return self.__entries[first][0], (length, first)
+        return None
+
+    def latest_containing(self, period):
+        """
+        The item with the latest beginning period containing `period`, leaving the smallest gap before it
+        :return: (item, stored period) pair, or None if nothing fits
+        """
+        longest = self.__longest()
+        if longest is None:
+            return None
+        for pos in range(bisect_left(self.__keys, (period.begin_hour, float("inf"))) - 1, -1, -1):
+            begin, seq = self.__keys[pos]
+            if period.end_hour - begin > longest:
+                break
+            if self.__entries[seq][1].contains(period):
+                return self.__entries[seq][:2]
+        return None
+
+    def touching(self, period):
+        """
+        Items whose period overlaps or is adjacent to `period`, in order of beginning
+        """
+        longest = self.__longest()
+        if longest is None:
+            return []
+        return [item for item, per in self.starting_between(period.begin_hour - longest, period.end_hour)
+                if per.gluable(period)]
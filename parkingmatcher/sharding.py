@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+
+from collections import deque
+import multiprocessing
+
+from parkingmatcher.parkingmatcher import Api, TestDataAccess, number_objects_from, parking_zones
+
+
+def spans_zones(request):
+    return len(set(request.zones)) > 1
+
+
+class ShardApi(Api):
+    def __init__(self, data):
+        """
+        Api of a single zone, running in a shard process.
+        Requests for several zones belong to the coordinator: ones displaced here are handed back to it instead of
+        being queued, and they are only matched with an offer reserved for them. Unmatched offers stored while
+        handling a command are reported back, so the coordinator can match them with its requests.
+        """
+        super().__init__(data)
+        self.__held = {}  # request -> offer reserved for it
+        self.__committing = False
+        self.free = []
+        self.displaced = []
+
+    def new_offer(self, offer):
+        matched = super().new_offer(offer)
+        self.free.extend(off for off in self.data.get_offers_touching(offer.spot, offer.period)
+                         if off.matched_request() is None)
+        return matched
+
+    def new_request(self, request):
+        if spans_zones(request) and not self.__committing:
+            self.displaced.append(request)
+            return None
+        return super().new_request(request)
+
+    def reserve_offer(self, request_and_offer):
+        """
+        Takes the offer aside for the request, if it is still stored unmatched
+        :return: True if reserved
+        """
+        request, offer = request_and_offer
+        if offer not in self.data.get_offers_for_spot(offer.spot, offer.period.begin, offer.period.end):
+            return False
+        self.data.delete_offer(offer)
+        self.__held[request] = offer
+        return True
+
+    def reserve_for(self, request):
+        """
+        Takes aside the shortest offer the request fits in
+        :return: the offer reserved, or None
+        """
+        offer = self.data.get_shortest_matching_offer(request)
+        if offer is not None:
+            self.data.delete_offer(offer)
+            self.__held[request] = offer
+        return offer
+
+    def commit(self, request):
+        """
+        Matches the request with the offer reserved for it, or a shorter one stored since
+        """
+        offer = self.__held.pop(request)
+        self.data.add_offer(offer)
+        self.__committing = True
+        try:
+            matched = super().new_request(request)
+        finally:
+            self.__committing = False
+        if matched != offer:
+            self.free.append(offer)
+        return matched
+
+    def abort(self, request):
+        """
+        Gives the offer reserved for the request back, matching it like a new one
+        """
+        return self.new_offer(self.__held.pop(request))
+
+    def read(self, name):
+        return getattr(self.data, name)()
+
+    def take_reports(self):
+        reports = (self.free, self.displaced)
+        self.free, self.displaced = [], []
+        return reports
+
+
+def serve_shard(connection, number, users, spots):
+    """
+    Runs commands received on the connection against a ShardApi until told to stop with a None command.
+    Every command is answered with (succeeded, result or exception, free offers, displaced requests).
+    :param number: number of the shard, counted from 1, keeping ids of offers it creates apart from other processes'
+    """
+    number_objects_from(number << 48)
+    api = ShardApi(TestDataAccess(users, spots))
+    while True:
+        command, argument = connection.recv()
+        if command is None:
+            break
+        try:
+            result = getattr(api, command)(argument)
+        except Exception as e:
+            connection.send((False, e) + api.take_reports())
+        else:
+            connection.send((True, result) + api.take_reports())
+    connection.close()
+
+
+class ShardedApi:
+    def __init__(self, users, spots, context=None):
+        """
+        Matching split by zone: every zone has its own Api in a process of its own, so zones are matched on separate
+        cores. Requests for several zones are kept by this coordinator. It matches them with a two-phase reserve and
+        commit: shards first take aside the best offer they have, then the shortest of them, on the first zone in
+        sorted order on ties, gets matched and the others are given back. A request is never held by more than one
+        shard, so it cannot be matched twice.
+        An offer goes to requests queued in its zone's shard before any request for several zones.
+        :param context: multiprocessing context to start shards with; the default one if not given
+        """
+        context = context or multiprocessing.get_context()
+        self.users = users
+        self.spots = spots
+        self.__pending = TestDataAccess(users, spots)  # requests for several zones, waiting for an offer
+        self.__connections = {}
+        self.__waiting = {}  # zone -> handlers of replies not received yet, in order of sending
+        self.__sent = deque()  # (zone, handler) of commands in order of sending, across zones
+        self.__shards = []
+        for number, zone in enumerate(sorted(parking_zones), 1):
+            ours, theirs = context.Pipe()
+            shard = context.Process(target=serve_shard,
+                                    args=(theirs, number, users, [s for s in spots if s.zone == zone]), daemon=True)
+            shard.start()
+            theirs.close()
+            self.__connections[zone] = ours
+            self.__waiting[zone] = deque()
+            self.__shards.append(shard)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if not self.__shards:
+            return
+        self.__drain()
+        for connection in self.__connections.values():
+            connection.send((None, None))
+            connection.close()
+        for shard in self.__shards:
+            shard.join()
+        self.__shards = []
+
+    def __send(self, zone, command, argument, handler):
+        """
+        :param handler: called with the result of the command, and the waiting requests matched with offers it freed
+        """
+        self.__connections[zone].send((command, argument))
+        self.__waiting[zone].append(handler)
+        self.__sent.append((zone, handler))
+
+    def __receive(self, zone):
+        """
+        Handles the oldest reply from the zone's shard, then matches what it reports
+        """
+        handler = self.__waiting[zone].popleft()
+        succeeded, result, free, displaced = self.__connections[zone].recv()
+        if not succeeded:
+            raise result
+        for request in displaced:
+            self.__new_request(request)
+        matched = [self.__match_pending(zone, offer) for offer in free]
+        handler(result, [request for request in matched if request is not None])
+
+    def __call(self, zone, command, argument):
+        reply = []
+        self.__send(zone, command, argument, lambda result, matched: reply.append(result))
+        while not reply:
+            self.__receive(zone)
+        return reply[0]
+
+    def __drain(self):
+        """
+        Handles all replies not received yet, in order of sending
+        """
+        while self.__sent:
+            zone, handler = self.__sent.popleft()
+            while handler in self.__waiting[zone]:
+                self.__receive(zone)
+
+    def __match_pending(self, zone, offer):
+        """
+        Matches an unmatched offer a shard reports with the first waiting request for several zones it fits
+        :return: the request matched, or None
+        """
+        request = self.__pending.get_first_matching_request(offer)
+        if request is None or not self.__call(zone, "reserve_offer", (request, offer)):
+            return None
+        self.__pending.delete_request_from_queue(request)
+        self.__call(zone, "commit", request)
+        return request
+
+    def __new_request(self, request):
+        zones = sorted(set(request.zones))
+        for zone in zones:
+            while self.__waiting[zone]:
+                self.__receive(zone)  # offers freed by earlier commands go to requests waiting since before
+        reserved = {}
+        for zone in zones:
+            self.__send(zone, "reserve_for", request,
+                        lambda offer, matched, zone=zone: reserved.__setitem__(zone, offer))
+        for zone in zones:
+            while zone not in reserved:
+                self.__receive(zone)
+        found = [(offer.period.length(), zone) for zone, offer in reserved.items() if offer is not None]
+        best = min(found)[1] if found else None
+        matched = None
+        for zone in zones:
+            if zone == best:
+                matched = self.__call(zone, "commit", request)
+            elif reserved[zone] is not None:
+                self.__call(zone, "abort", request)
+        if best is None:
+            self.__pending.add_request(request)
+        return matched
+
+    def __cancel_request(self, request):
+        if self.__pending.is_queued(request):
+            self.__pending.delete_request_from_queue(request)
+        else:
+            for zone in sorted(set(request.zones)):
+                self.__call(zone, "cancel_request", request)
+
+    def apply(self, calls):
+        """
+        Runs Api calls, sending each call for a single zone to its shard without waiting for the result, so shards
+        work on them in parallel
+        :param calls: (method name, argument) pairs, method being one of new_offer, cancel_offer, new_request,
+        cancel_request
+        :return: list of results of the calls
+        """
+        results = [None] * len(calls)
+        for position, (method, argument) in enumerate(calls):
+            if method in ("new_offer", "cancel_offer"):
+                zones = [argument.spot.zone]
+            elif method in ("new_request", "cancel_request"):
+                zones = sorted(set(argument.zones))
+            else:
+                raise AttributeError("unknown method " + method)
+            if len(zones) == 1:
+                self.__send(zones[0], method, argument,
+                            lambda result, matched, at=position, method=method: results.__setitem__(
+                                at, self.__result(method, result, matched)))
+            elif method == "new_request":
+                results[position] = self.__new_request(argument)
+            else:
+                self.__cancel_request(argument)
+        self.__drain()
+        return results
+
+    @staticmethod
+    def __result(method, result, matched):
+        """
+        Result of a call for a single zone, like Api's: a new offer the shard left unmatched may still have been
+        matched with a waiting request for several zones
+        """
+        if method == "new_offer" and result is None and matched:
+            return matched[0]
+        return result
+
+    def new_offer(self, offer):
+        return self.apply([("new_offer", offer)])[0]
+
+    def cancel_offer(self, offer):
+        return self.apply([("cancel_offer", offer)])[0]
+
+    def new_request(self, request):
+        return self.apply([("new_request", request)])[0]
+
+    def cancel_request(self, request):
+        return self.apply([("cancel_request", request)])[0]
+
+    def __read(self, name):
+        return [item for zone in sorted(self.__connections) for item in self.__call(zone, "read", name)]
+
+    def get_unmatched_offers(self):
+        return self.__read("get_unmatched_offers")
+
+    def get_matched_offers(self):
+        return self.__read("get_matched_offers")
+
+    def get_request_queue(self):
+        return self.__read("get_request_queue") + self.__pending.get_request_queue()
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+
+from array import array
+from datetime import timedelta
+import mmap
+import os
+import struct
+import sys
+
+from parkingmatcher.parkingmatcher import Offer, Period, Request, Spot, TestDataAccess, User, epoch, spot_key
+
+# magic, format version, numbers of strings, users, registered users, spots, registered spots, requests and offers,
+# then the operation log position the snapshot was taken at
+header = struct.Struct("<8sIIIIIIIIQ")
+magic = b"PMSNAP\0\0"
+version = 1
+# columns of every table, in order, each stored as an array of little-endian 64-bit ints
+user_columns = ["name", "email"]
+spot_columns = ["zone", "place", "owner"]
+request_columns = ["requestor", "begin_hour", "end_hour", "zones", "when_requested", "queued"]
+offer_columns = ["spot", "begin_hour", "end_hour", "request"]
+microsecond = timedelta(microseconds=1)
+
+
+class StringTable:
+    def __init__(self):
+        self.strings = []
+        self.__index = {}
+
+    def __call__(self, text):
+        """
+        :return: index of the text in the table, adding it if not there yet
+        """
+        index = self.__index.get(text)
+        if index is None:
+            index = self.__index[text] = len(self.strings)
+            self.strings.append(text)
+        return index
+
+
+def int_column(values):
+    column = array("q", values)
+    if sys.byteorder != "little":
+        column.byteswap()
+    return column.tobytes()
+
+
+def padded(blob):
+    return blob + b"\0" * (-len(blob) % 8)
+
+
+def write_snapshot(data, stream, position=0):
+    """
+    Writes users, spots, offers with the requests they are matched with, in the order they are stored, and the request
+    queue of a data access. Times of requests are written as naive local time.
+    Layout: header, string table (offsets, then UTF-8 text) and one column of 64-bit ints per table column, all
+    aligned to 8 bytes.
+    :param stream: binary file-like object to write to
+    :param position: operation log position the data is at, given back by `read_snapshot`
+    """
+    strings = StringTable()
+    users, user_index = [], {}
+    spots, spot_index = [], {}
+    requests, request_index = [], {}
+
+    def user(usr):
+        if usr.email not in user_index:
+            user_index[usr.email] = len(users)
+            users.append((strings(usr.name), strings(usr.email)))
+        return user_index[usr.email]
+
+    def spot(spt):
+        key = spot_key(spt)
+        if key not in spot_index:
+            spot_index[key] = len(spots)
+            spots.append((strings(spt.zone), strings(spt.place), user(spt.owner)))
+        return spot_index[key]
+
+    def request(req, queued):
+        if queued or id(req) not in request_index:
+            when = req.when_requested
+            if when.tzinfo is not None:
+                when = when.astimezone().replace(tzinfo=None)  # local time, like the times of other requests
+            request_index[id(req)] = len(requests)
+            requests.append((user(req.requestor), req.period.begin_hour, req.period.end_hour,
+                             strings(",".join(req.zones)), (when - epoch) // microsecond, queued))
+        return request_index[id(req)]
+
+    for usr in data.users:
+        user(usr)
+    registered_users = len(users)
+    for spt in data.spots:
+        spot(spt)
+    registered_spots = len(spots)
+    for req in data.get_request_queue():
+        request(req, 1)
+    offers = [(spot(off.spot), off.period.begin_hour, off.period.end_hour,
+               -1 if off.matched_request() is None else request(off.matched_request(), 0))
+              for off in data.get_offers()]
+
+    encoded = [text.encode("utf-8") for text in strings.strings]
+    offsets = [0]
+    for text in encoded:
+        offsets.append(offsets[-1] + len(text))
+    stream.write(header.pack(magic, version, len(encoded), len(users), registered_users, len(spots),
+                             registered_spots, len(requests), len(offers), position))
+    stream.write(int_column(offsets))
+    stream.write(padded(b"".join(encoded)))
+    for rows, columns in [(users, user_columns), (spots, spot_columns), (requests, request_columns),
+                          (offers, offer_columns)]:
+        for column in range(len(columns)):
+            stream.write(int_column(row[column] for row in rows))
+
+
+def save_snapshot(data, path, position=0):
+    """
+    Saves a snapshot of the data access to a file, see `write_snapshot`.
+    The file is written next to `path` and renamed over it once synced, so a crash never leaves half a snapshot.
+    :param position: operation log position the data is at, given back by `load_snapshot`
+    """
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as snapshot:
+        write_snapshot(data, snapshot, position)
+        snapshot.flush()
+        os.fsync(snapshot.fileno())
+    os.replace(temporary, path)
+
+
+class Reader:
+    def __init__(self, view):
+        """
+        Reads consecutive parts of a snapshot
+        :param view: memoryview of the snapshot, past the header
+        """
+        self.view = view
+        self.position = 0
+
+    def ints(self, count):
+        with self.view[self.position:self.position + 8 * count] as part:
+            if len(part) != 8 * count:
+                raise ValueError("snapshot is truncated")
+            self.position += 8 * count
+            if sys.byteorder == "little":
+                with part.cast("q") as column:
+                    return column.tolist()
+            column = array("q", part)
+        column.byteswap()
+        return column.tolist()
+
+    def text(self, size):
+        blob = bytes(self.view[self.position:self.position + size])
+        if len(blob) != size:
+            raise ValueError("snapshot is truncated")
+        self.position += size + (-size % 8)
+        return blob
+
+    def table(self, rows, columns):
+        return dict(zip(columns, (self.ints(rows) for _ in columns)))
+
+
+def load_snapshot(path, data_access=TestDataAccess):
+    """
+    Restores data saved with `save_snapshot`. The file is mapped to memory, see `read_snapshot`.
+    :param data_access: called with users and spots to make the data access to restore into
+    :return: (data access, operation log position of the snapshot)
+    """
+    with open(path, "rb") as snapshot, mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        with memoryview(mapped) as view:
+            return read_snapshot(view, data_access, "'%s'" % path)
+
+
+def read_snapshot(buffer, data_access=TestDataAccess, name="data"):
+    """
+    Restores data written with `write_snapshot`. Every column is read with a single conversion; objects are only
+    built once per row, sharing users and spots.
+    :param buffer: bytes-like object holding the snapshot
+    :param data_access: called with users and spots to make the data access to restore into
+    :param name: what the buffer is, for errors
+    :return: (data access, operation log position of the snapshot)
+    """
+    with memoryview(buffer) as view:
+        if len(view) < header.size:
+            raise ValueError("%s is not a snapshot" % name)
+        mark, file_version, strings_count, users_count, registered_users, spots_count, registered_spots, \
+            requests_count, offers_count, position = header.unpack_from(view)
+        if mark != magic or file_version != version:
+            raise ValueError("%s is not a snapshot of version %d" % (name, version))
+        with view[header.size:] as rest:
+            reader = Reader(rest)
+            offsets = reader.ints(strings_count + 1)
+            blob = reader.text(offsets[-1])
+            users_table = reader.table(users_count, user_columns)
+            spots_table = reader.table(spots_count, spot_columns)
+            requests_table = reader.table(requests_count, request_columns)
+            offers_table = reader.table(offers_count, offer_columns)
+
+    strings = [blob[begin:end].decode("utf-8") for begin, end in zip(offsets, offsets[1:])]
+    users = [User(strings[name], strings[email])
+             for name, email in zip(users_table["name"], users_table["email"])]
+    spots = [Spot(strings[zone], strings[place], users[owner])
+             for zone, place, owner in zip(spots_table["zone"], spots_table["place"], spots_table["owner"])]
+    zones = {}
+    requests = []
+    for requestor, begin, end, zone_list, when in zip(*(requests_table[column] for column in request_columns[:5])):
+        if zone_list not in zones:
+            zones[zone_list] = strings[zone_list].split(",") if strings[zone_list] else []
+        requests.append(Request.with_period(users[requestor], Period.from_hours(begin, end), list(zones[zone_list]),
+                                            epoch + when * microsecond))
+
+    data = data_access(users[:registered_users], spots[:registered_spots])
+    with data.transaction():
+        for request, queued in zip(requests, requests_table["queued"]):
+            if queued:
+                data.add_request(request)
+        for spot, begin, end, request in zip(*(offers_table[column] for column in offer_columns)):
+            data.add_offer(Offer(spots[spot], Period.from_hours(begin, end),
+                                 requests[request] if request >= 0 else None))
+    return data, position
@@ -0,0 +1,172 @@
+import asyncio
+from contextlib import contextmanager
+import sqlite3
+import threading
+import unittest
+from parkingmatcher.asyncapi import AsyncApi
+from parkingmatcher.parkingmatcher import Api, DBDataAccess, Offer, Request, TestDataAccess
+from test_parkingmatcher import hours, today, spot_e11, spot_e21, user_e1, user_e2, user_nopark
+
+
+class AsyncApiTest(unittest.TestCase):
+    def setUp(self):
+        self.data = TestDataAccess([user_e1, user_e2, user_nopark], [spot_e11, spot_e21])
+        self.matcher = AsyncApi(Api(self.data), burst_size=10)
+
+    def run_async(self, coroutine):
+        return asyncio.run(coroutine)
+
+    def test_futures_resolve_to_matches(self):
+        request = Request(user_nopark, today(4), today(5), "etap1")
+
+        async def scenario():
+            async with self.matcher:
+                queued = await self.matcher.new_request(request)
+                matched = await self.matcher.new_offer(Offer.unmatched(spot_e11, hours(3, 6)))
+                return queued, matched
+
+        self.assertEqual(self.run_async(scenario()), (None, request))
+        self.assertEqual(self.data.get_request_queue(), [])
+
+    def test_applies_changes_in_order(self):
+        first = Request(user_nopark, today(4), today(5), "etap1", today(1))
+        second = Request(user_e2, today(4), today(5), "etap1", today(2))
+
+        async def scenario():
+            async with self.matcher:
+                return await asyncio.gather(self.matcher.new_request(first), self.matcher.new_request(second),
+                                            self.matcher.new_offer(Offer.unmatched(spot_e11, hours(3, 6))),
+                                            self.matcher.cancel_request(first))
+
+        results = self.run_async(scenario())
+        self.assertEqual(results[2], first)
+        self.assertEqual(self.data.get_matched_requests(), [second])
+
+    def test_bursts(self):
+        offers = [Offer.unmatched(spot_e21, hours(h, h + 1)) for h in range(0, 46, 2)]
+
+        async def scenario():
+            async with self.matcher:
+                await asyncio.gather(*map(self.matcher.new_offer, offers))
+                return self.matcher.snapshot()
+
+        snapshot = self.run_async(scenario())
+        self.assertEqual(snapshot.version, 3)
+        self.assertEqual(list(snapshot.unmatched_offers), offers)
+
+    def test_reads_from_snapshot(self):
+        async def scenario():
+            async with self.matcher:
+                await self.matcher.new_offer(Offer.unmatched(spot_e11, hours(3, 6)))
+                before = self.matcher.get_unmatched_offers()
+                pending = self.matcher.new_offer(Offer.unmatched(spot_e21, hours(3, 6)))
+                self.assertIs(self.matcher.snapshot(), self.matcher.snapshot())
+                self.assertEqual(self.matcher.get_unmatched_offers(), before)
+                await pending
+                return before, self.matcher.get_unmatched_offers()
+
+        before, after = self.run_async(scenario())
+        self.assertEqual(before, [Offer.unmatched(spot_e11, hours(3, 6))])
+        self.assertEqual(after, before + [Offer.unmatched(spot_e21, hours(3, 6))])
+
+    def test_errors_go_to_their_future(self):
+        async def scenario():
+            async with self.matcher:
+                failing = self.matcher.new_request(None)
+                working = self.matcher.new_offer(Offer.unmatched(spot_e11, hours(3, 6)))
+                with self.assertRaises(AttributeError):
+                    await failing
+                return await working
+
+        self.assertIsNone(self.run_async(scenario()))
+        self.assertEqual(self.data.get_unmatched_offers(), [Offer.unmatched(spot_e11, hours(3, 6))])
+
+    def test_failed_transaction_fails_its_burst(self):
+        class FailingOnce(TestDataAccess):
+            depth = 0
+            failed = False
+
+            @contextmanager
+            def transaction(self):
+                self.depth += 1
+                try:
+                    yield
+                finally:
+                    self.depth -= 1
+                if self.depth == 0 and not self.failed:
+                    self.failed = True
+                    raise sqlite3.OperationalError("database is locked")  # on committing the first burst
+
+        matcher = AsyncApi(Api(FailingOnce([user_e1, user_nopark], [spot_e11])))
+
+        async def scenario():
+            async with matcher:
+                first = matcher.new_request(Request(user_nopark, today(4), today(5), "etap1"))
+                second = matcher.new_offer(Offer.unmatched(spot_e11, hours(7, 9)))
+                with self.assertRaises(sqlite3.OperationalError):
+                    await first
+                with self.assertRaises(sqlite3.OperationalError):
+                    await second
+                return await matcher.new_offer(Offer.unmatched(spot_e11, hours(10, 12)))
+
+        self.assertIsNone(self.run_async(asyncio.wait_for(scenario(), 5)))
+
+    def test_failing_change_leaves_nothing_on_db(self):
+        class FailingHalfway(DBDataAccess):
+            def add_offer(self, offer):
+                if offer == Offer.unmatched(spot_e11, hours(5, 6)):
+                    raise sqlite3.IntegrityError("failing after the matched offer was added")
+                super().add_offer(offer)
+
+        data = FailingHalfway(":memory:", [user_e1, user_e2, user_nopark], [spot_e11, spot_e21])
+        matcher = AsyncApi(Api(data))
+        request = Request(user_nopark, today(4), today(5), "etap1")
+
+        async def scenario():
+            async with matcher:
+                await matcher.new_request(request)
+                failing = matcher.new_offer(Offer.unmatched(spot_e11, hours(3, 6)))
+                working = matcher.new_offer(Offer.unmatched(spot_e21, hours(3, 6)))
+                with self.assertRaises(sqlite3.IntegrityError):
+                    await failing
+                return await working
+
+        self.assertIsNone(self.run_async(asyncio.wait_for(scenario(), 5)))
+        self.assertEqual(data.get_request_queue(), [request])
+        self.assertEqual(data.get_matched_offers(), [])
+        self.assertEqual(data.get_unmatched_offers(), [Offer.unmatched(spot_e21, hours(3, 6))])
+
+    def test_reads_while_burst_applied(self):
+        applying, release = threading.Event(), threading.Event()
+
+        class SlowApi(Api):
+            def new_offer(self, offer):
+                applying.set()
+                release.wait(5)
+                return super().new_offer(offer)
+
+        matcher = AsyncApi(SlowApi(self.data))
+
+        async def scenario():
+            async with matcher:
+                pending = matcher.new_offer(Offer.unmatched(spot_e11, hours(3, 6)))
+                while not applying.is_set():
+                    await asyncio.sleep(0.01)
+                during = matcher.get_unmatched_offers()  # the event loop runs while the burst is applied
+                release.set()
+                await pending
+                return during, matcher.get_unmatched_offers()
+
+        self.assertEqual(self.run_async(asyncio.wait_for(scenario(), 5)),
+                         ([], [Offer.unmatched(spot_e11, hours(3, 6))]))
+
+    def test_not_started(self):
+        async def scenario():
+            with self.assertRaises(AttributeError):
+                self.matcher.new_offer(Offer.unmatched(spot_e11, hours(3, 6)))
+
+        self.run_async(scenario())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import unittest
+from parkingmatcher.parkingmatcher import Api, Offer, Request, TestDataAccess
+from test_parkingmatcher import hours, today, tomorrow, spot_e11, spot_e21, spot_e22, spot_out1, user_e1, user_e2, \
+    user_oute2, user_nopark
+
+try:
+    from parkingmatcher.availability import Availability
+except ImportError:
+    Availability = None
+
+
+@unittest.skipIf(Availability is None, "numpy not installed")
+class AvailabilityTest(unittest.TestCase):
+    def setUp(self):
+        data = TestDataAccess([user_e1, user_e2, user_oute2, user_nopark], [spot_e11, spot_e21, spot_e22, spot_out1])
+        api = Api(data)
+        api.new_offer(Offer.unmatched(spot_e11, hours(2, 6)))
+        api.new_offer(Offer.unmatched(spot_e21, hours(0, 30)))
+        api.new_offer(Offer.unmatched(spot_e22, hours(3, 5)))
+        api.new_request(Request(user_nopark, today(4), today(8), "etap2"))
+        self.availability = Availability(data)
+
+    def test_zones(self):
+        self.assertEqual(Availability.zones, ["etap1", "etap2", "outside"])
+
+    def test_free(self):
+        free = self.availability.free(today(1), today(9))
+        self.assertEqual(free.shape, (3, 8))
+        self.assertEqual(free[0].tolist(), [0, 1, 1, 1, 1, 0, 0, 0])
+        self.assertEqual(free[1].tolist(), [1, 1, 2, 1, 0, 0, 0, 1])
+        self.assertEqual(free[2].tolist(), [0] * 8)
+
+    def test_taken(self):
+        taken = self.availability.taken(today(1), today(9))
+        self.assertEqual(taken[1].tolist(), [0, 0, 0, 1, 1, 1, 1, 0])
+        self.assertEqual(taken[0].sum() + taken[2].sum(), 0)
+
+    def test_window_clips_offers(self):
+        self.assertEqual(self.availability.free(tomorrow(5), tomorrow(8))[1].tolist(), [1, 0, 0])
+        self.assertEqual(self.availability.free(tomorrow(8), tomorrow(8)).shape, (3, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
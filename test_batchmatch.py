@@ -0,0 +1,120 @@
+import random
+import unittest
+from itertools import product
+from parkingmatcher.batchmatch import BatchMatcher
+from parkingmatcher.parkingmatcher import Api, Offer, Request, TestDataAccess
+from test_parkingmatcher import hours, today, spot_e11, spot_e21, spot_e22, user_e1, user_e2, user_oute2, user_nopark
+
+
+class BatchMatcherTest(unittest.TestCase):
+    def setUp(self):
+        # one by one, the first request takes the shorter offer and leaves the second one nowhere to go
+        self.offers = [Offer.unmatched(spot_e21, hours(0, 6)), Offer.unmatched(spot_e22, hours(3, 12))]
+        self.first = Request(user_nopark, today(3), today(5), "etap2", today(1))
+        self.second = Request(user_e1, today(0), today(4), "etap2", today(2))
+
+    def test_greedy(self):
+        plan = BatchMatcher(self.offers, [self.first, self.second]).greedy()
+        self.assertEqual(plan.assignments, [(self.first, 0)])
+        self.assertEqual(plan.hours, 2)
+
+    def test_plan_assigns_more(self):
+        plan = BatchMatcher(self.offers, [self.first, self.second]).plan()
+        self.assertEqual(sorted(plan.assignments, key=lambda a: a[1]), [(self.second, 0), (self.first, 1)])
+        self.assertEqual(plan.hours, 6)
+        self.assertEqual(plan.gain(), 4)
+        self.assertEqual(plan.free, {0: [hours(4, 6)], 1: [hours(5, 12)]})
+
+    def test_plan_by_when_requested(self):
+        later = Request(user_e1, today(0), today(6), "etap2", today(2))
+        plan = BatchMatcher(self.offers[:1], [later, self.first]).plan(by_when_requested=True)
+        self.assertEqual(plan.assignments, [(self.first, 0)])
+
+    def test_plan_never_assigns_less_than_greedy(self):
+        offers = [Offer.unmatched(spot_e21, hours(9, 15)), Offer.unmatched(spot_e22, hours(7, 14))]
+        requests = [Request(user_nopark, today(begin), today(end), "etap2", today(i))
+                    for i, (begin, end) in enumerate([(12, 15), (12, 16), (2, 6), (10, 14), (12, 17)])]
+        plan = BatchMatcher(offers, requests).plan()
+        self.assertEqual(plan.hours, 7)
+        self.assertEqual(plan.gain(), 0)
+        rand = random.Random(7)
+        for _ in range(200):
+            offers = [Offer.unmatched(spot, hours(begin, begin + rand.randrange(1, 10)))
+                      for spot, begin in [(spot_e21, rand.randrange(0, 12)), (spot_e22, rand.randrange(0, 12))]]
+            requests = [Request(user_nopark, today(begin), today(begin + rand.randrange(1, 6)), "etap2", today(i))
+                        for i, begin in enumerate(rand.randrange(0, 18) for _ in range(5))]
+            self.assertTrue(BatchMatcher(offers, requests).plan().gain() >= 0)
+
+    def test_plan_against_best_possible(self):
+        rand = random.Random(11)
+        for _ in range(100):
+            offers = [Offer.unmatched(spot, hours(begin, begin + rand.randrange(2, 12)))
+                      for spot, begin in [(spot, rand.randrange(0, 12)) for spot in [spot_e11, spot_e21, spot_e22]]]
+            requests = [Request(user_nopark, today(begin), today(begin + rand.randrange(1, 6)),
+                                rand.choice(["etap1", "etap2", "etap1,etap2"]), today(i))
+                        for i, begin in enumerate(rand.randrange(0, 18) for _ in range(6))]
+            plan = BatchMatcher(offers, requests).plan()
+            for position, offer in enumerate(offers):
+                assigned = [request for request, at in plan.assignments if at == position]
+                self.assertTrue(all(offer.spot.zone in req.zones and offer.period.contains(req.period)
+                                    for req in assigned))
+                self.assertFalse(any(first.period.intersects(second.period)
+                                     for i, first in enumerate(assigned) for second in assigned[i + 1:]))
+            # not guaranteed in general, but reached on these small cases
+            self.assertEqual(plan.hours, self.best_possible_hours(offers, requests))
+
+    @staticmethod
+    def best_possible_hours(offers, requests):
+        """
+        Most hours any plan could assign, trying every way of placing the requests
+        """
+        fitting = [[None] + [position for position, offer in enumerate(offers)
+                             if offer.spot.zone in request.zones and offer.period.contains(request.period)]
+                   for request in requests]
+        best = 0
+        for positions in product(*fitting):
+            placed = [(request, position) for request, position in zip(requests, positions) if position is not None]
+            if not any(first[1] == second[1] and first[0].period.intersects(second[0].period)
+                       for i, first in enumerate(placed) for second in placed[i + 1:]):
+                best = max(best, sum(request.period.length() for request, _ in placed))
+        return best
+
+    def test_respects_zones(self):
+        plan = BatchMatcher([Offer.unmatched(spot_e11, hours(0, 12))], [self.first, self.second]).plan()
+        self.assertEqual(plan.assignments, [])
+        self.assertEqual(plan.gain(), 0)
+
+
+class ApiBatchMatchTest(unittest.TestCase):
+    def setUp(self):
+        self.data = TestDataAccess([user_e1, user_e2, user_oute2, user_nopark], [spot_e11, spot_e21, spot_e22])
+        self.api = Api(self.data)
+
+    def test_batch_match(self):
+        # given
+        self.api.new_offer(Offer.unmatched(spot_e21, hours(0, 6)))
+        self.api.new_offer(Offer.unmatched(spot_e22, hours(3, 12)))
+        first = Request(user_nopark, today(3), today(5), "etap2", today(1))
+        second = Request(user_e1, today(0), today(4), "etap2", today(2))
+        for request in [first, second]:
+            self.data.add_request(request)
+        # when
+        plan = self.api.batch_match()
+        # then
+        self.assertEqual(plan.gain(), 4)
+        self.assertEqual(self.data.get_request_queue(), [])
+        self.assertEqual(len(self.data.get_matched_offers()), 2)
+        self.assertTrue(Offer.matched_with(spot_e21, second) in self.data.get_matched_offers())
+        self.assertTrue(Offer.matched_with(spot_e22, first) in self.data.get_matched_offers())
+        self.assertEqual(sorted(self.data.get_unmatched_offers(), key=lambda off: off.period.begin),
+                         [Offer.unmatched(spot_e21, hours(4, 6)), Offer.unmatched(spot_e22, hours(5, 12))])
+
+    def test_batch_match_without_applying(self):
+        self.api.new_offer(Offer.unmatched(spot_e21, hours(0, 6)))
+        self.data.add_request(Request(user_nopark, today(3), today(5), "etap2"))
+        self.assertEqual(self.api.batch_match(apply=False).hours, 2)
+        self.assertEqual(len(self.data.get_request_queue()), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
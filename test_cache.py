@@ -0,0 +1,98 @@
+import random
+import unittest
+from parkingmatcher.cache import CachedDataAccess
+from parkingmatcher.parkingmatcher import Api, DBDataAccess, Offer, Request, Spot, TestDataAccess, User, parking_zones
+from test_parkingmatcher import hours, today, spot_e11, spot_e21, user_e1, user_e2, user_nopark
+from test_snapshot import workload
+
+
+class CachedDataAccessTest(unittest.TestCase):
+    def setUp(self):
+        self.data = CachedDataAccess(TestDataAccess([user_e1, user_e2, user_nopark], [spot_e11, spot_e21]))
+        self.api = Api(self.data)
+
+    def test_reuses_until_changed(self):
+        self.api.new_offer(Offer.unmatched(spot_e11, hours(3, 6)))
+        first = self.data.get_unmatched_offers()
+        first.append(None)
+        self.assertEqual(self.data.get_unmatched_offers(), [Offer.unmatched(spot_e11, hours(3, 6))])
+        self.assertEqual((self.data.hits, self.data.misses), (1, 1))
+        self.api.new_request(Request(user_nopark, today(4), today(5), "etap1"))
+        self.assertEqual(len(self.data.get_unmatched_offers()), 2)
+        self.assertEqual(self.data.get_matched_requests(), [Request(user_nopark, today(4), today(5), "etap1")])
+        self.assertEqual((self.data.hits, self.data.misses), (1, 3))
+
+    def test_queue_of_owner_depends_on_their_zones(self):
+        self.api.new_request(Request(user_nopark, today(4), today(5), "etap1"))
+        self.assertEqual(len(self.data.get_request_queue(user_e1)), 1)
+        self.api.new_request(Request(user_nopark, today(6), today(7), "etap2"))
+        self.assertEqual(len(self.data.get_request_queue(user_e1)), 1)
+        self.assertEqual(self.data.hits, 1)
+        self.api.new_request(Request(user_nopark, today(8), today(9), "etap1,outside"))
+        self.assertEqual(len(self.data.get_request_queue(user_e1)), 2)
+        self.assertEqual(len(self.data.get_request_queue(user_e1, today(8))), 1)
+        self.assertEqual(len(self.data.get_request_queue()), 3)
+        self.assertEqual(self.data.hits, 1)
+
+    def test_queue_sees_request_without_zones(self):
+        self.assertEqual(self.data.get_request_queue(), [])
+        self.api.new_request(Request(user_nopark, today(4), today(5), "nosuch"))
+        self.assertEqual(self.data.get_request_queue(), [Request(user_nopark, today(4), today(5), "nosuch")])
+        self.assertEqual(self.data.get_request_queue(user_e1), [])
+        self.api.cancel_request(Request(user_nopark, today(4), today(5), "nosuch"))
+        self.assertEqual(self.data.get_request_queue(), [])
+
+    def test_offers_for_spot_depend_on_the_spot(self):
+        self.api.new_offer(Offer.unmatched(spot_e11, hours(3, 6)))
+        self.assertEqual(self.data.get_offers_for_spot(spot_e11), [Offer.unmatched(spot_e11, hours(3, 6))])
+        self.api.new_offer(Offer.unmatched(spot_e21, hours(3, 6)))
+        self.assertEqual(self.data.get_offers_for_spot(spot_e11), [Offer.unmatched(spot_e11, hours(3, 6))])
+        self.assertEqual(self.data.hits, 1)
+        self.api.cancel_offer(Offer.unmatched(spot_e11, hours(3, 6)))
+        self.assertEqual(self.data.get_offers_for_spot(spot_e11), [])
+        self.assertEqual(self.data.hits, 1)
+
+    def test_least_recently_used_dropped(self):
+        data = CachedDataAccess(TestDataAccess([user_e1], [spot_e11]), size=2)
+        data.get_unmatched_offers()
+        data.get_matched_offers()
+        data.get_unmatched_offers()
+        data.get_request_queue()
+        data.get_unmatched_offers()
+        self.assertEqual(data.hits, 2)
+        data.get_matched_offers()
+        self.assertEqual(data.misses, 4)
+        with self.assertRaises(AttributeError):
+            CachedDataAccess(TestDataAccess([], []), size=0)
+
+    def test_rollback_drops_results(self):
+        data = CachedDataAccess(DBDataAccess(":memory:", [user_e1], [spot_e11]))
+        try:
+            with data.transaction():
+                data.add_offer(Offer.unmatched(spot_e11, hours(3, 12)))
+                self.assertEqual(len(data.get_unmatched_offers()), 1)
+                data.add_offer(Offer.unmatched(spot_e21, hours(3, 12)))
+            self.fail("Should raise AttributeError for a spot not stored")
+        except AttributeError:
+            self.assertEqual(data.get_unmatched_offers(), [])
+
+    def test_same_results_as_data_access(self):
+        rand = random.Random(24)
+        users = [User("owner%d" % i, "owner%d@lp.pl" % i) for i in range(6)]
+        spots = [Spot(sorted(parking_zones)[i % 3], i, owner) for i, owner in enumerate(users)]
+        calls = workload(rand, spots, 400)
+        plain = Api(TestDataAccess(users, spots))
+        cached = Api(CachedDataAccess(TestDataAccess(users, spots), size=8))
+        for method, argument in calls:
+            getattr(plain, method)(argument)
+            getattr(cached, method)(argument)
+            user = rand.choice(users)
+            for read in [lambda data: data.get_unmatched_offers(), lambda data: data.get_matched_offers(),
+                         lambda data: data.get_request_queue(), lambda data: data.get_request_queue(user),
+                         lambda data: data.get_offers_for_spot(spots[0])]:
+                self.assertEqual(read(cached.data), read(plain.data))
+        self.assertTrue(cached.data.hits > 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,194 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+from multiprocessing.connection import Client
+from parkingmatcher.cluster import ClusterNode, NotLeader, SharedStore
+from parkingmatcher.parkingmatcher import Api, Offer, Request, Spot, TestDataAccess, User, spot_key
+from test_parkingmatcher import hours, today
+
+authkey = b"parking cluster test"
+context = multiprocessing.get_context("spawn")  # nodes have threads running, which fork would not copy
+owners = [User("owner%d" % i, "owner%d@lp.pl" % i) for i in range(4)]
+spots = [Spot("etap1" if i % 2 else "etap2", i, owner) for i, owner in enumerate(owners)]
+
+
+def calls_in(zone, count):
+    """
+    Offers and requests of a single zone, so calls of different zones give the same data in any order
+    """
+    zone_spots = [spot for spot in spots if spot.zone == zone]
+    calls = []
+    for i in range(count):
+        begin = (i * 7) % 40
+        if i % 2:
+            calls.append(("new_offer", Offer.unmatched(zone_spots[i % len(zone_spots)], hours(begin, begin + 5))))
+        else:
+            period = hours(begin, begin + 2)
+            calls.append(("new_request", Request(User("%s%d" % (zone, i), "%s%d@lp.pl" % (zone, i)), period.begin,
+                                                 period.end, zone, today(0))))
+    return calls
+
+
+def state(node):
+    def key(off):
+        return spot_key(off.spot), off.period.begin_hour
+
+    return (sorted(node.get_unmatched_offers(), key=key), sorted(node.get_matched_offers(), key=key),
+            sorted(node.get_request_queue(), key=lambda req: req.requestor.email))
+
+
+def connect(node):
+    host, port = node.address.rsplit(":", 1)
+    return Client((host, int(port)), authkey=authkey)
+
+
+def run_node(dbfile, name, calls, connection, lease_seconds=2.0, snapshot_every=1000):
+    """
+    Runs the calls on a node of its own process, sends the results, then its state when asked
+    """
+    with ClusterNode(SharedStore(dbfile), name, owners, spots, authkey, lease_seconds=lease_seconds,
+                     snapshot_every=snapshot_every) as node:
+        connection.send((node.is_leader(), [getattr(node, method)(argument) for method, argument in calls]))
+        while connection.recv():
+            connection.send(state(node))
+
+
+class SharedStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.dbfile = os.path.join(self.directory, "cluster.db")
+        self.now = [1000.0, -50.0]  # clocks of the nodes, never compared with each other
+        self.first = SharedStore(self.dbfile, clock=lambda: self.now[0])
+        self.second = SharedStore(self.dbfile, clock=lambda: self.now[1])
+
+    def tearDown(self):
+        self.first.close()
+        self.second.close()
+        shutil.rmtree(self.directory)
+
+    def test_lease_and_fencing(self):
+        offer = Offer.unmatched(spots[0], hours(3, 6))
+        self.assertEqual(self.first.acquire("a", "127.0.0.1:1", 5), 1)
+        self.assertIsNone(self.second.acquire("b", "127.0.0.1:2", 5))
+        self.assertEqual(self.second.leader(), ("a", "127.0.0.1:1", 1))
+        self.assertEqual(self.first.append(1, "new_offer", offer), (1, True, None))
+        self.now[1] += 4
+        self.assertTrue(self.first.renew(1, 5))
+        self.now[1] += 4
+        self.assertEqual(self.second.leader(), ("a", "127.0.0.1:1", 1))  # renewed since seen
+        self.now[1] += 5
+        self.assertIsNone(self.second.leader())
+        self.assertEqual(self.second.acquire("b", "127.0.0.1:2", 5), 2)
+        self.assertFalse(self.first.renew(1, 5))
+        with self.assertRaises(NotLeader):
+            self.first.append(1, "new_offer", offer)
+        self.assertEqual(self.second.append(2, "cancel_offer", offer), (2, True, None))
+        self.assertEqual([position for position, _, _, _ in self.first.read(0)[1]], [1, 2])
+        self.second.release(2)
+        self.assertEqual(self.first.acquire("a", "127.0.0.1:1", 5), 3)
+
+    def test_call_logged_once(self):
+        offer = Offer.unmatched(spots[0], hours(3, 6))
+        self.first.acquire("a", "127.0.0.1:1", 5)
+        self.assertEqual(self.first.append(1, "new_offer", offer, "b 1", 1), (1, True, None))
+        self.assertEqual(self.first.append(1, "new_offer", offer, "b 1", 1), (1, False, None))
+        self.first.publish(1, TestDataAccess(owners, spots), 1, [("b 1", 1, b"outcome")])
+        self.assertEqual(self.first.append(1, "new_offer", offer, "b 1", 1), (1, False, b"outcome"))
+        self.assertEqual(self.first.append(1, "cancel_offer", offer, "b 1", 2), (2, True, None))
+        self.assertEqual(self.first.read(0)[1][-1][:3], (2, "b 1", 2))
+
+    def test_snapshot_replaces_calls(self):
+        node = ClusterNode(self.first, "a", owners, spots, authkey, snapshot_every=3)
+        node.step()
+        for method, argument in calls_in("etap1", 7):
+            getattr(node, method)(argument)
+        snapshot, operations = self.second.read(0)
+        self.assertIsNotNone(snapshot)
+        self.assertEqual([position for position, _, _, _ in operations], [7])
+        follower = ClusterNode(self.second, "b", owners, spots, authkey)
+        self.assertEqual(state(follower), state(node))
+        self.assertEqual(self.second.read(6), (None, operations))
+        node.close()
+        follower.close()
+
+    def test_forwarded_call_applied_once(self):
+        request = Request(owners[1], today(4), today(5), "etap2", today(0))
+        offer = Offer.unmatched(spots[0], hours(3, 6))
+        message = ("follower 1", 1, "new_offer", offer)
+        with ClusterNode(self.first, "a", owners, spots, authkey, snapshot_every=2) as node:
+            node.new_request(request)
+            with connect(node) as leader:
+                leader.send(message)
+                first = leader.recv()
+                leader.send(message)  # sent again after losing the answer
+                self.assertEqual(leader.recv(), first)
+        self.assertEqual(first, (True, (request, 2)))
+        with ClusterNode(self.second, "b", owners, spots, authkey) as node:  # taking over from the snapshot
+            self.assertTrue(node.is_leader())
+            with connect(node) as leader:
+                leader.send(message)
+                self.assertEqual(leader.recv(), first)
+            self.assertEqual(node.get_matched_offers(), [Offer.matched_with(spots[0], request)])
+            self.assertEqual(node.get_unmatched_offers(), [Offer.unmatched(spots[0], hours(3, 4)),
+                                                           Offer.unmatched(spots[0], hours(5, 6))])
+
+
+class ClusterNodeTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.dbfile = os.path.join(self.directory, "cluster.db")
+        self.processes = []
+
+    def tearDown(self):
+        for process in self.processes:
+            process.terminate()
+            process.join()
+        shutil.rmtree(self.directory)
+
+    def start_node(self, name, calls, **kwargs):
+        ours, theirs = context.Pipe()
+        process = context.Process(target=run_node, args=(self.dbfile, name, calls, theirs), kwargs=kwargs,
+                                  daemon=True)
+        process.start()
+        self.processes.append(process)
+        return ours
+
+    def test_followers_forward_to_leader(self):
+        with ClusterNode(SharedStore(self.dbfile), "leader", owners, spots, authkey, snapshot_every=10) as leader:
+            self.assertTrue(leader.is_leader())
+            calls = {"etap1": calls_in("etap1", 30), "etap2": calls_in("etap2", 30)}
+            followers = {zone: self.start_node(zone, zone_calls) for zone, zone_calls in calls.items()}
+            expected = Api(TestDataAccess(owners, spots))
+            for zone, connection in followers.items():
+                was_leader, results = connection.recv()
+                self.assertFalse(was_leader)
+                self.assertEqual(results, [getattr(expected, method)(argument) for method, argument in calls[zone]])
+            for connection in followers.values():
+                connection.send(True)
+                self.assertEqual(connection.recv(), state(leader))
+                connection.send(False)
+            self.assertEqual(state(leader), state(expected.data))
+
+    def test_follower_takes_over(self):
+        leader = self.start_node("first", calls_in("etap1", 10), lease_seconds=0.5)
+        self.assertTrue(leader.recv()[0])
+        with ClusterNode(SharedStore(self.dbfile), "second", owners, spots, authkey, lease_seconds=0.5) as node:
+            self.assertFalse(node.is_leader())
+            offer = Offer.unmatched(spots[0], hours(40, 44))
+            node.new_offer(offer)
+            self.assertIn(offer, node.get_unmatched_offers())
+            self.processes[0].terminate()
+            self.processes[0].join()
+            request = Request(owners[1], hours(41, 42).begin, hours(41, 42).end, "etap2", today(0))
+            self.assertEqual(node.new_request(request), offer)
+            self.assertTrue(node.is_leader())
+            expected = Api(TestDataAccess(owners, spots))
+            for method, argument in calls_in("etap1", 10) + [("new_offer", offer), ("new_request", request)]:
+                getattr(expected, method)(argument)
+            self.assertEqual(state(node), state(expected.data))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+from datetime import timedelta
+from parkingmatcher.compaction import Archive, Compaction, CompactingApi, Compactor
+from parkingmatcher.parkingmatcher import Api, DBDataAccess, Offer, Request, TestDataAccess
+from test_parkingmatcher import hours, today, spot_e11, spot_e21, user_e1, user_e2, user_nopark
+
+
+class CompactorTest(unittest.TestCase):
+    def setUp(self):
+        self.data = TestDataAccess([user_e1, user_e2, user_nopark], [spot_e11, spot_e21])
+        self.archive = Archive(":memory:")
+
+    def tearDown(self):
+        self.archive.close()
+
+    def fill(self, api):
+        matched = Request(user_nopark, today(4), today(5), "etap1", today(0))
+        api.new_request(matched)
+        api.new_offer(Offer.unmatched(spot_e11, hours(3, 6)))
+        api.new_offer(Offer.unmatched(spot_e21, hours(7, 12)))
+        api.new_request(Request(user_e1, today(2), today(6), "etap2", today(0)))
+        api.new_request(Request(user_e2, today(8), today(9), "etap1", today(0)))
+        return matched
+
+    def test_evicts_ended_and_archives_matched(self):
+        api = Api(self.data)
+        matched = self.fill(api)
+        compactor = Compactor(self.data, self.archive)
+        self.assertEqual(compactor.compact(today(6)), Compaction(2, 1, 1))
+        self.assertEqual(self.data.get_unmatched_offers(), [Offer.unmatched(spot_e21, hours(7, 12))])
+        self.assertEqual(self.data.get_matched_offers(), [])
+        self.assertEqual(self.data.get_request_queue(), [Request(user_e2, today(8), today(9), "etap1")])
+        history = self.archive.get_history()
+        self.assertEqual(history, [Offer.matched_with(spot_e11, matched)])
+        self.assertEqual(history[0].matched_request().when_requested, today(0))
+        self.assertEqual(self.archive.add(history), 0)
+        self.assertEqual(self.archive.count(), 1)
+
+    def test_horizon_keeps_recent(self):
+        self.fill(Api(self.data))
+        compactor = Compactor(self.data, self.archive, horizon=timedelta(hours=2))
+        self.assertEqual(compactor.compact(today(5)), Compaction(0, 0, 0))
+        self.assertEqual(compactor.compact(today(8)), Compaction(2, 1, 1))
+
+    def test_compacts_once_an_hour(self):
+        clock = [today(5)]
+        compactor = Compactor(self.data, self.archive, clock=lambda: clock[0])
+        api = CompactingApi(Api(self.data), compactor)
+        self.fill(api)
+        self.assertEqual(len(self.data.get_matched_offers()), 1)
+        clock[0] = today(6) + timedelta(minutes=30)
+        self.assertEqual(compactor.compact_if_due(), Compaction(2, 1, 1))
+        self.assertIsNone(compactor.compact_if_due(today(6) + timedelta(minutes=59)))
+        clock[0] = today(9) + timedelta(minutes=1)
+        api.new_request(Request(user_e1, today(10), today(11), "etap2", today(9)))
+        self.assertEqual(self.data.get_request_queue(), [])
+        self.assertEqual(self.data.get_matched_offers(), [Offer.matched_with(
+            spot_e21, Request(user_e1, today(10), today(11), "etap2"))])
+
+    def test_db_data_access(self):
+        data = DBDataAccess(":memory:", [user_e1, user_e2, user_nopark], [spot_e11, spot_e21])
+        self.fill(Api(data))
+        self.assertEqual(Compactor(data, self.archive).compact(today(6)), Compaction(2, 1, 1))
+        self.assertEqual(data.get_unmatched_offers(), [Offer.unmatched(spot_e21, hours(7, 12))])
+        self.assertEqual(data.get_matched_offers(), [])
+        self.assertEqual(data.get_request_queue(), [Request(user_e2, today(8), today(9), "etap1")])
+        self.assertEqual(len(self.archive.get_history(until=today(6))), 1)
+        self.assertEqual(self.archive.get_history(since=today(6)), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import random
+import sys
+import threading
+import unittest
+from datetime import timedelta
+from parkingmatcher.concurrentapi import ConcurrentApi
+from parkingmatcher.parkingmatcher import Offer, Request, Spot, TestDataAccess, User, parking_zones, spot_key
+from test_parkingmatcher import hours, today, spot_e11, spot_e21, user_e1, user_e2, user_nopark
+
+
+class ConcurrentApiTest(unittest.TestCase):
+    def setUp(self):
+        self.data = TestDataAccess([user_e1, user_e2, user_nopark], [spot_e11, spot_e21])
+        self.api = ConcurrentApi(self.data)
+
+    def assertUnlocked(self):
+        def lock_all():
+            with self.api.exclusive():
+                pass
+        locker = threading.Thread(target=lock_all)
+        locker.start()
+        locker.join(5)
+        self.assertFalse(locker.is_alive())
+
+    def test_offer_matching_request_in_more_zones(self):
+        request = Request(user_nopark, today(4), today(5), "etap2,etap1,outside")
+        self.api.new_request(request)
+        self.api.new_offer(Offer.unmatched(spot_e11, hours(3, 6)))
+        self.assertEqual(self.data.get_matched_requests(), [request])
+        self.assertEqual(self.data.get_request_queue(), [])
+        self.assertUnlocked()
+
+    def test_cancellations_match_again(self):
+        first = Request(user_nopark, today(4), today(5), "etap1", today(1))
+        second = Request(user_e2, today(4), today(5), "etap1", today(2))
+        self.api.new_request(first)
+        self.api.new_request(second)
+        self.api.new_offer(Offer.unmatched(spot_e11, hours(3, 6)))
+        self.api.cancel_request(first)
+        self.assertEqual(self.data.get_matched_requests(), [second])
+        self.api.cancel_offer(Offer.unmatched(spot_e11, hours(4, 5)))
+        self.assertEqual(self.data.get_request_queue(), [second])
+        self.assertEqual(self.data.get_matched_offers(), [])
+        self.assertUnlocked()
+
+    def test_stress(self):
+        zones = sorted(parking_zones)
+        owners = [User("owner%d" % i, "owner%d@lp.pl" % i) for i in range(6)]
+        spots = [Spot(zones[i % len(zones)], i, owner) for i, owner in enumerate(owners)]
+        api = ConcurrentApi(TestDataAccess(owners, spots))
+        rand = random.Random(16)
+        work = []
+        for thread in range(8):
+            calls = []
+            for i in range(150):
+                begin = rand.randrange(42)
+                period = hours(begin, begin + rand.randint(1, 6))
+                if rand.random() < 0.5:
+                    offer = Offer.unmatched(rand.choice(spots), period)
+                    calls.append((api.new_offer, offer))
+                    if rand.random() < 0.2:
+                        calls.append((api.cancel_offer, offer))
+                else:
+                    user = User("user%d_%d" % (thread, i), "user%d_%d@lp.pl" % (thread, i))
+                    request = Request(user, period.begin, period.end, rand.sample(zones, rand.randint(1, 3)),
+                                      today(0) + timedelta(seconds=len(calls)))
+                    calls.append((api.new_request, request))
+                    if rand.random() < 0.3:
+                        calls.append((api.cancel_request, request))
+            work.append(calls)
+        errors = []
+        writing = threading.Event()
+        writing.set()
+
+        def run(calls):
+            try:
+                for method, argument in calls:
+                    method(argument)
+            except Exception as e:
+                errors.append(e)
+
+        def read():
+            try:
+                while writing.is_set():
+                    api.get_unmatched_offers()
+                    api.get_matched_offers()
+                    api.get_request_queue()
+                    api.get_request_queue(owners[0])
+            except Exception as e:
+                errors.append(e)
+
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            readers = [threading.Thread(target=read) for _ in range(2)]
+            threads = [threading.Thread(target=run, args=(calls,)) for calls in work]
+            for thread in readers + threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            writing.clear()
+            for thread in readers:
+                thread.join()
+        finally:
+            sys.setswitchinterval(switch_interval)
+        self.assertEqual(errors, [])
+
+        with api.exclusive():
+            matched = api.data.get_matched_requests()
+            queued = api.data.get_request_queue()
+            self.assertEqual(len(matched), len(set(map(id, matched))))
+            self.assertFalse(set(map(id, matched)) & set(map(id, queued)))
+            cancelled = {id(argument) for calls in work for method, argument in calls
+                         if method == api.cancel_request}
+            requested = {id(argument) for calls in work for method, argument in calls if method == api.new_request}
+            self.assertLessEqual(set(map(id, matched)) | set(map(id, queued)), requested - cancelled)
+            for offer in api.data.get_matched_offers():
+                self.assertTrue(offer.matched_request().matches(offer))
+            by_spot = {}
+            for offer in api.data.get_unmatched_offers() + api.data.get_matched_offers():
+                by_spot.setdefault(spot_key(offer.spot), []).append(offer.period)
+            for periods in by_spot.values():
+                periods.sort(key=lambda per: per.begin_hour)
+                for earlier, later in zip(periods, periods[1:]):
+                    self.assertFalse(earlier.intersects(later))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+from datetime import datetime, timezone
+import json
+import sqlite3
+import unittest
+from parkingmatcher.ingest import ingest, read_jsonl, RecordParser
+from parkingmatcher.parkingmatcher import Api, DBDataAccess, Offer, Request, TestDataAccess
+from test_parkingmatcher import hours, today, spot_e11, spot_e21, user_e1, user_e2, user_nopark
+
+
+def offer_record(spot, begins, ends, **extra):
+    return dict(type="offer", zone=spot.zone, place=spot.place, begins=begins, ends=ends, **extra)
+
+
+def request_record(user, begins, ends, zones, **extra):
+    return dict(type="request", name=user.name, email=user.email, begins=begins, ends=ends, zones=zones, **extra)
+
+
+class IngestTest(unittest.TestCase):
+    def setUp(self):
+        self.data = TestDataAccess([user_e1, user_e2, user_nopark], [spot_e11, spot_e21])
+        self.api = Api(self.data)
+
+    def test_feed(self):
+        lines = [json.dumps(request_record(user_nopark, "2018-01-02T04", "2018-01-02T05", "etap1",
+                                           when_requested="2018-01-01T12:30:00")),
+                 "",
+                 json.dumps(offer_record(spot_e11, "2018-01-02T03", "2018-01-02T06")),
+                 json.dumps(request_record(user_e2, "2018-01-02T08", "2018-01-02T09", ["etap2", "etap1"])),
+                 json.dumps(request_record(user_e2, "2018-01-02T08", "2018-01-02T09", ["etap2", "etap1"],
+                                           cancel=True))]
+        report = ingest(lines, self.api, batch_size=2)
+        self.assertEqual((report.records, report.applied, report.rejected, report.batches), (4, 4, 0, 2))
+        matched = self.data.get_matched_requests()
+        self.assertEqual(matched, [Request(user_nopark, today(4), today(5), "etap1")])
+        self.assertIs(matched[0].requestor, user_nopark)
+        self.assertEqual(self.data.get_request_queue(), [])
+        self.assertTrue(report.records_per_sec > 0)
+
+    def test_rejected_record_leaves_nothing_on_db(self):
+        class FailingHalfway(DBDataAccess):
+            def add_offer(self, offer):
+                if offer == Offer.unmatched(spot_e11, hours(5, 6)):
+                    raise sqlite3.IntegrityError("failing after the matched offer was added")
+                super().add_offer(offer)
+
+        data = FailingHalfway(":memory:", [user_e1, user_e2, user_nopark], [spot_e11, spot_e21])
+        lines = [json.dumps(request_record(user_nopark, "2018-01-02T04", "2018-01-02T05", "etap1")),
+                 json.dumps(offer_record(spot_e11, "2018-01-02T03", "2018-01-02T06")),
+                 json.dumps(offer_record(spot_e21, "2018-01-02T03", "2018-01-02T06"))]
+        report = ingest(lines, Api(data))
+        self.assertEqual((report.applied, report.rejected), (2, 1))
+        self.assertEqual(data.get_request_queue(), [Request(user_nopark, today(4), today(5), "etap1")])
+        self.assertEqual(data.get_matched_offers(), [])
+        self.assertEqual(data.get_unmatched_offers(), [Offer.unmatched(spot_e21, hours(3, 6))])
+
+    def test_rejects(self):
+        lines = ["{not json",
+                 json.dumps(["a", "list"]),
+                 json.dumps({"type": "parking"}),
+                 json.dumps(offer_record(spot_e11, "2018-01-02T03", "2018-13-02T06")),
+                 json.dumps(dict(offer_record(spot_e11, "2018-01-02T03", "2018-01-02T06"), place="99")),
+                 json.dumps(request_record(user_e1, "2018-01-02T03", "2018-01-02T06", "nowhere")),
+                 json.dumps({"type": "request", "begins": "2018-01-02T03", "ends": "2018-01-02T06"}),
+                 json.dumps(offer_record(spot_e21, "2018-01-02T03", "2018-01-02T06"))]
+        report = ingest(lines, self.api, max_rejects=3)
+        self.assertEqual((report.records, report.applied, report.rejected), (8, 1, 7))
+        self.assertEqual([number for number, _ in report.rejects], [1, 2, 3])
+        self.assertTrue(report.rejects[0][1].startswith("invalid JSON"))
+        self.assertEqual(self.data.get_unmatched_offers(), [Offer.unmatched(spot_e21, hours(3, 6))])
+        parse = RecordParser([], [spot_e11])
+        for record, reason in [(lines[4], "unknown spot etap1/99"), (lines[5], "no known zones in 'nowhere'"),
+                               (lines[6], "missing 'email'")]:
+            with self.assertRaises(ValueError) as raised:
+                parse(json.loads(record))
+            self.assertEqual(str(raised.exception), reason)
+
+    def test_time_zone_of_when_requested(self):
+        lines = [json.dumps(request_record(user_nopark, "2018-01-02T04", "2018-01-02T05", "etap1",
+                                           when_requested="2018-01-01T10:00:00+02:00")),
+                 json.dumps(request_record(user_e2, "2018-01-02T04", "2018-01-02T05", "etap1",
+                                           when_requested="2018-01-01T12:00:00")),
+                 json.dumps(offer_record(spot_e11, "2018-01-02T03", "2018-01-02T06"))]
+        report = ingest(lines, self.api)
+        self.assertEqual((report.applied, report.rejected), (3, 0))
+        queued = self.data.get_request_queue() + self.data.get_matched_requests()
+        self.assertTrue(all(req.when_requested.tzinfo is None for req in queued))
+        self.assertEqual(RecordParser([], [])(json.loads(lines[0]))[1].when_requested,
+                         datetime(2018, 1, 1, 8, tzinfo=timezone.utc).astimezone().replace(tzinfo=None))
+
+    def test_reads_only_as_batches_are_applied(self):
+        read = []
+
+        def feed():
+            for hour in range(0, 46, 2):
+                read.append(hour)
+                period = hours(hour, hour + 1)
+                yield json.dumps(offer_record(spot_e21, period.begin.isoformat(), period.end.isoformat()))
+
+        progress = []
+        report = ingest(feed(), self.api, batch_size=5,
+                        on_batch=lambda rep: progress.append((rep.applied, len(read))))
+        self.assertEqual(progress[:3], [(5, 5), (10, 10), (15, 15)])
+        self.assertEqual(report.applied, 23)
+        self.assertEqual(report.batches, 5)
+
+    def test_read_jsonl(self):
+        self.assertEqual(list(read_jsonl(['{"a": 1}', "  ", "[2]"])), [(1, {"a": 1}, None), (3, [2], None)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+from parkingmatcher.metrics import Metrics, InstrumentedDataAccess
+from parkingmatcher.parkingmatcher import Api, Offer, Request, TestDataAccess
+from test_parkingmatcher import hours, today, spot_e11, spot_e21, user_e1, user_e2, user_nopark
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics()
+        self.data = TestDataAccess([user_e1, user_e2, user_nopark], [spot_e11, spot_e21])
+        self.api = Api(self.data, self.metrics)
+
+    def test_no_metrics_by_default(self):
+        api = Api(self.data)
+        self.assertIs(api.data, self.data)
+        api.new_offer(Offer.unmatched(spot_e11, hours(3, 6)))
+        self.assertEqual(self.metrics.calls, {})
+
+    def test_times_api_and_data_calls(self):
+        self.api.new_request(Request(user_nopark, today(4), today(5), "etap1"))
+        self.api.new_offer(Offer.unmatched(spot_e11, hours(3, 6)))
+        self.assertEqual(self.metrics.calls[("api", "new_offer")][0], 1)
+        self.assertEqual(self.metrics.calls[("api", "new_request")][0], 1)
+        self.assertEqual(self.metrics.calls[("data", "add_offer")][0], 3)
+        self.assertEqual(self.metrics.calls[("data", "get_offers_touching")][0], 1)
+        self.assertTrue(self.metrics.calls[("api", "new_offer")][1] > 0)
+
+    def test_counts_items(self):
+        self.api.new_offer(Offer.unmatched(spot_e11, hours(3, 6)))
+        self.api.new_offer(Offer.unmatched(spot_e11, hours(6, 8)))
+        self.api.new_request(Request(user_nopark, today(4), today(5), "etap1"))
+        self.api.new_request(Request(user_nopark, today(4), today(5), "etap2"))
+        self.assertEqual(self.metrics.items, {"offers_scanned": 1, "offers_glued": 1, "get_offers_touching_returned": 1,
+                                              "requests_matched": 1, "requests_queued": 1})
+
+    def test_prometheus(self):
+        self.api.new_offer(Offer.unmatched(spot_e11, hours(3, 6)))
+        exported = self.metrics.prometheus().splitlines()
+        self.assertIn("# TYPE parkingmatcher_call_seconds summary", exported)
+        self.assertIn('parkingmatcher_call_seconds_count{layer="api",call="new_offer"} 1', exported)
+        self.assertIn('parkingmatcher_items_total{item="offers_scanned"} 0', exported)
+        self.assertTrue(any(line.startswith('parkingmatcher_call_seconds_sum{layer="data",call="add_offer"} ')
+                            for line in exported))
+
+    def test_instrumented_data_access_passes_attributes(self):
+        instrumented = InstrumentedDataAccess(self.data, self.metrics)
+        self.assertIs(instrumented.spots, self.data.spots)
+        with instrumented.transaction():
+            instrumented.add_offer(Offer.unmatched(spot_e21, hours(3, 6)))
+        self.assertEqual(list(self.metrics.calls), [("data", "add_offer")])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+import os
+import random
+import shutil
+import tempfile
+import threading
+import unittest
+from parkingmatcher.oplog import LoggedApi, OperationLog, encode_call, read_records, Decoder, recover
+from parkingmatcher.parkingmatcher import Api, Offer, Request, Spot, TestDataAccess, User, parking_zones
+from test_parkingmatcher import hours, today, spot_e11, user_e1, user_nopark
+from test_snapshot import state, workload
+
+users = [User("owner%d" % i, "owner%d@lp.pl" % i) for i in range(6)]
+spots = [Spot(sorted(parking_zones)[i % 3], "m%d" % i, owner) for i, owner in enumerate(users)]
+
+
+class OperationLogTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.log_path = os.path.join(self.directory, "operations.log")
+        self.snapshot_path = os.path.join(self.directory, "state.snapshot")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def logged_api(self, durable=True, batch_size=100):
+        return LoggedApi(Api(TestDataAccess(users, spots)), OperationLog(self.log_path, batch_size), durable)
+
+    def test_records(self):
+        offer = Offer.unmatched(spot_e11, hours(3, 6))
+        request = Request(user_nopark, today(4), today(5), "etap1,outside", today(1))
+        decode = Decoder([user_e1], [spot_e11])
+        for method, argument in [("new_offer", offer), ("cancel_offer", offer), ("new_request", request),
+                                 ("cancel_request", request)]:
+            record = encode_call(method, argument)
+            decoded_method, decoded = decode(record[4:-4])
+            self.assertEqual((decoded_method, decoded), (method, argument))
+        self.assertIs(decode(encode_call("new_offer", offer)[4:-4])[1].spot, spot_e11)
+        self.assertEqual(decode(encode_call("new_request", request)[4:-4])[1].when_requested, today(1))
+        with self.assertRaises(AttributeError):
+            encode_call("batch_match", offer)
+
+    def test_recover_from_log(self):
+        api = self.logged_api()
+        calls = workload(random.Random(20), spots, 200)
+        for method, argument in calls:
+            getattr(api, method)(argument)
+        api.log.close()
+        recovered = recover(self.snapshot_path, OperationLog(self.log_path), users, spots)
+        self.assertEqual(state(recovered.data), state(api.data))
+
+    def test_recover_from_snapshot_and_tail(self):
+        api = self.logged_api()
+        rand = random.Random(2020)
+        for method, argument in workload(rand, spots, 200):
+            getattr(api, method)(argument)
+        api.checkpoint(self.snapshot_path)
+        checkpoint = api.log.position
+        tail = workload(rand, spots, 50, 200)
+        for method, argument in tail:
+            getattr(api, method)(argument)
+        api.log.close()
+        self.assertEqual(len(list(read_records(self.log_path, checkpoint))), len(tail))
+        recovered = recover(self.snapshot_path, OperationLog(self.log_path))
+        self.assertEqual(state(recovered.data), state(api.data))
+
+    def test_cut_record_is_dropped(self):
+        api = self.logged_api()
+        api.new_offer(Offer.unmatched(spots[0], hours(3, 6)))
+        api.log.close()
+        size = os.path.getsize(self.log_path)
+        with open(self.log_path, "ab") as log:
+            log.write(encode_call("new_offer", Offer.unmatched(spots[0], hours(7, 9)))[:-3])
+        log = OperationLog(self.log_path)
+        self.assertEqual(log.position, size)
+        self.assertEqual(os.path.getsize(self.log_path), size)
+        recovered = recover(self.snapshot_path, log, users, spots)
+        self.assertEqual(recovered.data.get_unmatched_offers(), [Offer.unmatched(spots[0], hours(3, 6))])
+
+    def test_damaged_record_before_others(self):
+        api = self.logged_api()
+        api.new_offer(Offer.unmatched(spots[0], hours(3, 6)))
+        api.new_offer(Offer.unmatched(spots[0], hours(7, 9)))
+        api.log.close()
+        with open(self.log_path, "ab") as log:
+            log.write(b"\0" * 16)  # never written before a crash
+        self.assertEqual(len(list(read_records(self.log_path))), 2)
+        with open(self.log_path, "r+b") as log:
+            log.seek(8)
+            byte = log.read(1)
+            log.seek(8)
+            log.write(bytes([byte[0] ^ 1]))
+        with self.assertRaises(ValueError):
+            list(read_records(self.log_path))
+        with self.assertRaises(ValueError):
+            OperationLog(self.log_path)
+
+    def test_failing_calls(self):
+        api = self.logged_api()
+        with self.assertRaises(AttributeError):
+            api.new_request(None)
+        api.new_offer(Offer.unmatched(spots[0], hours(3, 6)))
+        api.log.close()
+        self.assertEqual(len(list(read_records(self.log_path))), 1)
+
+        class FailingApi(Api):
+            def new_offer(self, offer):
+                raise AttributeError("failing now")
+
+        with self.assertRaises(AttributeError):
+            OperationLog(self.log_path).replay(FailingApi(TestDataAccess(users, spots)))
+
+    def test_long_text(self):
+        request = Request(User("x" * 70000, "long@lp.pl"), today(4), today(5), "etap1", today(1))
+        decoded = Decoder()(encode_call("new_request", request)[4:-4])[1]
+        self.assertEqual(decoded.requestor.name, request.requestor.name)
+
+    def test_batches(self):
+        api = self.logged_api(durable=False, batch_size=10)
+        for hour in range(0, 46, 2):
+            api.new_offer(Offer.unmatched(spots[0], hours(hour, hour + 1)))
+        self.assertEqual(api.log.syncs, 2)
+        self.assertEqual(api.log.unsynced(), 3)
+        api.log.close()
+        self.assertEqual(api.log.syncs, 3)
+        self.assertEqual(len(list(read_records(self.log_path))), 23)
+
+    def test_group_commit(self):
+        api = self.logged_api()
+        rand = random.Random(200)
+        work = [workload(rand, spots, 50, 50 * thread) for thread in range(8)]
+        threads = [threading.Thread(target=lambda calls: [getattr(api, m)(a) for m, a in calls], args=(calls,))
+                   for calls in work]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        calls = sum(map(len, work))
+        self.assertEqual(len(list(read_records(self.log_path))), calls)
+        self.assertLessEqual(api.log.syncs, calls)
+        self.assertEqual(api.log.unsynced(), 0)
+        recovered = recover(self.snapshot_path, OperationLog(self.log_path), users, spots)
+        self.assertEqual(state(recovered.data), state(api.data))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,3 +1,7 @@
+import os
+import random
+import shutil
+import tempfile
 import unittest
 from parkingmatcher.parkingmatcher import *
 
@@ -23,6 +27,14 @@ class UtilTest(unittest.TestCase):
         self.assertEqual(self.expected, date_hour("2018-01-02T03:04"))
         self.assertEqual(self.expected, date_hour(" 2018-01-02T03:04"))
 
+    def test_datehour_loose_format(self):
+        self.assertEqual(self.expected, date_hour("2018-1-2T3"))
+
+    def test_datehour_malformed(self):
+        for malformed in ["2018-13-02T03", "2018-02-30T03", "2018-01-02 03", "2018-01-02T25", "nonsense", ""]:
+            with self.assertRaises(ValueError):
+                date_hour(malformed)
+
     def test_datehour_from_datetime(self):
         self.assertEqual(self.expected, date_hour(datetime(2018, 1, 2, 3)))
         self.assertEqual(self.expected, date_hour(datetime(2018, 1, 2, 3, 4)))
@@ -31,6 +43,14 @@ class UtilTest(unittest.TestCase):
 
 
 class PeriodTest(unittest.TestCase):
+    def test_hours_since_epoch(self):
+        period = hours(3, 30)
+        self.assertEqual(period.begin, today(3))
+        self.assertEqual(period.end, tomorrow(6))
+        self.assertEqual(period.end_hour - period.begin_hour, 27)
+        self.assertEqual(Period.from_hours(period.begin_hour, period.end_hour), period)
+        self.assertEqual(hours_since_epoch(datetime(1970, 1, 2, 5)), 29)
+
     def test_length(self):
         self.assertEqual(3, hours(3, 6).length())
         self.assertEqual(3, hours(6, 3).length())
@@ -160,6 +180,28 @@ class SpotTest(unittest.TestCase):
             self.assertIsNone(spot)
 
 
+class RegistryTest(unittest.TestCase):
+    def test_interns_users_and_spots(self):
+        owner = User("owner", "owner@lp.pl")
+        spot = Spot("etap1", 7, owner)
+        registry = Registry([owner], [spot])
+        self.assertIs(registry.user("other name", "owner@lp.pl"), owner)
+        self.assertIs(registry.spot("etap1", "7", User("owner", "owner@lp.pl")), spot)
+        self.assertIs(registry.get_spot("etap1", 7), spot)
+        self.assertIsNone(registry.get_spot("etap2", 7))
+        added = registry.spot("etap2", 7, User("owner", "owner@lp.pl"))
+        self.assertIs(added.owner, owner)
+        self.assertIs(registry.get_user("owner@lp.pl"), owner)
+        self.assertEqual(registry.spots_of(User("owner", "owner@lp.pl")), [spot, added])
+        self.assertEqual(registry.zones_of(owner), {"etap1", "etap2"})
+        self.assertEqual(registry.spots_of(User("nobody", "nobody@lp.pl")), [])
+
+    def test_no_instance_dict(self):
+        owner = User("owner", "owner@lp.pl")
+        self.assertFalse(hasattr(owner, "__dict__"))
+        self.assertFalse(hasattr(Spot("etap1", 7, owner), "__dict__"))
+
+
 class RequestTest(unittest.TestCase):
     def test_filter_zones(self):
         request = Request(User("test", "test"), "2018-01-01T01", "2018-01-01T01", ["etap1", "nosuch"])
@@ -185,8 +227,11 @@ api = Api(api_test_data)
 
 
 class ApiTest(unittest.TestCase):
+    data = api_test_data
+    api = api
+
     def tearDown(self):
-        api_test_data.clear()
+        self.data.clear()
 
     def assertListEqualContents(self, list1, list2):
         self.assertEqual(len(list1), len(list2))
@@ -195,82 +240,94 @@ class ApiTest(unittest.TestCase):
 
     def test_new_offer_no_requests(self):
         # given
-        self.assertEqual(len(api_test_data.get_request_queue()), 0)
+        self.assertEqual(len(self.data.get_request_queue()), 0)
         # when
         unmatched = Offer.unmatched(spot_e11, hours(3, 12))
-        api.new_offer(unmatched)
+        self.api.new_offer(unmatched)
         # then
-        self.assertEqual(api_test_data.get_unmatched_offers(), [unmatched])
-        self.assertEqual(api_test_data.get_matched_offers(), [])
+        self.assertEqual(self.data.get_unmatched_offers(), [unmatched])
+        self.assertEqual(self.data.get_matched_offers(), [])
 
     def test_new_offer_none_matching(self):
         # given
-        api.new_request(Request(user_nopark, today(2), today(6), "etap1"))
-        api.new_request(Request(user_nopark, today(10), today(16), "etap1"))
-        api.new_request(Request(user_nopark, today(4), today(12), "etap2"))
-        self.assertEqual(len(api_test_data.get_request_queue()), 3)
+        self.api.new_request(Request(user_nopark, today(2), today(6), "etap1"))
+        self.api.new_request(Request(user_nopark, today(10), today(16), "etap1"))
+        self.api.new_request(Request(user_nopark, today(4), today(12), "etap2"))
+        self.assertEqual(len(self.data.get_request_queue()), 3)
         # when
         unmatched = Offer.unmatched(spot_e11, hours(5, 11))
-        api.new_offer(unmatched)
+        self.api.new_offer(unmatched)
+        # then
+        self.assertEqual(self.data.get_unmatched_offers(), [unmatched])
+        self.assertEqual(self.data.get_matched_offers(), [])
+        self.assertEqual(len(self.data.get_request_queue()), 3)
+
+    def test_new_offer_and_request_return_match(self):
+        # given
+        request = Request(user_nopark, today(5), today(7), "etap1")
+        self.assertIsNone(self.api.new_request(request))
+        # when
+        matched = self.api.new_offer(Offer.unmatched(spot_e11, hours(3, 12)))
         # then
-        self.assertEqual(api_test_data.get_unmatched_offers(), [unmatched])
-        self.assertEqual(api_test_data.get_matched_offers(), [])
-        self.assertEqual(len(api_test_data.get_request_queue()), 3)
+        self.assertEqual(matched, request)
+        self.assertIsNone(self.api.new_offer(Offer.unmatched(spot_e21, hours(3, 12))))
+        self.assertEqual(self.api.new_request(Request(user_nopark, today(4), today(6), "etap2")),
+                         Offer.unmatched(spot_e21, hours(3, 12)))
 
     def test_new_offer_matching(self):
         # given
-        api.new_request(Request(user_nopark, today(3), today(9), "etap2"))
+        self.api.new_request(Request(user_nopark, today(3), today(9), "etap2"))
         expected = Request(user_nopark, today(5), today(11), "etap2")
-        api.new_request(expected)
-        self.assertEqual(len(api_test_data.get_request_queue()), 2)
+        self.api.new_request(expected)
+        self.assertEqual(len(self.data.get_request_queue()), 2)
         # when
-        api.new_offer(Offer.unmatched(spot_e21, hours(4, 12)))
+        self.api.new_offer(Offer.unmatched(spot_e21, hours(4, 12)))
         # then
-        self.assertEqual(len(api_test_data.get_matched_offers()), 1)
-        self.assertEqual(api_test_data.get_matched_offers()[0].matched_request(), expected)
+        self.assertEqual(len(self.data.get_matched_offers()), 1)
+        self.assertEqual(self.data.get_matched_offers()[0].matched_request(), expected)
         expected_unmatched = [Offer.unmatched(spot_e21, hours(4, 5)), Offer.unmatched(spot_e21, hours(11, 12))]
-        self.assertListEqualContents(api_test_data.get_unmatched_offers(), expected_unmatched)
-        self.assertEqual(len(api_test_data.get_request_queue()), 1)
+        self.assertListEqualContents(self.data.get_unmatched_offers(), expected_unmatched)
+        self.assertEqual(len(self.data.get_request_queue()), 1)
 
     def test_disallow_new_offer_over_matched(self):
         # given
-        api.new_offer(Offer.unmatched(spot_e21, hours(5, 9)))
-        api.new_request(Request(user_nopark, today(5), today(9), "etap2"))
-        self.assertEqual(len(api_test_data.get_matched_offers()), 1)
-        self.assertEqual(len(api_test_data.get_request_queue()), 0)
-        self.assertEqual(len(api_test_data.get_unmatched_offers()), 0)
+        self.api.new_offer(Offer.unmatched(spot_e21, hours(5, 9)))
+        self.api.new_request(Request(user_nopark, today(5), today(9), "etap2"))
+        self.assertEqual(len(self.data.get_matched_offers()), 1)
+        self.assertEqual(len(self.data.get_request_queue()), 0)
+        self.assertEqual(len(self.data.get_unmatched_offers()), 0)
         # when
-        api.new_offer(Offer.unmatched(spot_e21, hours(2, 6)))
-        api.new_offer(Offer.unmatched(spot_e21, hours(4, 9)))
-        api.new_offer(Offer.unmatched(spot_e21, hours(4, 12)))
-        api.new_offer(Offer.unmatched(spot_e21, hours(5, 12)))
-        api.new_offer(Offer.unmatched(spot_e21, hours(6, 12)))
-        api.new_offer(Offer.unmatched(spot_e21, hours(6, 8)))
+        self.api.new_offer(Offer.unmatched(spot_e21, hours(2, 6)))
+        self.api.new_offer(Offer.unmatched(spot_e21, hours(4, 9)))
+        self.api.new_offer(Offer.unmatched(spot_e21, hours(4, 12)))
+        self.api.new_offer(Offer.unmatched(spot_e21, hours(5, 12)))
+        self.api.new_offer(Offer.unmatched(spot_e21, hours(6, 12)))
+        self.api.new_offer(Offer.unmatched(spot_e21, hours(6, 8)))
         # then
-        self.assertEqual(len(api_test_data.get_unmatched_offers()), 0)
+        self.assertEqual(len(self.data.get_unmatched_offers()), 0)
 
     def test_new_offer_expanding(self):
         # given
-        api.new_offer(Offer.unmatched(spot_e11, hours(1, 2)))
-        api.new_offer(Offer.unmatched(spot_e21, hours(1, 3)))
-        api.new_offer(Offer.unmatched(spot_e22, hours(2, 4)))
-        api.new_offer(Offer.unmatched(spot_out1, hours(3, 4)))
-        api.new_offer(Offer.unmatched(spot_e11, hours(6, 9)))
-        api.new_offer(Offer.unmatched(spot_e21, hours(6, 9)))
-        api.new_offer(Offer.unmatched(spot_e22, hours(6, 9)))
-        api.new_offer(Offer.unmatched(spot_out1, hours(6, 9)))
-        self.assertEqual(len(api_test_data.get_unmatched_offers()), 8)
+        self.api.new_offer(Offer.unmatched(spot_e11, hours(1, 2)))
+        self.api.new_offer(Offer.unmatched(spot_e21, hours(1, 3)))
+        self.api.new_offer(Offer.unmatched(spot_e22, hours(2, 4)))
+        self.api.new_offer(Offer.unmatched(spot_out1, hours(3, 4)))
+        self.api.new_offer(Offer.unmatched(spot_e11, hours(6, 9)))
+        self.api.new_offer(Offer.unmatched(spot_e21, hours(6, 9)))
+        self.api.new_offer(Offer.unmatched(spot_e22, hours(6, 9)))
+        self.api.new_offer(Offer.unmatched(spot_out1, hours(6, 9)))
+        self.assertEqual(len(self.data.get_unmatched_offers()), 8)
         # when
-        api.new_offer(Offer.unmatched(spot_e11, hours(2, 3)))
-        api.new_offer(Offer.unmatched(spot_e21, hours(2, 4)))
-        api.new_offer(Offer.unmatched(spot_e22, hours(1, 3)))
-        api.new_offer(Offer.unmatched(spot_out1, hours(2, 3)))
-        api.new_offer(Offer.unmatched(spot_e11, hours(5, 10)))
-        api.new_offer(Offer.unmatched(spot_e21, hours(5, 9)))
-        api.new_offer(Offer.unmatched(spot_e22, hours(6, 10)))
-        api.new_offer(Offer.unmatched(spot_out1, hours(7, 8)))
+        self.api.new_offer(Offer.unmatched(spot_e11, hours(2, 3)))
+        self.api.new_offer(Offer.unmatched(spot_e21, hours(2, 4)))
+        self.api.new_offer(Offer.unmatched(spot_e22, hours(1, 3)))
+        self.api.new_offer(Offer.unmatched(spot_out1, hours(2, 3)))
+        self.api.new_offer(Offer.unmatched(spot_e11, hours(5, 10)))
+        self.api.new_offer(Offer.unmatched(spot_e21, hours(5, 9)))
+        self.api.new_offer(Offer.unmatched(spot_e22, hours(6, 10)))
+        self.api.new_offer(Offer.unmatched(spot_out1, hours(7, 8)))
         # then
-        self.assertListEqualContents(api_test_data.get_unmatched_offers(),
+        self.assertListEqualContents(self.data.get_unmatched_offers(),
                                      [Offer.unmatched(spot_e11, hours(1, 3)),
                                       Offer.unmatched(spot_e21, hours(1, 4)),
                                       Offer.unmatched(spot_e22, hours(1, 4)),
@@ -282,84 +339,96 @@ class ApiTest(unittest.TestCase):
 
     def test_offer_expansion_matches_request(self):
         # given
-        api.new_offer(Offer.unmatched(spot_e21, hours(3, 6)))
-        api.new_request(Request(user_nopark, today(4), today(7), spot_e21.zone))
-        self.assertEqual(len(api_test_data.get_matched_offers()), 0)
-        self.assertEqual(len(api_test_data.get_request_queue()), 1)
+        self.api.new_offer(Offer.unmatched(spot_e21, hours(3, 6)))
+        self.api.new_request(Request(user_nopark, today(4), today(7), spot_e21.zone))
+        self.assertEqual(len(self.data.get_matched_offers()), 0)
+        self.assertEqual(len(self.data.get_request_queue()), 1)
         # when
-        api.new_offer(Offer.unmatched(spot_e21, hours(6, 7)))
+        self.api.new_offer(Offer.unmatched(spot_e21, hours(6, 7)))
         # then
-        self.assertEqual(len(api_test_data.get_matched_offers()), 1)
-        self.assertEqual(len(api_test_data.get_request_queue()), 0)
+        self.assertEqual(len(self.data.get_matched_offers()), 1)
+        self.assertEqual(len(self.data.get_request_queue()), 0)
 
     def test_new_offer_matching_multiple(self):
         # given
         later = date_hour(today(3))
-        api.new_request(Request(user_nopark, today(4), today(10), "etap2", later))
+        self.api.new_request(Request(user_nopark, today(4), today(10), "etap2", later))
         earlier = date_hour(today(2))
         expected = Request(user_nopark, today(5), today(11), "etap2", earlier)
-        api.new_request(expected)
-        self.assertEqual(len(api_test_data.get_request_queue()), 2)
+        self.api.new_request(expected)
+        self.assertEqual(len(self.data.get_request_queue()), 2)
         # when
-        api.new_offer(Offer.unmatched(spot_e21, hours(4, 12)))
+        self.api.new_offer(Offer.unmatched(spot_e21, hours(4, 12)))
         # then
-        self.assertEqual(api_test_data.get_matched_offers()[0].matched_request(), expected)
-        self.assertListEqualContents(api_test_data.get_unmatched_offers(),
+        self.assertEqual(self.data.get_matched_offers()[0].matched_request(), expected)
+        self.assertListEqualContents(self.data.get_unmatched_offers(),
                                      [Offer.unmatched(spot_e21, hours(4, 5)), Offer.unmatched(spot_e21, hours(11, 12))])
-        self.assertEqual(len(api_test_data.get_request_queue()), 1)
+        self.assertEqual(len(self.data.get_request_queue()), 1)
+
+    def test_new_offer_matching_multizone_request(self):
+        # given
+        request = Request(user_nopark, today(5), today(8), [spot_e11.zone, spot_out1.zone])
+        self.api.new_request(request)
+        # when
+        self.api.new_offer(Offer.unmatched(spot_out1, hours(5, 8)))
+        self.api.new_offer(Offer.unmatched(spot_e11, hours(5, 8)))
+        # then
+        self.assertEqual(self.data.get_matched_offers(), [Offer.matched_with(spot_out1, request)])
+        self.assertEqual(self.data.get_unmatched_offers(), [Offer.unmatched(spot_e11, hours(5, 8))])
+        self.assertEqual(len(self.data.get_request_queue()), 0)
 
     def test_new_request_no_offers(self):
         # given
-        self.assertEqual(len(api_test_data.get_unmatched_offers()), 0)
+        self.assertEqual(len(self.data.get_unmatched_offers()), 0)
         # when
         unmatched = Request(user_nopark, today(2), today(6), "etap1")
-        api.new_request(unmatched)
+        self.api.new_request(unmatched)
         # then
-        self.assertEqual(api_test_data.get_request_queue(), [unmatched])
-        self.assertEqual(api_test_data.get_matched_offers(), [])
+        self.assertEqual(self.data.get_request_queue(), [unmatched])
+        self.assertEqual(self.data.get_matched_offers(), [])
 
     def test_new_request_none_matching(self):
         # given
-        api.new_offer(Offer.unmatched(spot_e11, hours(2, 4)))
-        api.new_offer(Offer.unmatched(spot_e11, hours(5, 8)))
-        api.new_offer(Offer.unmatched(spot_e21, hours(2, 10)))
-        api.new_offer(Offer.unmatched(spot_out1, hours(3, 12)))
-        self.assertEqual(len(api_test_data.get_unmatched_offers()), 4)
+        self.api.new_offer(Offer.unmatched(spot_e11, hours(2, 4)))
+        self.api.new_offer(Offer.unmatched(spot_e11, hours(5, 8)))
+        self.api.new_offer(Offer.unmatched(spot_e21, hours(2, 10)))
+        self.api.new_offer(Offer.unmatched(spot_out1, hours(3, 12)))
+        self.assertEqual(len(self.data.get_unmatched_offers()), 4)
         # when
         unmatched = Request(user_nopark, today(3), today(6), spot_e11.zone)
-        api.new_request(unmatched)
+        self.api.new_request(unmatched)
         # then
-        self.assertEqual(api_test_data.get_request_queue(), [unmatched])
-        self.assertEqual(api_test_data.get_matched_offers(), [])
+        self.assertEqual(self.data.get_request_queue(), [unmatched])
+        self.assertEqual(self.data.get_matched_offers(), [])
 
     def test_new_request_matching(self):
         # given
-        api.new_offer(Offer.unmatched(spot_e11, hours(2, 4)))
-        api.new_offer(Offer.unmatched(spot_e21, hours(2, 10)))
-        self.assertEqual(len(api_test_data.get_unmatched_offers()), 2)
+        self.api.new_offer(Offer.unmatched(spot_e11, hours(2, 4)))
+        self.api.new_offer(Offer.unmatched(spot_e21, hours(2, 10)))
+        self.assertEqual(len(self.data.get_unmatched_offers()), 2)
         # when
         request = Request(user_nopark, today(3), today(6), spot_e21.zone)
-        api.new_request(request)
+        self.api.new_request(request)
         # then
-        self.assertEqual(len(api_test_data.get_request_queue()), 0)
-        self.assertEqual(api_test_data.get_matched_offers(), [Offer.matched_with(spot_e21, request)])
-        self.assertListEqualContents(api_test_data.get_unmatched_offers(),
+        self.assertEqual(len(self.data.get_request_queue()), 0)
+        self.assertEqual(self.data.get_matched_offers(), [Offer.matched_with(spot_e21, request)])
+        self.assertListEqualContents(self.data.get_unmatched_offers(),
                                      [Offer.unmatched(spot_e11, hours(2, 4)), Offer.unmatched(spot_e21, hours(2, 3)),
                                       Offer.unmatched(spot_e21, hours(6, 10))])
 
     def test_new_request_matching_multiple(self):
         # given
-        api.new_offer(Offer.unmatched(spot_e22, hours(2, 10)))
-        api.new_offer(Offer.unmatched(spot_e11, hours(2, 4)))
-        api.new_offer(Offer.unmatched(spot_e21, hours(3, 6)))
-        self.assertEqual(len(api_test_data.get_unmatched_offers()), 3)
+        self.api.new_offer(Offer.unmatched(spot_e22, hours(2, 10)))
+        self.api.new_offer(Offer.unmatched(spot_e11, hours(2, 4)))
+        self.api.new_offer(Offer.unmatched(spot_e21, hours(3, 6)))
+        self.assertEqual(len(self.data.get_unmatched_offers()), 3)
         # when
         request = Request(user_nopark, today(3), today(6), spot_e21.zone)
-        api.new_request(request)
+        self.api.new_request(request)
         # then
-        self.assertEqual(len(api_test_data.get_request_queue()), 0)
-        self.assertEqual(api_test_data.get_matched_offers(), [Offer.matched_with(spot_e21, request)])
-        self.assertListEqualContents(api_test_data.get_unmatched_offers(),
+        self.assertEqual(len(self.data.get_request_queue()), 0)
+        self.assertEqual(self.data.get_matched_offers(), [Offer.matched_with(spot_e21, request)])
+        self.assertListEqualContents(self.data.get_unmatched_offers(),
                                      [Offer.unmatched(spot_e22, hours(2, 10)), Offer.unmatched(spot_e11, hours(2, 4))])
 
     def test_get_offers_user_can_help_with(self):
@@ -371,93 +440,306 @@ class ApiTest(unittest.TestCase):
         req_etap2_or_outside = Request(user_nopark, tomorrow(10), tomorrow(14), [spot_e21.zone, spot_out1.zone])
         req_far_future = Request(user_nopark, today(4) + timedelta(days=8), today(6) + timedelta(days=8), spot_e11.zone)
         for req in [req_etap1, req_etap12, req_etap2, req_etap2_or_outside, req_outside, req_far_future]:
-            api.new_request(req)
+            self.api.new_request(req)
         # when
         week_future = today(0) + timedelta(days=7)
-        for_user_e1 = api.get_request_for_owner(user_e1, week_future)
-        for_user_e2 = api.get_request_for_owner(user_e2, week_future)
-        for_user_e2out = api.get_request_for_owner(user_oute2, week_future)
+        for_user_e1 = self.api.get_request_for_owner(user_e1, week_future)
+        for_user_e2 = self.api.get_request_for_owner(user_e2, week_future)
+        for_user_e2out = self.api.get_request_for_owner(user_oute2, week_future)
         # then
         self.assertListEqualContents(for_user_e1, [req_etap1, req_etap12])
         self.assertListEqualContents(for_user_e2, [req_etap12, req_etap2, req_etap2_or_outside])
         self.assertListEqualContents(for_user_e2out, [req_etap12, req_etap2, req_etap2_or_outside, req_outside])
 
+    def test_get_offers_user_can_help_with_until(self):
+        # given
+        ends_at_nine = Request(user_nopark, today(4), today(9), spot_e11.zone)
+        ends_at_ten = Request(user_nopark, today(4), today(10), spot_e11.zone)
+        next_week = Request(user_nopark, datetime.now() + timedelta(days=8), datetime.now() + timedelta(days=9),
+                            spot_e11.zone)
+        for req in [ends_at_nine, ends_at_ten, next_week]:
+            self.api.new_request(req)
+        # then
+        self.assertEqual(self.api.get_request_for_owner(user_e1, today(9) + timedelta(minutes=30)), [ends_at_nine])
+        self.assertEqual(self.api.get_request_for_owner(user_e1, today(10)), [ends_at_nine])
+        self.assertEqual(self.api.get_request_for_owner(user_e1), [ends_at_nine, ends_at_ten])
+        self.assertEqual(self.api.get_request_for_owner(user_e2), [])
+        self.assertEqual(self.data.get_request_queue(None, today(10)), [ends_at_nine])
+
     def test_delete_offer(self):
         # given
         unmatched = Offer.unmatched(spot_e21, hours(3, 6))
-        api.new_offer(unmatched)
-        self.assertEqual(len(api_test_data.get_unmatched_offers()), 1)
+        self.api.new_offer(unmatched)
+        self.assertEqual(len(self.data.get_unmatched_offers()), 1)
         # when
-        api.cancel_offer(unmatched)
+        self.api.cancel_offer(unmatched)
         # then
-        self.assertEqual(len(api_test_data.get_unmatched_offers()), 0)
+        self.assertEqual(len(self.data.get_unmatched_offers()), 0)
 
     def test_dont_delete_non_matching_offer(self):
         # given
         unmatched = Offer.unmatched(spot_e21, hours(3, 6))
-        api.new_offer(unmatched)
-        self.assertEqual(len(api_test_data.get_unmatched_offers()), 1)
+        self.api.new_offer(unmatched)
+        self.assertEqual(len(self.data.get_unmatched_offers()), 1)
         # when
-        api.cancel_offer(Offer.unmatched(spot_e21, hours(0, 1)))
-        api.cancel_offer(Offer.unmatched(spot_e21, hours(0, 3)))
-        api.cancel_offer(Offer.unmatched(spot_e21, hours(0, 5)))
-        api.cancel_offer(Offer.unmatched(spot_e21, hours(0, 6)))
-        api.cancel_offer(Offer.unmatched(spot_e21, hours(4, 6)))
-        api.cancel_offer(Offer.unmatched(spot_e21, hours(4, 8)))
-        api.cancel_offer(Offer.unmatched(spot_e22, hours(3, 6)))
-        self.assertEqual(api_test_data.get_unmatched_offers(), [unmatched])
+        self.api.cancel_offer(Offer.unmatched(spot_e21, hours(0, 1)))
+        self.api.cancel_offer(Offer.unmatched(spot_e21, hours(0, 3)))
+        self.api.cancel_offer(Offer.unmatched(spot_e21, hours(0, 5)))
+        self.api.cancel_offer(Offer.unmatched(spot_e21, hours(0, 6)))
+        self.api.cancel_offer(Offer.unmatched(spot_e21, hours(4, 6)))
+        self.api.cancel_offer(Offer.unmatched(spot_e21, hours(4, 8)))
+        self.api.cancel_offer(Offer.unmatched(spot_e22, hours(3, 6)))
+        self.assertEqual(self.data.get_unmatched_offers(), [unmatched])
 
     def test_delete_matched_offer(self):
         # given
-        api.new_request(Request(user_nopark, today(3), today(6), spot_e11.zone))
+        self.api.new_request(Request(user_nopark, today(3), today(6), spot_e11.zone))
         matched = Offer.unmatched(spot_e11, hours(3, 6))
-        api.new_offer(matched)
-        self.assertEqual(len(api_test_data.get_request_queue()), 0)
-        self.assertEqual(len(api_test_data.get_matched_offers()), 1)
+        self.api.new_offer(matched)
+        self.assertEqual(len(self.data.get_request_queue()), 0)
+        self.assertEqual(len(self.data.get_matched_offers()), 1)
         # when
-        api.cancel_offer(matched)
+        self.api.cancel_offer(matched)
         # then
-        self.assertEqual(len(api_test_data.get_matched_offers()), 0)
-        self.assertEqual(len(api_test_data.get_request_queue()), 1)
+        self.assertEqual(len(self.data.get_matched_offers()), 0)
+        self.assertEqual(len(self.data.get_request_queue()), 1)
 
     def test_cancel_unmatched_request(self):
         # given
         request = Request(user_nopark, today(5), today(9), spot_e21.zone)
-        api.new_request(request)
-        self.assertEqual(len(api_test_data.get_request_queue()), 1)
+        self.api.new_request(request)
+        self.assertEqual(len(self.data.get_request_queue()), 1)
         # when
-        api.cancel_request(request)
+        self.api.cancel_request(request)
         # then
-        self.assertEqual(len(api_test_data.get_request_queue()), 0)
+        self.assertEqual(len(self.data.get_request_queue()), 0)
 
     def test_cancel_matched_request(self):
         # given
         original_offer = Offer.unmatched(spot_e21, hours(3, 12))
-        api.new_offer(original_offer)
+        self.api.new_offer(original_offer)
         request = Request(user_nopark, today(5), today(9), spot_e21.zone)
-        api.new_request(request)
-        self.assertEqual(api_test_data.get_matched_offers(), [Offer.matched_with(spot_e21, request)])
-        self.assertEqual(len(api_test_data.get_unmatched_offers()), 2)
+        self.api.new_request(request)
+        self.assertEqual(self.data.get_matched_offers(), [Offer.matched_with(spot_e21, request)])
+        self.assertEqual(len(self.data.get_unmatched_offers()), 2)
         # when
-        api.cancel_request(request)
+        self.api.cancel_request(request)
         # then
-        self.assertEqual(len(api_test_data.get_matched_offers()), 0)
-        self.assertEqual(api_test_data.get_unmatched_offers(), [original_offer])
+        self.assertEqual(len(self.data.get_matched_offers()), 0)
+        self.assertEqual(self.data.get_unmatched_offers(), [original_offer])
 
     def test_cancel_request_new_takes_over(self):
         # given
-        api.new_offer(Offer.unmatched(spot_e11, hours(3, 12)))
+        self.api.new_offer(Offer.unmatched(spot_e11, hours(3, 12)))
+        first_request = Request(user_nopark, today(5), today(10), spot_e11.zone)
+        self.api.new_request(first_request)
+        second_request = Request(user_oute2, today(6), today(12), spot_e11.zone)
+        self.api.new_request(second_request)
+        self.assertEqual(self.data.get_matched_offers(), [Offer.matched_with(spot_e11, first_request)])
+        self.assertEqual(self.data.get_request_queue(), [second_request])
+        # when
+        self.api.cancel_request(first_request)
+        # then
+        self.assertEqual(self.data.get_matched_offers(), [Offer.matched_with(spot_e11, second_request)])
+        self.assertEqual(len(self.data.get_request_queue()), 0)
+
+    def test_deferred_matching_after_cancellations(self):
+        # given
+        self.api.new_offer(Offer.unmatched(spot_e11, hours(3, 12)))
         first_request = Request(user_nopark, today(5), today(10), spot_e11.zone)
-        api.new_request(first_request)
+        self.api.new_request(first_request)
         second_request = Request(user_oute2, today(6), today(12), spot_e11.zone)
-        api.new_request(second_request)
-        self.assertEqual(api_test_data.get_matched_offers(), [Offer.matched_with(spot_e11, first_request)])
-        self.assertEqual(api_test_data.get_request_queue(), [second_request])
+        self.api.new_request(second_request)
         # when
-        api.cancel_request(first_request)
+        with self.api.deferred_matching():
+            self.api.cancel_request(first_request)
+            self.assertEqual(self.data.get_matched_offers(), [])
+            self.assertEqual(self.data.get_request_queue(), [second_request])
         # then
-        self.assertEqual(api_test_data.get_matched_offers(), [Offer.matched_with(spot_e11, second_request)])
-        self.assertEqual(len(api_test_data.get_request_queue()), 0)
+        self.assertEqual(self.data.get_matched_offers(), [Offer.matched_with(spot_e11, second_request)])
+        self.assertEqual(self.data.get_unmatched_offers(), [Offer.unmatched(spot_e11, hours(3, 6))])
+        self.assertEqual(len(self.data.get_request_queue()), 0)
+
+    def test_deferred_matching_drops_cancelled(self):
+        # given
+        request = Request(user_nopark, today(3), today(6), spot_e21.zone)
+        self.api.new_request(request)
+        self.api.new_offer(Offer.unmatched(spot_e21, hours(3, 6)))
+        self.api.new_offer(Offer.unmatched(spot_e11, hours(2, 8)))
+        matched = Request(user_oute2, today(4), today(5), spot_e11.zone)
+        self.api.new_request(matched)
+        # when
+        with self.api.deferred_matching():
+            self.api.cancel_offer(Offer.unmatched(spot_e21, hours(3, 6)))
+            self.api.cancel_request(request)
+            self.api.cancel_request(matched)
+            self.api.cancel_offer(Offer.unmatched(spot_e11, hours(4, 5)))
+        # then
+        self.assertEqual(self.data.get_matched_offers(), [])
+        self.assertListEqualContents(self.data.get_unmatched_offers(), [Offer.unmatched(spot_e11, hours(2, 4)),
+                                                                        Offer.unmatched(spot_e11, hours(5, 8))])
+        self.assertEqual(self.data.get_request_queue(), [])
+
+    def test_bulk_load_same_as_one_by_one(self):
+        generator = random.Random(6)
+        spots = [spot_e11, spot_e21, spot_e22, spot_out1]
+        users = [user_e1, user_e2, user_oute2, user_nopark]
+        zones = sorted(parking_zones)
+
+        def random_period():
+            begin = generator.randrange(0, 40)
+            return hours(begin, begin + generator.randrange(0, 8))
+
+        def random_request(when):
+            period = random_period()
+            return Request(generator.choice(users), period.begin, period.end,
+                           generator.sample(zones, generator.randrange(1, 3)), today(0) + timedelta(minutes=when))
+
+        for _ in range(20):
+            stored = [Offer.unmatched(generator.choice(spots), random_period()) for _ in range(5)]
+            queued = [random_request(when) for when in range(5)]
+            offers = [Offer.unmatched(generator.choice(spots), random_period()) for _ in range(25)]
+            requests = [random_request(when) for when in range(25, 0, -1)]
+            one_by_one = TestDataAccess(users, spots)
+            for data in [one_by_one, self.data]:
+                data.clear()
+                for offer in stored:
+                    Api(data).new_offer(offer)
+                for request in queued:
+                    Api(data).new_request(request)
+            for offer in sorted(offers, key=lambda off: off.period.begin):
+                Api(one_by_one).new_offer(offer)
+            for request in sorted(requests, key=lambda req: req.when_requested):
+                Api(one_by_one).new_request(request)
+            self.api.bulk_load(offers, requests)
+            self.assertListEqualContents(self.data.get_unmatched_offers(), one_by_one.get_unmatched_offers())
+            self.assertListEqualContents(self.data.get_matched_offers(), one_by_one.get_matched_offers())
+            self.assertEqual(self.data.get_request_queue(), one_by_one.get_request_queue())
+
+    def test_bulk_load_keeps_touching_stored_offers_apart(self):
+        one_by_one = TestDataAccess([user_e1], [spot_e11])
+        for data in [one_by_one, self.data]:
+            data.add_offer(Offer.unmatched(spot_e11, hours(2, 6)))
+            data.add_offer(Offer.unmatched(spot_e11, hours(6, 7)))
+        Api(one_by_one).new_offer(Offer.unmatched(spot_e11, hours(1, 3)))
+        self.api.bulk_load([Offer.unmatched(spot_e11, hours(1, 3))], [])
+        self.assertListEqualContents(self.data.get_unmatched_offers(), one_by_one.get_unmatched_offers())
+        self.assertListEqualContents(self.data.get_unmatched_offers(), [Offer.unmatched(spot_e11, hours(1, 6)),
+                                                                        Offer.unmatched(spot_e11, hours(6, 7))])
+
+    def test_requestor_not_stored(self):
+        walkin = User("walkin", "walkin@lp.pl")
+        request = Request(walkin, today(4), today(5), "etap2")
+        self.api.new_request(request)
+        self.api.new_offer(Offer.unmatched(spot_e21, hours(3, 6)))
+        self.api.new_offer(Offer.unmatched(spot_e22, hours(3, 6)))
+        self.assertEqual(self.data.get_request_queue(), [])
+        self.assertEqual(self.data.get_matched_offers(), [Offer.matched_with(spot_e21, request)])
+        self.assertEqual(self.data.get_matched_offers()[0].matched_request().requestor, walkin)
+        self.assertListEqualContents(self.data.get_unmatched_offers(),
+                                     [Offer.unmatched(spot_e21, hours(3, 4)), Offer.unmatched(spot_e21, hours(5, 6)),
+                                      Offer.unmatched(spot_e22, hours(3, 6))])
+
+
+class DBApiTest(ApiTest):
+    data = DBDataAccess(":memory:", api_test_data.users, api_test_data.spots)
+    api = Api(data)
+
+
+class TestDataAccessTest(unittest.TestCase):
+    def setUp(self):
+        self.data = TestDataAccess([user_e1, user_nopark], [spot_e11])
+
+    def test_ids_and_hashes(self):
+        first, second = Offer.unmatched(spot_e11, hours(3, 6)), Offer.unmatched(spot_e11, hours(3, 6))
+        self.assertNotEqual(first.id, second.id)
+        self.assertEqual(hash(first), hash(second))
+        request = Request(user_nopark, today(3), today(6), "etap1")
+        self.assertEqual(hash(Offer.matched_with(spot_e11, request)),
+                         hash(Offer.matched_with(spot_e11, Request(user_nopark, today(3), today(6), ["etap1"]))))
+
+    def test_delete_equal_offers_one_at_a_time(self):
+        first, second = Offer.unmatched(spot_e11, hours(3, 6)), Offer.unmatched(spot_e11, hours(3, 6))
+        self.data.add_offer(first)
+        self.data.add_offer(Offer.unmatched(spot_e11, hours(7, 8)))
+        self.data.add_offer(second)
+        self.data.delete_offer(Offer.unmatched(spot_e11, hours(3, 6)))
+        self.assertIs(self.data.get_unmatched_offers()[1], second)
+        self.data.delete_offer(first)
+        self.data.delete_offer(first)
+        self.assertEqual(self.data.get_unmatched_offers(), [Offer.unmatched(spot_e11, hours(7, 8))])
+        self.assertEqual(self.data.get_offers_for_spot(spot_e11), [Offer.unmatched(spot_e11, hours(7, 8))])
+
+    def test_queue_membership(self):
+        request = Request(user_nopark, today(3), today(6), "etap1")
+        self.data.add_request(request)
+        self.assertTrue(self.data.is_queued(Request(user_nopark, today(3), today(6), "etap1")))
+        self.data.delete_request_from_queue(Request(user_nopark, today(3), today(6), "etap1"))
+        self.assertFalse(self.data.is_queued(request))
+        self.assertEqual(self.data.get_request_queue(), [])
+
+    def test_offers_matched_with(self):
+        request = Request(user_nopark, today(3), today(6), "etap1")
+        matched = Offer.matched_with(spot_e11, request)
+        self.data.add_offer(matched)
+        self.assertEqual(self.data.get_offers_matched_with(Request(user_nopark, today(3), today(6), "etap1")),
+                         [matched])
+        self.data.delete_offer(matched)
+        self.assertEqual(self.data.get_offers_matched_with(request), [])
+
+
+class DBDataAccessTest(unittest.TestCase):
+    def setUp(self):
+        self.dbfile = os.path.join(tempfile.mkdtemp(), "parking.db")
+        self.data = DBDataAccess(self.dbfile, [user_e1, user_nopark], [spot_e11])
+
+    def tearDown(self):
+        del self.data
+        shutil.rmtree(os.path.dirname(self.dbfile))
+
+    def test_wal_mode(self):
+        self.assertEqual(self.data.dbcon.execute("pragma journal_mode").fetchone()[0], "wal")
+        self.assertEqual(self.data.dbcon.execute("pragma synchronous").fetchone()[0], 1)
+
+    def test_wrong_synchronous(self):
+        with self.assertRaises(AttributeError):
+            DBDataAccess(self.dbfile, synchronous="sometimes")
+
+    def test_api_call_commits_once(self):
+        commits = []
+        self.data.dbcon.set_trace_callback(lambda statement: commits.append(statement) if statement == "commit" else 0)
+        api_on_db = Api(self.data)
+        api_on_db.new_request(Request(user_nopark, today(5), today(8), spot_e11.zone))
+        api_on_db.new_offer(Offer.unmatched(spot_e11, hours(3, 12)))
+        self.assertEqual(commits, ["commit", "commit"])
+        self.assertEqual(len(self.data.get_unmatched_offers()), 2)
+        self.assertEqual(len(self.data.get_matched_offers()), 1)
+
+    def test_rollback_on_error(self):
+        try:
+            with self.data.transaction():
+                self.data.add_offer(Offer.unmatched(spot_e11, hours(3, 12)))
+                self.data.add_offer(Offer.unmatched(spot_e21, hours(3, 12)))
+            self.fail("Should raise AttributeError for a spot not stored")
+        except AttributeError:
+            self.assertEqual(self.data.get_unmatched_offers(), [])
+
+    def test_readers_see_committed_state(self):
+        reader = DBDataAccess(self.dbfile)
+        with self.data.transaction():
+            self.data.add_offer(Offer.unmatched(spot_e11, hours(3, 12)))
+            self.assertEqual(reader.get_unmatched_offers(), [])
+        self.assertEqual(reader.get_unmatched_offers(), [Offer.unmatched(spot_e11, hours(3, 12))])
+
+    def test_rows_share_users_and_spots(self):
+        request = Request(User("nopark", "nopark@lp.pl"), today(5), today(8), spot_e11.zone)
+        with self.data.transaction():
+            self.data.add_offer(Offer.unmatched(spot_e11, hours(3, 12)))
+            self.data.add_offer(Offer.matched_with(spot_e11, request))
+        first, second = self.data.get_unmatched_offers() + self.data.get_matched_offers()
+        self.assertIs(first.spot, spot_e11)
+        self.assertIs(second.spot, spot_e11)
+        self.assertIs(second.matched_request().requestor, user_nopark)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,116 @@
+import random
+import unittest
+from itertools import count
+from parkingmatcher.periodindex import PeriodIndex
+from test_parkingmatcher import hours
+
+
+class PeriodIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = PeriodIndex()
+        for name, period in [("a", hours(1, 3)), ("b", hours(5, 9)), ("c", hours(9, 10)), ("d", hours(12, 14))]:
+            self.index.add(name, period)
+
+    def test_ordered_by_begin(self):
+        self.index.add("e", hours(0, 1))
+        self.assertEqual(list(self.index), ["e", "a", "b", "c", "d"])
+
+    def test_touching(self):
+        self.assertEqual(self.index.touching(hours(3, 5)), ["a", "b"])
+        self.assertEqual(self.index.touching(hours(6, 7)), ["b"])
+        self.assertEqual(self.index.touching(hours(10, 11)), ["c"])
+        self.assertEqual(self.index.touching(hours(0, 20)), ["a", "b", "c", "d"])
+        self.assertEqual(self.index.touching(hours(15, 20)), [])
+
+    def test_touching_long_period(self):
+        self.index.add("long", hours(0, 30))
+        self.assertEqual(self.index.touching(hours(20, 21)), ["long"])
+
+    def test_remove(self):
+        self.assertFalse(self.index.remove("b", hours(5, 8)))
+        self.assertTrue(self.index.remove("b", hours(5, 9)))
+        self.assertFalse(self.index.remove("b", hours(5, 9)))
+        self.assertEqual(len(self.index), 3)
+        self.assertEqual(self.index.touching(hours(6, 9)), ["c"])
+
+    def test_first_within(self):
+        rank = {"a": 3, "b": 2, "c": 1, "d": 0}
+        index = PeriodIndex(key=rank.get)
+        for name, period in [("a", hours(1, 3)), ("b", hours(5, 9)), ("c", hours(9, 10)), ("d", hours(12, 14))]:
+            index.add(name, period)
+        self.assertEqual(index.first_within(hours(0, 10)), "c")
+        self.assertEqual(index.first_within(hours(0, 9)), "b")
+        self.assertEqual(index.first_within(hours(2, 9)), "b")
+        self.assertIsNone(index.first_within(hours(10, 13)))
+        self.assertEqual(self.index.first_within(hours(0, 10)), "a")
+
+    def test_first_within_ties_go_to_earliest_added(self):
+        index = PeriodIndex(key=lambda item: 0)
+        for name, period in [("b", hours(1, 3)), ("a", hours(2, 3)), ("a2", hours(1, 3))]:
+            index.add(name, period)
+        self.assertEqual(index.first_within(hours(0, 4)), "b")
+        index.remove("b", hours(1, 3))
+        self.assertEqual(index.first_within(hours(0, 4)), "a")
+
+    def test_remove_uses_key_taken_when_added(self):
+        rank = {"a": 1, "b": 2}
+        index = PeriodIndex(key=lambda item: rank[item])
+        index.add("a", hours(1, 3))
+        index.add("b", hours(1, 3))
+        rank["a"] = 3
+        self.assertTrue(index.remove("a", hours(1, 3)))
+        self.assertEqual(index.first_within(hours(0, 4)), "b")
+        self.assertTrue(index.remove("b", hours(1, 3)))
+        self.assertIsNone(index.first_within(hours(0, 4)))
+
+    def test_first_within_same_as_scan(self):
+        rand = random.Random(5)
+        index, stored = PeriodIndex(key=lambda item: item % 7), []
+        for name in range(300):
+            if stored and rand.random() < 0.3:
+                index.remove(*stored.pop(rand.randrange(len(stored))))
+            else:
+                begin = rand.randrange(0, 40)
+                stored.append((name, hours(begin, begin + rand.randrange(0, 4))))
+                index.add(*stored[-1])
+            begin = rand.randrange(0, 40)
+            period = hours(begin, min(begin + rand.randrange(0, 12), 47))
+            within = [(name % 7, pos) for pos, (name, per) in enumerate(stored) if period.contains(per)]
+            self.assertEqual(index.first_within(period), stored[min(within)[1]][0] if within else None)
+
+    def test_shortest_containing(self):
+        self.index.add("long", hours(4, 12))
+        self.assertEqual(self.index.shortest_containing(hours(6, 8))[0], "b")
+        self.assertEqual(self.index.shortest_containing(hours(9, 10))[0], "c")
+        self.assertEqual(self.index.shortest_containing(hours(8, 10))[0], "long")
+        self.assertIsNone(self.index.shortest_containing(hours(2, 6)))
+
+    def test_shortest_containing_same_as_scan(self):
+        rand = random.Random(3)
+        index, stored = PeriodIndex(), []
+        for name in range(300):
+            if stored and rand.random() < 0.3:
+                index.remove(*stored.pop(rand.randrange(len(stored))))
+            else:
+                begin = rand.randrange(0, 40)
+                stored.append((name, hours(begin, min(begin + rand.randrange(0, 12), 47))))
+                index.add(*stored[-1])
+            begin = rand.randrange(0, 40)
+            period = hours(begin, begin + rand.randrange(0, 4))
+            containing = [(per.length(), pos) for pos, (_, per) in enumerate(stored) if per.contains(period)]
+            found = index.shortest_containing(period)
+            if containing:
+                self.assertEqual(found[0], stored[min(containing)[1]][0])
+            else:
+                self.assertIsNone(found)
+
+    def test_shortest_containing_ranks_across_indexes(self):
+        sequence = count()
+        first, second = PeriodIndex(sequence), PeriodIndex(sequence)
+        first.add("first", hours(2, 6))
+        second.add("second", hours(3, 7))
+        self.assertLess(first.shortest_containing(hours(4, 5))[1], second.shortest_containing(hours(4, 5))[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+import random
+import unittest
+from parkingmatcher.parkingmatcher import Api, Offer, Request, Spot, TestDataAccess, User, parking_zones, spot_key
+from parkingmatcher.sharding import ShardedApi
+from test_parkingmatcher import hours, today, spot_e11, spot_e21, user_e1, user_e2, user_nopark
+
+spot_out = Spot("outside", 1, user_e1)
+
+
+class ShardedApiTest(unittest.TestCase):
+    def setUp(self):
+        self.api = ShardedApi([user_e1, user_e2, user_nopark], [spot_e11, spot_e21, spot_out])
+
+    def tearDown(self):
+        self.api.close()
+
+    def test_single_zone(self):
+        request = Request(user_nopark, today(4), today(5), "etap1")
+        self.assertIsNone(self.api.new_request(request))
+        self.assertEqual(self.api.new_offer(Offer.unmatched(spot_e11, hours(3, 6))), request)
+        self.assertEqual(self.api.get_matched_offers(), [Offer.matched_with(spot_e11, request)])
+        self.assertEqual(self.api.get_request_queue(), [])
+
+    def test_request_for_several_zones_takes_shortest_offer(self):
+        self.api.new_offer(Offer.unmatched(spot_e11, hours(3, 9)))
+        self.api.new_offer(Offer.unmatched(spot_e21, hours(3, 6)))
+        request = Request(user_nopark, today(4), today(5), "etap1,etap2")
+        self.assertEqual(self.api.new_request(request), Offer.unmatched(spot_e21, hours(3, 6)))
+        self.assertEqual(self.api.get_matched_offers(), [Offer.matched_with(spot_e21, request)])
+        self.assertIn(Offer.unmatched(spot_e11, hours(3, 9)), self.api.get_unmatched_offers())
+
+    def test_waiting_request_for_several_zones(self):
+        request = Request(user_nopark, today(4), today(5), "etap2,outside")
+        self.assertIsNone(self.api.new_request(request))
+        self.assertEqual(self.api.get_request_queue(), [request])
+        results = self.api.apply([("new_offer", Offer.unmatched(spot_out, hours(3, 6))),
+                                  ("new_offer", Offer.unmatched(spot_e21, hours(3, 6)))])
+        self.assertEqual(results, [request, None])
+        self.assertEqual(self.api.get_matched_offers(), [Offer.matched_with(spot_out, request)])
+        self.api.cancel_request(request)
+        self.assertEqual(self.api.get_matched_offers(), [])
+
+    def test_cancelling_returns_none_when_freeing_offer_for_waiting_request(self):
+        single = Request(user_e2, today(4), today(5), "outside", today(1))
+        waiting = Request(user_nopark, today(4), today(5), "etap2,outside", today(2))
+        self.api.new_request(single)
+        self.assertEqual(self.api.new_offer(Offer.unmatched(spot_out, hours(4, 5))), single)
+        self.assertIsNone(self.api.new_request(waiting))
+        self.assertIsNone(self.api.cancel_request(single))
+        self.assertEqual(self.api.get_matched_offers(), [Offer.matched_with(spot_out, waiting)])
+
+    def test_earlier_waiting_request_goes_first(self):
+        earlier = Request(user_nopark, today(4), today(5), "etap2,outside", today(1))
+        later = Request(user_e2, today(4), today(5), "etap1,outside", today(2))
+        self.assertIsNone(self.api.new_request(earlier))
+        results = self.api.apply([("new_offer", Offer.unmatched(spot_out, hours(3, 6))), ("new_request", later)])
+        self.assertEqual(results, [earlier, None])
+        self.assertEqual(self.api.get_matched_offers(), [Offer.matched_with(spot_out, earlier)])
+        self.assertEqual(self.api.get_request_queue(), [later])
+
+    def test_displaced_request_for_several_zones(self):
+        request = Request(user_nopark, today(4), today(5), "etap1,etap2")
+        self.api.new_offer(Offer.unmatched(spot_e11, hours(3, 6)))
+        self.api.new_offer(Offer.unmatched(spot_e21, hours(3, 9)))
+        self.api.new_request(request)
+        self.api.cancel_offer(Offer.unmatched(spot_e11, hours(4, 5)))
+        self.assertEqual(self.api.get_matched_offers(), [Offer.matched_with(spot_e21, request)])
+
+    def test_single_zone_calls_match_api(self):
+        rand = random.Random(18)
+        owners = [User("owner%d" % i, "owner%d@lp.pl" % i) for i in range(6)]
+        zones = sorted(parking_zones)
+        spots = [Spot(zones[i % len(zones)], i, owner) for i, owner in enumerate(owners)]
+        calls = []
+        for i in range(300):
+            begin = rand.randrange(40)
+            period = hours(begin, begin + rand.randint(1, 6))
+            if rand.random() < 0.5:
+                calls.append(("new_offer", Offer.unmatched(rand.choice(spots), period)))
+            else:
+                user = User("user%d" % i, "user%d@lp.pl" % i)
+                calls.append(("new_request", Request(user, period.begin, period.end, rand.choice(zones),
+                                                     today(0) + (period.begin - today(0)) / 100)))
+            if rand.random() < 0.2:
+                calls.append(("cancel_offer" if calls[-1][0] == "new_offer" else "cancel_request", calls[-1][1]))
+        expected = Api(TestDataAccess(owners, spots))
+        with ShardedApi(owners, spots) as sharded:
+            self.assertEqual(sharded.apply(calls), [getattr(expected, method)(arg) for method, arg in calls])
+
+            def key(off):
+                return spot_key(off.spot), off.period.begin_hour
+
+            self.assertEqual(sorted(sharded.get_matched_offers(), key=key),
+                             sorted(expected.data.get_matched_offers(), key=key))
+            self.assertEqual(sorted(sharded.get_unmatched_offers(), key=key),
+                             sorted(expected.data.get_unmatched_offers(), key=key))
+
+    def test_never_matched_twice(self):
+        rand = random.Random(1818)
+        zones = sorted(parking_zones)
+        owners = [User("owner%d" % i, "owner%d@lp.pl" % i) for i in range(6)]
+        spots = [Spot(zones[i % len(zones)], i, owner) for i, owner in enumerate(owners)]
+        calls, requested = [], []
+        for i in range(400):
+            begin = rand.randrange(40)
+            period = hours(begin, begin + rand.randint(1, 6))
+            if rand.random() < 0.5:
+                calls.append(("new_offer", Offer.unmatched(rand.choice(spots), period)))
+            else:
+                user = User("user%d" % i, "user%d@lp.pl" % i)
+                request = Request(user, period.begin, period.end, rand.sample(zones, rand.randint(1, 3)), today(0))
+                calls.append(("new_request", request))
+                requested.append(request)
+            if rand.random() < 0.2:
+                calls.append(("cancel_offer" if calls[-1][0] == "new_offer" else "cancel_request", calls[-1][1]))
+        with ShardedApi(owners, spots) as sharded:
+            sharded.apply(calls)
+            matched = [off.matched_request() for off in sharded.get_matched_offers()]
+            queued = sharded.get_request_queue()
+            self.assertEqual(len(matched), len(set(matched)))
+            self.assertFalse(set(matched) & set(queued))
+            by_spot = {}
+            for offer in sharded.get_unmatched_offers() + sharded.get_matched_offers():
+                by_spot.setdefault(spot_key(offer.spot), []).append(offer.period)
+            for periods in by_spot.values():
+                periods.sort(key=lambda per: per.begin_hour)
+                for earlier, later in zip(periods, periods[1:]):
+                    self.assertFalse(earlier.intersects(later))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from datetime import timedelta, timezone
+from parkingmatcher.parkingmatcher import Api, DBDataAccess, Offer, Request, Spot, TestDataAccess, User, \
+    parking_zones, spot_key
+from parkingmatcher.snapshot import load_snapshot, save_snapshot
+from test_parkingmatcher import hours, today, spot_e11, spot_e21, user_e1, user_e2, user_nopark
+
+
+def workload(rand, spots, count, first=0):
+    zones = sorted(parking_zones)
+    calls = []
+    for i in range(first, first + count):
+        begin = rand.randrange(40)
+        period = hours(begin, begin + rand.randint(1, 6))
+        if rand.random() < 0.5:
+            calls.append(("new_offer", Offer.unmatched(rand.choice(spots), period)))
+        else:
+            user = User(u"użytkownik%d" % i, "user%d@lp.pl" % i)
+            calls.append(("new_request", Request(user, period.begin, period.end, rand.sample(zones, rand.randint(1, 3)),
+                                                 today(0) + timedelta(seconds=rand.randrange(3600), microseconds=i))))
+        if rand.random() < 0.1:
+            calls.append(("cancel_offer" if calls[-1][0] == "new_offer" else "cancel_request", calls[-1][1]))
+    return calls
+
+
+def state(data):
+    def key(off):
+        return spot_key(off.spot), off.period.begin_hour
+
+    return (sorted(data.get_unmatched_offers(), key=key), sorted(data.get_matched_offers(), key=key),
+            data.get_request_queue(), [(req.when_requested, req.zones) for req in data.get_request_queue()])
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "state.snapshot")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        data = TestDataAccess([user_e1, user_e2], [spot_e11, spot_e21])
+        api = Api(data)
+        request = Request(user_nopark, today(4), today(5), "etap1", today(1))
+        api.new_request(request)
+        api.new_request(Request(user_e1, today(4), today(5), "etap2,outside", today(2)))
+        api.new_offer(Offer.unmatched(spot_e11, hours(3, 6)))
+        save_snapshot(data, self.path, 42)
+        restored, position = load_snapshot(self.path)
+        self.assertEqual(position, 42)
+        self.assertEqual(restored.users, [user_e1, user_e2])
+        self.assertEqual(restored.spots, [spot_e11, spot_e21])
+        self.assertEqual(state(restored), state(data))
+        self.assertEqual(restored.get_matched_requests()[0].requestor.name, user_nopark.name)
+        self.assertIs(restored.get_matched_offers()[0].spot, restored.spots[0])
+
+    def test_keeps_order_of_offers(self):
+        data = TestDataAccess([user_e1, user_e2], [spot_e11, spot_e21])
+        api = Api(data)
+        api.new_offer(Offer.unmatched(spot_e21, hours(1, 2)))
+        api.new_request(Request(user_nopark, today(4), today(5), "etap1", today(1)))
+        api.new_offer(Offer.unmatched(spot_e11, hours(4, 5)))
+        api.new_offer(Offer.unmatched(spot_e21, hours(7, 8)))
+        self.assertEqual([off.matched_request() is None for off in data.get_offers()], [True, False, True])
+        save_snapshot(data, self.path)
+        restored, _ = load_snapshot(self.path)
+        self.assertEqual(restored.get_offers(), data.get_offers())
+        into_db, _ = load_snapshot(self.path, lambda users, spots: DBDataAccess(":memory:", users, spots))
+        self.assertEqual(into_db.get_offers(), data.get_offers())
+
+    def test_time_zone_aware_request(self):
+        data = TestDataAccess([user_e1], [spot_e11])
+        when = today(1).replace(tzinfo=timezone.utc)
+        data.add_request(Request(user_nopark, today(4), today(5), "etap1", when))
+        save_snapshot(data, self.path)
+        restored, _ = load_snapshot(self.path)
+        self.assertEqual(restored.get_request_queue()[0].when_requested, when.astimezone().replace(tzinfo=None))
+
+    def test_matching_continues_the_same(self):
+        rand = random.Random(19)
+        owners = [User("owner%d" % i, "owner%d@lp.pl" % i) for i in range(6)]
+        spots = [Spot(sorted(parking_zones)[i % 3], "m%d" % i, owner) for i, owner in enumerate(owners)]
+        data = TestDataAccess(owners, spots)
+        api = Api(data)
+        for method, argument in workload(rand, spots, 300):
+            getattr(api, method)(argument)
+        save_snapshot(data, self.path)
+        restored, _ = load_snapshot(self.path)
+        restored_api = Api(restored)
+        for method, argument in workload(rand, spots, 300, 300):
+            self.assertEqual(getattr(restored_api, method)(argument), getattr(api, method)(argument))
+        self.assertEqual(state(restored), state(data))
+
+    def test_between_data_accesses(self):
+        data = DBDataAccess(":memory:", [user_e1, user_e2, user_nopark], [spot_e11, spot_e21])
+        api = Api(data)
+        api.new_request(Request(user_nopark, today(4), today(5), "etap1", today(1)))
+        api.new_request(Request(user_e2, today(7), today(8), "etap1", today(2)))
+        api.new_offer(Offer.unmatched(spot_e11, hours(3, 6)))
+        save_snapshot(data, self.path)
+        restored, _ = load_snapshot(self.path)
+        self.assertEqual(state(restored), state(data))
+        save_snapshot(restored, self.path)
+        into_db, _ = load_snapshot(self.path, lambda users, spots: DBDataAccess(":memory:", users, spots))
+        self.assertEqual(state(into_db), state(data))
+
+    def test_not_a_snapshot(self):
+        with open(self.path, "wb") as broken:
+            broken.write(b"nothing to see here" * 4)
+        with self.assertRaises(ValueError):
+            load_snapshot(self.path)
+        save_snapshot(TestDataAccess([user_e1], [spot_e11]), self.path)
+        with open(self.path, "r+b") as truncated:
+            truncated.truncate(os.path.getsize(self.path) - 8)
+        with self.assertRaises(ValueError):
+            load_snapshot(self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()